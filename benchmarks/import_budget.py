@@ -0,0 +1,145 @@
+"""
+Startup benchmark of the computational core.
+
+Imports the core modules in fresh interpreters, as a batch worker does,
+and checks the import time and memory against a budget. Fails if any
+plotting, Stan, OSM download or GIS dependency is imported eagerly.
+
+Run from the repository root:
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --top 15
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Modules a batch worker imports. Importing them must not pull in any of
+# the heavy modules below
+CORE_MODULES = ['utils.util', 'utils.graph', 'utils.batch', 'utils.cache',
+                'utils.data_processing', 'utils.accessibility_analysis',
+                'utils.stan_utils']
+
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'osmnx', 'networkx', 'pandana', 'pystan',
+                 'geopandas', 'shapely', 'requests', 'scipy.optimize']
+
+# Best of the runs, in a fresh interpreter. numpy, pandas and
+# scipy.sparse are most of it
+IMPORT_BUDGET_SECONDS = 2.0
+IMPORT_BUDGET_RSS_MB = 150.0
+
+IMPORT_SCRIPT = """
+import sys, json, time, resource
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': seconds,
+                  'max_rss_mb': rss / (1e6 if sys.platform == 'darwin' else 1024),
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+###############
+## MEASURING ##
+###############
+
+def import_run(modules=CORE_MODULES, heavy=HEAVY_MODULES, importtime=False):
+    """
+    Import modules in a fresh interpreter.
+
+    Returns:
+     record: dict of seconds, max_rss_mb and the heavy modules loaded
+     importtime: -X importtime report (stderr) if asked for
+    """
+
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+              ['-c', IMPORT_SCRIPT.format(modules=list(modules), heavy=list(heavy))]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(report, top=10):
+    """(cumulative seconds, module) of the slowest top level imports in an -X importtime report"""
+    rows = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented: keep the top level ones
+        if not name[1:].startswith(' '):
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def import_budget(modules=CORE_MODULES, runs=5, budget_s=IMPORT_BUDGET_SECONDS,
+                  budget_mb=IMPORT_BUDGET_RSS_MB):
+    """
+    Import time and memory of the core over several fresh interpreters.
+
+    Returns:
+     summary: dict of best and median seconds, max RSS, heavy modules
+              loaded and the failed checks (empty if within budget)
+    """
+
+    records = [import_run(modules)[0] for _ in range(runs)]
+    seconds = [r['seconds'] for r in records]
+    summary = {'modules': list(modules),
+               'runs': runs,
+               'best_s': min(seconds),
+               'median_s': float(np.median(seconds)),
+               'max_rss_mb': max(r['max_rss_mb'] for r in records),
+               'heavy': sorted(set(sum((r['heavy'] for r in records), [])))}
+
+    failures = []
+    if summary['best_s'] > budget_s:
+        failures.append('import time {:.2f}s over {:.2f}s'.format(summary['best_s'], budget_s))
+    if summary['max_rss_mb'] > budget_mb:
+        failures.append('RSS {:.0f}MB over {:.0f}MB'.format(summary['max_rss_mb'], budget_mb))
+    if summary['heavy']:
+        failures.append('heavy modules imported: {}'.format(', '.join(summary['heavy'])))
+    summary['failures'] = failures
+    return summary
+
+
+##########
+## MAIN ##
+##########
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modules', nargs='+', default=CORE_MODULES)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SECONDS,
+                        help='import time budget (s)')
+    parser.add_argument('--budget-mb', type=float, default=IMPORT_BUDGET_RSS_MB,
+                        help='peak RSS budget (MB)')
+    parser.add_argument('--top', type=int, default=0,
+                        help='list the slowest top level imports')
+    args = parser.parse_args(argv)
+
+    summary = import_budget(args.modules, args.runs, args.budget, args.budget_mb)
+    print('core import: best {:.3f}s, median {:.3f}s, peak RSS {:.0f}MB (budget {:.2f}s, {:.0f}MB)'
+          .format(summary['best_s'], summary['median_s'], summary['max_rss_mb'],
+                  args.budget, args.budget_mb))
+
+    if args.top:
+        _, report = import_run(args.modules, importtime=True)
+        for seconds, module in slowest_imports(report, args.top):
+            print('{:8.3f}s  {}'.format(seconds, module))
+
+    for failure in summary['failures']:
+        print('FAIL: ' + failure)
+    return 1 if summary['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
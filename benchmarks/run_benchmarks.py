@@ -0,0 +1,326 @@
+"""
+Offline end-to-end benchmarks on synthetic street networks.
+
+Times each pipeline stage (network build, direction separation, speed
+model, accessibility, spatial aggregation, Stan fitting) and its peak
+traced memory on grid and random geometric networks, and writes the
+results to JSON so runs can be compared across commits.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<base>.json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib.util
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+import utils.graph as gr
+import utils.synthetic as syn
+import utils.util as ut
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+RESULTS_DIR = 'benchmarks/results'
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# networkx graphs (and the osmnx based stages on them) above this size
+# are skipped unless asked for: they take minutes and many GB
+MAX_GRAPH_NODES = 200000
+
+# Stage slowdown flagged as a regression by --compare. Stages faster
+# than MIN_COMPARE_SECONDS in the baseline are too noisy to flag
+REGRESSION_RATIO = 1.25
+MIN_COMPARE_SECONDS = 0.05
+
+
+###############
+## MEASURING ##
+###############
+
+class StageSkipped(Exception):
+    """Raised by a stage whose optional dependencies are missing."""
+
+
+def measure(stage_fn, trace_memory=True):
+    """
+    Run one stage, timing it and recording its peak traced memory.
+
+    Returns:
+     value: the stage's return value (None if skipped)
+     record: dict of seconds and peak_mb, or the skip reason
+    """
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        value = stage_fn()
+    except StageSkipped as skipped:
+        return None, {'skipped': str(skipped)}
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+
+    record = {'seconds': seconds}
+    if peak is not None:
+        record['peak_mb'] = peak / 1e6
+    return value, record
+
+
+def optional_import(module, requires=()):
+    """
+    Import a package module, skipping the stage if a dependency is missing.
+    Heavy dependencies of the package modules are imported lazily (see
+    utils.lazy), so the ones a stage uses are listed in requires and
+    probed up front.
+    """
+    for dependency in requires:
+        if importlib.util.find_spec(dependency) is None:
+            raise StageSkipped('{}: No module named {!r}'.format(module, dependency))
+    try:
+        return __import__(module, fromlist=['_'])
+    except ImportError as error:
+        raise StageSkipped('{}: {}'.format(module, error))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+############
+## STAGES ##
+############
+
+def benchmark_network(kind, n_nodes, n_pois=100, distance=15, num_pois=5,
+                      n_regions=10, stan=('closed_form',), max_graph_nodes=MAX_GRAPH_NODES,
+                      trace_memory=True, seed=0):
+    """
+    Time every stage on one synthetic network.
+
+    Args:
+     kind: synthetic network kind (see synthetic.SYNTHETIC_NETWORKS)
+     n_nodes: approximate node count
+     n_pois: number of random POIs
+     distance: accessibility limit (mins)
+     num_pois: nth nearest POIs
+     n_regions: regions per side of the aggregation grid
+     stan: inference modes to time (see stan_utils.INFERENCE_MODES)
+     max_graph_nodes: largest network to build as a networkx graph
+     trace_memory: record peak traced memory per stage
+     seed: random seed
+
+    Returns:
+     records: list of dicts, one per stage
+    """
+
+    records = []
+    state = {}
+
+    def run(stage, stage_fn):
+        value, record = measure(stage_fn, trace_memory)
+        record.update({'network': kind, 'nodes': n_nodes, 'stage': stage})
+        records.append(record)
+        status = record.get('skipped') or '{:.3f}s'.format(record['seconds'])
+        print('{:>16} {:>9} {:<28} {}'.format(kind, n_nodes, stage, status))
+        return value
+
+    def generate():
+        state['nodes'], state['edges'] = syn.synthetic_network(kind, n_nodes, seed)
+        state['pois'] = syn.random_pois(state['nodes'], n_pois, seed)
+    run('generate', generate)
+    nodes_df, edges_df = state['nodes'], state['edges']
+    for record in records:
+        record['edges'] = len(edges_df)
+
+    # Network build
+    def networkx_graph():
+        if len(nodes_df) > max_graph_nodes:
+            raise StageSkipped('over max_graph_nodes')
+        state['G'] = syn.to_osmnx_graph(nodes_df, edges_df)
+    run('build_networkx', networkx_graph)
+
+    # Direction separation (osmnx based and array based)
+    def separate_by_direction():
+        if 'G' not in state:
+            raise StageSkipped('no networkx graph')
+        dp = optional_import('utils.data_processing', requires=['osmnx'])
+        return dp.separate_elevation_graph_by_direction(state['G'])
+    run('separate_by_direction', separate_by_direction)
+
+    def edge_tables():
+        if 'G' not in state:
+            raise StageSkipped('no networkx graph')
+        dp = optional_import('utils.data_processing')
+        return dp.edge_tables_by_direction(state['G'])
+    run('edge_tables_by_direction', edge_tables)
+    state.pop('G', None)
+
+    # Speed models
+    grade = edges_df['grade'].values
+    length = edges_df['length'].values
+
+    def speed_model():
+        edges_df['time_tobler'] = ut.travel_time(grade, length, 'tobler')
+        edges_df['time_tobler_inv'] = ut.travel_time(-grade, length, 'tobler')
+    run('speed_model', speed_model)
+
+    def speed_model_lookup():
+        table = ut.speed_lookup_table('tobler')
+        return ut.travel_time(np.stack([grade, -grade]), length, 'tobler',
+                              lookup=(ut.grade_index(np.stack([grade, -grade])), table))
+    run('speed_model_lookup', speed_model_lookup)
+
+    # Accessibility
+    def array_graph():
+        state['graph'] = gr.build_graph(nodes_df, edges_df, ['time_tobler'], twoway=True)
+    run('build_array_graph', array_graph)
+
+    def accessibility():
+        graph = state['graph']
+        poi_positions = gr.get_node_positions(graph, state['pois']['lon'].values,
+                                              state['pois']['lat'].values)
+        best_dist, _ = gr.nearest_pois(graph, poi_positions, 'time_tobler', distance, num_pois)
+        state['accessibility'] = gr.accessibility_frame(graph, best_dist, distance)
+    run('accessibility_array', accessibility)
+
+    def pandana_accessibility():
+        pandana = optional_import('pandana')
+        aa = optional_import('utils.accessibility_analysis', requires=['pandana'])
+        network = pandana.Network(nodes_df['x'], nodes_df['y'], edges_df['u'], edges_df['v'],
+                                  edges_df[['time_tobler']], twoway=True)
+        return aa.get_accessibility(network, state['pois'], distance, num_pois)
+    run('accessibility_pandana', pandana_accessibility)
+
+    # Spatial aggregation
+    def aggregation():
+        sa = optional_import('utils.spatial_aggregation')
+        regions = syn.region_grid(nodes_df, n_regions)
+        mapping, levels = sa.assign_nodes_to_regions(nodes_df, {'region': (regions, 'region')},
+                                                     crs='epsg:4326')
+        state['mapping'] = mapping
+        state['levels'] = levels
+        return sa.summarise_by_region(state['accessibility'][1], mapping, levels, 'region')
+    run('spatial_aggregation', aggregation)
+
+    # Stan fitting of regional accessibility
+    for inference in stan:
+        def stan_fit():
+            if 'mapping' not in state:
+                raise StageSkipped('no region mapping')
+            su = optional_import('utils.stan_utils',
+                                 requires=[] if inference == 'closed_form' else ['pystan'])
+            acc_df = state['accessibility'][[1]].rename(columns={1: 'accessibility'})
+            acc_df['region'] = state['levels']['region'][state['mapping']['region'].values]
+            acc_df = acc_df[state['mapping']['region'].values != -1]
+            model = None
+            if inference != 'closed_form':
+                model = su.load_or_generate_stan_model(
+                    'stan', 'univariate_normal_hierarchical_single_level_suffstats')
+            data, _ = su.hierarchical_data(acc_df, 'region', 'sufficient')
+            return su.fit_model(model, data, inference, chains=2, iter=500, n_jobs=1)
+        run('stan_' + inference, stan_fit)
+
+    records.append({'network': kind, 'nodes': n_nodes, 'edges': len(edges_df),
+                    'stage': 'max_rss', 'max_rss_mb': resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss / 1024})
+    return records
+
+
+#################
+## COMPARISONS ##
+#################
+
+def compare_results(base_file, new_file, ratio=REGRESSION_RATIO):
+    """
+    Stage by stage timing ratios between two result files.
+
+    Returns:
+     comparison: list of (network, nodes, stage, base s, new s, ratio)
+     regressions: the rows slower than the ratio
+    """
+
+    def stage_times(result_file):
+        with open(result_file) as f:
+            results = json.load(f)
+        return {(r['network'], r['nodes'], r['stage']): r['seconds']
+                for r in results['records'] if 'seconds' in r}
+
+    base = stage_times(base_file)
+    new = stage_times(new_file)
+    comparison = [key + (base[key], new[key], new[key] / max(base[key], 1e-9))
+                  for key in sorted(set(base) & set(new))]
+    regressions = [row for row in comparison
+                   if row[-1] > ratio and row[3] >= MIN_COMPARE_SECONDS]
+    return comparison, regressions
+
+
+##########
+## MAIN ##
+##########
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--networks', nargs='+', default=list(syn.SYNTHETIC_NETWORKS))
+    parser.add_argument('--pois', type=int, default=100)
+    parser.add_argument('--distance', type=float, default=15)
+    parser.add_argument('--num-pois', type=int, default=5)
+    parser.add_argument('--stan', nargs='*', default=['closed_form'],
+                        help='inference modes to time, e.g. closed_form map nuts')
+    parser.add_argument('--max-graph-nodes', type=int, default=MAX_GRAPH_NODES)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc (faster on networkx heavy stages)')
+    parser.add_argument('--out', default=None, help='results JSON file')
+    parser.add_argument('--compare', default=None, help='baseline results JSON file')
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    records = []
+    for kind in args.networks:
+        for n_nodes in args.sizes:
+            records += benchmark_network(kind, n_nodes, args.pois, args.distance, args.num_pois,
+                                         stan=args.stan, max_graph_nodes=args.max_graph_nodes,
+                                         trace_memory=not args.no_memory)
+
+    out_file = args.out or os.path.join(
+        RESULTS_DIR, '{}_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'), commit))
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    with open(out_file, 'w') as f:
+        json.dump({'commit': commit,
+                   'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'platform': platform.platform(),
+                   'args': vars(args),
+                   'records': records}, f, indent=1)
+    print(out_file)
+
+    if args.compare:
+        comparison, regressions = compare_results(args.compare, out_file)
+        for row in comparison:
+            network, nodes, stage, base_s, new_s, ratio = row
+            flag = '  REGRESSION' if row in regressions else ''
+            print('{:>16} {:>9} {:<28} {:8.3f}s -> {:8.3f}s  x{:.2f}{}'.format(
+                network, nodes, stage, base_s, new_s, ratio, flag))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
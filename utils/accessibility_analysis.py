@@ -1,61 +1,130 @@
 # Import packages
 import os
+import warnings
 import pandas as pd
-import osmnx as ox
-import networkx as nx
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandana
-from pandana.loaders import osm
+import utils.cache as cache
+import utils.cleaning as cleaning
+import utils.data_processing as dp
+import utils.elevation as elevation
+import utils.graph as gr
+import utils.instrument as instrument
+import utils.lazy as lazy
+import utils.util as ut
+
+ox = lazy.lazy_import('osmnx')
+nx = lazy.lazy_import('networkx')
+plt = lazy.lazy_import('matplotlib.pyplot')
+sns = lazy.lazy_import('seaborn')
+pandana = lazy.lazy_import('pandana')
+osm = lazy.lazy_import('pandana.loaders.osm')
 
 
 ###########################
 ## PANDANA ACCESSIBILITY ##
 ###########################
 
-def get_pandana_network(osm_bbox, impedance=5000, lcn_cutoff=True):
+@instrument.instrumented
+def get_pandana_network(osm_bbox, impedance=None, lcn_cutoff=True,
+                        cache_dir=None, network_format='h5'):
     """
     Utility function to get pandana nodes within analysis bounding box
-     - Function also filters out poorly connected nodes. Still uncertain
-    if this is required. And if it is, can we find a better set of values?
+     - Function also filters out poorly connected nodes: components of
+    fewer than cleaning.CLEAN_MIN_COMPONENT nodes (see cleaning.clean_graph)
     - Pandana network is saved to disk to avoid re-download
 
     Args:
      osm_bbox: OSM-spec'd bounding box as list
-     impedance: used for filtering poorly connected nodes
+     impedance: deprecated and ignored. Pruning is by component size, not
+                by nodes reached within this distance
+     lcn_cutoff: remove poorly connected nodes
+     cache_dir: if given, the network is stored in the content-addressed
+                cache, keyed on bbox, lcn_cutoff and the effective cleaning
+                parameters (see cleaning.clean_params). Otherwise the
+                bbox-named file in data/ is used.
+     network_format: 'h5' (pandana HDF5) or 'graph' (compact memory-mapped
+                     CSR arrays, see graph.save_graph). The graph format
+                     loads without HDF5 or pandas parsing, and its files
+                     can be shared read-only by batch workers.
     Returns:
      network: pandana network
     """
 
+    if impedance is not None:
+        warnings.warn('get_pandana_network: impedance is deprecated and ignored. Poorly '
+                      'connected nodes are pruned by component size '
+                      '(cleaning.CLEAN_MIN_COMPONENT)', FutureWarning, stacklevel=2)
+    clean_kwargs = {'u': 'from', 'v': 'to'}
+
     # Define some parameters
-    bbox_string = '_'.join([str(x) for x in osm_bbox])
-    net_filename = 'data/network_{}.h5'.format(bbox_string)
+    if cache_dir is None:
+        bbox_string = '_'.join([str(x) for x in osm_bbox])
+        net_filename = 'data/network_{}.h5'.format(bbox_string)
+    else:
+        key = cache.cache_key(stage='pandana_network', bbox=list(osm_bbox),
+                              network_type='walk', lcn_cutoff=lcn_cutoff,
+                              clean=cleaning.clean_params(**clean_kwargs) if lcn_cutoff else None)
+        net_filename = cache.stage_path(key, 'network', cache_dir)
+        os.makedirs(os.path.dirname(net_filename), exist_ok=True)
+        cache.touch(key, cache_dir)
+    if network_format == 'graph':
+        net_filename = os.path.splitext(net_filename)[0]
+        net_exists = gr.is_saved_graph(net_filename)
+    else:
+        net_exists = os.path.isfile(net_filename)
     print(net_filename)
 
-    if os.path.isfile(net_filename):
+    instrument.cache_event(net_exists)
+    if net_exists and network_format == 'graph':
+        network = gr.graph_to_pandana(gr.load_graph(net_filename, mmap=True))
+    elif net_exists:
         # if a street network file already exists, just load the dataset from that
         network = pandana.network.Network.from_hdf5(net_filename)
     else:
         # otherwise, query the OSM API for the street network within the specified bounding box
-        network = pandana.loaders.osm.pdna_network_from_bbox(osm_bbox[0],
+        network = osm.pdna_network_from_bbox(osm_bbox[0],
                                              osm_bbox[1],
                                              osm_bbox[2],
                                              osm_bbox[3],
                                              network_type='walk')
 
 
-        # identify nodes that are connected to fewer than some threshold
-        # of other nodes within a given distance
+        # identify poorly connected nodes by component size. This replaces
+        # pandana's low_connectivity_nodes(impedance, count=10), which
+        # flagged nodes reaching fewer than 10 nodes within impedance
+        # metres, and only approximates it: sparse parts of large
+        # components are kept and dense small components are dropped.
+        # No range query per node is needed
+        rm_nodes = None
         if lcn_cutoff:
-            lcn = network.low_connectivity_nodes(impedance, count=10, imp_name='distance')
-            network.save_hdf5(net_filename, rm_nodes=lcn)
-        else:
-            network.save_hdf5(net_filename)
+            rm_nodes = cleaning.removed_nodes(network.nodes_df, network.edges_df,
+                                              **clean_kwargs)
+        save_network(network, net_filename, network_format, rm_nodes)
 
+        if cache_dir is not None:
+            cache.evict(cache_dir, keep=[key])
 
     return network
 
 
+def save_network(network, net_filename, network_format='h5', rm_nodes=None):
+    """
+    Save a pandana network as HDF5 or as a compact graph directory,
+    leaving out rm_nodes.
+    """
+
+    if network_format == 'h5':
+        network.save_hdf5(net_filename, rm_nodes=rm_nodes)
+        return net_filename
+
+    nodes_df = network.nodes_df
+    if rm_nodes is not None:
+        nodes_df = nodes_df[~nodes_df.index.isin(rm_nodes)]
+    edges_df = network.edges_df.rename(columns={'from': 'u', 'to': 'v'})
+    graph = gr.build_graph(nodes_df, edges_df, list(network.impedance_names))
+    return gr.save_graph(graph, net_filename)
+
+
+@instrument.instrumented
 def get_accessibility(network, pois_df, distance=5000, num_pois=10):
     """
     Calculate accesibility metric per node in pandana network
@@ -80,6 +149,232 @@ def get_accessibility(network, pois_df, distance=5000, num_pois=10):
     return accessibility
 
 
+##################################
+## MULTI-SCENARIO ACCESSIBILITY ##
+##################################
+
+# Impedance column behind each accessibility scenario. time_tobler is the
+# hilly walk along each edge's stored orientation (u -> v), time_tobler_inv
+# the walk against it. On the default two-way network every edge costs the
+# same both ways, so 'there' and 'back' keep the baseline notebooks'
+# approximation: the grade cost of each edge's stored orientation, not of
+# the direction of travel. directional=True gives the true node -> POI
+# ('there') and POI -> node ('back') walks.
+SCENARIO_IMPEDANCES = {'flat': 'time_5khr',
+                       'there': 'time_tobler',
+                       'back': 'time_tobler_inv'}
+
+# Impedances whose reversed edge copy carries the paired column (see
+# directional_edges)
+DIRECTIONAL_IMPEDANCES = {'time_tobler': 'time_tobler_inv'}
+
+
+def directional_edges(edges_df, pairs=DIRECTIONAL_IMPEDANCES):
+    """
+    Edge table for a one-way (twoway=False) network walkable both ways:
+    every edge in its stored orientation plus a reversed copy with u and v
+    swapped, the grade negated and each impedance pair swapped. Each arc's
+    time_tobler is then the time to walk it in its own direction, and its
+    time_tobler_inv the time of the opposite arc, so searches on
+    time_tobler_inv give POI -> node times.
+
+    Args:
+     edges_df: edge dataframe with u, v and impedance columns
+     pairs: dict of impedance column to its opposite-direction column
+
+    Returns:
+     edges_df: edges in both directions, with a fresh index
+    """
+
+    swap = {'u': 'v', 'v': 'u'}
+    for imp, imp_inv in pairs.items():
+        if imp in edges_df and imp_inv in edges_df:
+            swap.update({imp: imp_inv, imp_inv: imp})
+    reversed_df = edges_df.rename(columns=swap)
+    if 'grade' in reversed_df:
+        reversed_df['grade'] = -reversed_df['grade']
+    return pd.concat([edges_df, reversed_df[edges_df.columns]], ignore_index=True)
+
+
+@instrument.instrumented
+def get_multi_impedance_network(nodes_df, edges_df,
+                                impedances=SCENARIO_IMPEDANCES,
+                                twoway=True, directional=False):
+    """
+    Build one pandana network carrying several impedance columns.
+    Replaces building a separate network per travel time column.
+
+    Args:
+     nodes_df: node dataframe with x and y columns (e.g. from
+               separate_elevation_graph_by_direction)
+     edges_df: edge dataframe with u, v and one column per impedance
+     impedances: dict of scenario name to impedance column
+     twoway: whether edges can be walked in both directions. Two-way edges
+             cost the same both ways (see SCENARIO_IMPEDANCES)
+     directional: build a one-way network from directional_edges instead,
+                  so hilly times depend on the direction of travel.
+                  Overrides twoway
+
+    Returns:
+     network: pandana network with all impedance columns
+    """
+
+    if directional:
+        edges_df = directional_edges(edges_df)
+        twoway = False
+    network = pandana.Network(nodes_df['x'], nodes_df['y'],
+                              edges_df['u'], edges_df['v'],
+                              edges_df[list(impedances.values())],
+                              twoway=twoway)
+    return network
+
+
+@instrument.instrumented
+def get_multi_accessibility(network, pois_df, distance=60, num_pois=10,
+                            impedances=SCENARIO_IMPEDANCES):
+    """
+    Calculate accessibility for every scenario of a multi-impedance
+    network. Range queries are precomputed and the POIs are snapped once,
+    then nearest POIs are queried per impedance.
+
+    Args:
+     network: pandana network from get_multi_impedance_network
+     pois_df: dataframe of POIs with lat and lon columns
+     distance: Limit of accessibility analysis, in impedance units.
+     num_pois: integer to calculate nth closest POIS
+     impedances: dict of scenario name to impedance column
+
+    Returns:
+     accessibility: tidy dataframe with one row per node and POI rank.
+                    Columns are node_id, poi_rank, one column per scenario
+                    and the round trip totals flat_total (flat there and
+                    back) and round_trip (there + back). round_trip is a
+                    true directional round trip only on a directional
+                    network (see get_multi_impedance_network).
+    """
+
+    network.precompute(distance + 1)
+    network.set_pois(category='all',
+                     x_col=pois_df['lon'],
+                     y_col=pois_df['lat'],
+                     maxdist=distance,
+                     maxitems=num_pois)
+
+    scenarios = []
+    for scenario, imp_name in impedances.items():
+        scenario_acc = network.nearest_pois(distance=distance,
+                                            category='all',
+                                            num_pois=num_pois,
+                                            imp_name=imp_name)
+        scenarios.append(scenario_acc.stack().rename(scenario))
+    accessibility = pd.concat(scenarios, axis=1)
+    accessibility.index.names = ['node_id', 'poi_rank']
+
+    # Round trip totals, as used for the suburb analyses
+    if 'flat' in accessibility:
+        accessibility['flat_total'] = accessibility['flat'] * 2
+    if 'there' in accessibility and 'back' in accessibility:
+        accessibility['round_trip'] = accessibility['there'] + accessibility['back']
+
+    return accessibility.reset_index()
+
+
+@instrument.instrumented
+def get_elevation_network(osm_bbox, api_key, network_type='walk',
+                          speed_params=dp.toblers, distance=60,
+                          cache_dir=cache.CACHE_DIR, fmt='h5', dem_file=None,
+                          graph_dir=None, clean=True, max_grade=None, directional=False):
+    """
+    Build the hill-aware street network with every stage cached on disk.
+    Stages are keyed on what determines them, so changing the speed model
+    only recomputes edge times and a warm start reads everything back:
+     - graph: undirected osmnx nodes (x, y, elevation) and edges
+              (u, v, length, grade), keyed on bbox, network type and
+              elevation source
+     - clean: the graph without dangling edges, isolated nodes and small
+              components (see cleaning.clean_graph), keyed on the graph
+              and the cleaning parameters
+     - edge_times: flat, there and back travel times, keyed on the
+                   cleaned graph and the speed model parameters
+
+    Args:
+     osm_bbox: OSM-spec'd bounding box as list (S, W, N, E)
+     api_key: Google Elevation API key, only used on a cold start
+              when no DEM is given
+     network_type: osmnx network type
+     speed_params: speed model for the hilly times: a name from
+                   ut.SPEED_MODELS or hiking params (e.g. dp.toblers)
+     distance: accessibility distance cap, used to precompute the network
+     cache_dir: root directory of the cache
+     fmt: 'h5' or 'parquet'
+     dem_file: local DEM raster (see elevation.load_dem). Node heights
+               are sampled offline instead of through the elevation API
+     graph_dir: if given, the multi-impedance graph is also saved there in
+                the compact memory-mapped format (see graph.save_graph),
+                e.g. for batch.run_batch workers
+     clean: run the cleaning stage
+     max_grade: steepest edge kept by the cleaning stage, e.g. 0.5
+     directional: build one-way networks (and graph_dir) with direction
+                  dependent hilly times (see directional_edges)
+
+    Returns:
+     network: precomputed multi-impedance pandana network
+     nodes_df: node dataframe
+     edges_df: edge dataframe with travel times
+    """
+
+    graph_params = {'bbox': list(osm_bbox), 'network_type': network_type,
+                    'elevation': dem_file or 'google'}
+    graph_key = cache.cache_key(stage='graph', **graph_params)
+    nodes_df = cache.load_stage(graph_key, 'nodes', cache_dir, fmt)
+    edges_df = cache.load_stage(graph_key, 'edges', cache_dir, fmt)
+
+    if nodes_df is None or edges_df is None:
+        south, west, north, east = osm_bbox
+        G = ox.graph_from_bbox(north, south, east, west, network_type=network_type)
+        if dem_file is None:
+            G = ox.add_node_elevations(G, api_key=api_key)
+            G = ox.add_edge_grades(G)
+        else:
+            G = elevation.add_node_elevations_from_dem(G, elevation.load_dem(dem_file))
+            G = elevation.add_edge_grades(G)
+        nodes_df, edges = dp.graph_to_edge_table(G)
+        edges_df = pd.DataFrame(edges)
+        cache.save_stage(nodes_df, graph_key, 'nodes', cache_dir, fmt, params=graph_params)
+        cache.save_stage(edges_df, graph_key, 'edges', cache_dir, fmt)
+
+    if clean:
+        nodes_df, edges_df, graph_key = cleaning.cleaned_stage(nodes_df, edges_df, graph_key,
+                                                               cache_dir, fmt,
+                                                               max_grade=max_grade)
+
+    times_key = cache.cache_key(stage='edge_times', graph=graph_key,
+                                speed_model=ut.speed_model_key(speed_params))
+
+    def edge_times():
+        times_df = edges_df[['u', 'v']].copy()
+        times_df['time_5khr'] = ut.flat_travel_time(edges_df['length'])
+        forward, reverse = dp.directional_edge_times(edges_df['length'],
+                                                     edges_df['grade'],
+                                                     speed_model=speed_params)
+        times_df['time_tobler'] = forward
+        times_df['time_tobler_inv'] = reverse
+        return times_df
+
+    edges_df = cache.cached_stage(edge_times, times_key, 'edge_times', cache_dir, fmt)
+    if graph_dir is not None:
+        graph_edges = directional_edges(edges_df) if directional else edges_df
+        gr.save_graph(gr.build_graph(nodes_df, graph_edges, list(SCENARIO_IMPEDANCES.values()),
+                                     twoway=not directional),
+                      graph_dir)
+
+    # Contraction and range precomputation live in pandana's memory and
+    # can't be written out, so they are redone from the cached edges
+    network = get_multi_impedance_network(nodes_df, edges_df, directional=directional)
+    network.precompute(distance + 1)
+    return network, nodes_df, edges_df
+
+
 def plot_accessibility(network, accessibility,
                        osm_bbox,
                        amenity_type = 'Z fuel station',
@@ -111,6 +406,7 @@ def plot_accessibility(network, accessibility,
     return
 
 
+@instrument.instrumented
 def filtered_accessibility_network(pandana_network, filtered_accessibility):
     """
     Filter the pandana network by accessibility values. Only plot the nodes of
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import utils.graph as gr
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Per-process cache of memory-mapped graphs, keyed on graph directory
+_GRAPHS = {}
+
+
+#####################
+## SCENARIO SET UP ##
+#####################
+
+def load_manifest(manifest):
+    """
+    Scenario manifest as a list of dicts.
+    Each scenario has:
+     - name: unique name, used for the output file
+     - graph: directory of a graph saved with graph.save_graph. Separate
+              bounding boxes or speed models are separate graphs or
+              impedance columns
+     - pois: csv file with lat and lon columns, or a list of
+             {'lat': ..., 'lon': ...} records
+     - impedance: impedance column to search on
+     - distance: Limit of accessibility analysis.
+     - num_pois: integer to calculate nth closest POIS
+
+    Args:
+     manifest: list of scenario dicts or path to a JSON file of them
+
+    Returns:
+     scenarios: list of scenario dicts
+    """
+
+    if isinstance(manifest, str):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    names = [scenario['name'] for scenario in manifest]
+    if len(set(names)) != len(names):
+        raise ValueError('Scenario names must be unique')
+    return manifest
+
+
+def scenario_pois(scenario):
+    pois = scenario['pois']
+    if isinstance(pois, str):
+        return pd.read_csv(pois)
+    return pd.DataFrame(pois)
+
+
+def scenario_output(scenario, out_dir):
+    return os.path.join(out_dir, scenario['name'] + '.h5')
+
+
+def worker_graph(graph_dir):
+    """Memory-map a graph once per worker process."""
+    if graph_dir not in _GRAPHS:
+        _GRAPHS[graph_dir] = gr.load_graph(graph_dir, mmap=True)
+    return _GRAPHS[graph_dir]
+
+
+##################
+## BATCH RUNNER ##
+##################
+
+def run_scenario(scenario, out_dir):
+    """
+    Run one get_accessibility style job and write its result.
+
+    Args:
+     scenario: scenario dict (see load_manifest)
+     out_dir: output directory
+
+    Returns:
+     record: dict with the scenario name, output file, node count and
+             wall time
+    """
+
+    start = time.time()
+    graph = worker_graph(scenario['graph'])
+    pois_df = scenario_pois(scenario)
+    distance = scenario.get('distance', 60)
+    num_pois = scenario.get('num_pois', 10)
+
+    poi_positions = gr.get_node_positions(graph, pois_df['lon'].values, pois_df['lat'].values)
+    best_dist, _ = gr.nearest_pois(graph, poi_positions, scenario['impedance'],
+                                   distance, num_pois)
+    accessibility = gr.accessibility_frame(graph, best_dist, distance)
+    accessibility.columns = accessibility.columns.astype(str)
+
+    out_file = scenario_output(scenario, out_dir)
+    accessibility.to_hdf(out_file, key='accessibility', mode='w')
+
+    return {'name': scenario['name'],
+            'output': out_file,
+            'nodes': len(accessibility),
+            'pois': len(pois_df),
+            'seconds': time.time() - start}
+
+
+def run_batch(manifest, out_dir, processes=None, overwrite=False):
+    """
+    Fan scenarios out across a process pool.
+    Workers memory-map the saved graphs read-only, so every worker shares
+    one copy of each network. Each scenario writes its result as soon as
+    it finishes, and scenarios with existing output are skipped unless
+    overwrite is set, so an interrupted batch can be resumed.
+
+    Args:
+     manifest: list of scenario dicts or path to a JSON manifest
+     out_dir: output directory for per-scenario results
+     processes: worker count. Defaults to the number of CPUs
+     overwrite: rerun scenarios that already have output
+
+    Returns:
+     records: dataframe with one row per scenario run
+    """
+
+    scenarios = load_manifest(manifest)
+    os.makedirs(out_dir, exist_ok=True)
+    if not overwrite:
+        scenarios = [s for s in scenarios if not os.path.isfile(scenario_output(s, out_dir))]
+
+    records = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(run_scenario, scenario, out_dir): scenario['name']
+                   for scenario in scenarios}
+        for future in as_completed(futures):
+            record = future.result()
+            print('{name}: {nodes} nodes, {seconds:.1f}s'.format(**record))
+            records.append(record)
+
+    with open(os.path.join(out_dir, 'batch_results.json'), 'w') as f:
+        json.dump(records, f, indent=1)
+    return pd.DataFrame(records)
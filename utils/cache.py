@@ -0,0 +1,200 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+import utils.instrument as instrument
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+CACHE_DIR = 'data/cache'
+MAX_CACHE_BYTES = 5 * 1024**3
+CACHE_FORMATS = {'h5': '.h5', 'parquet': '.parquet'}
+
+
+##################
+## CACHE KEYING ##
+##################
+
+def cache_key(**params):
+    """
+    Content address for a pipeline stage.
+    Parameters are serialised to sorted JSON and hashed, so the same
+    bbox, network type, speed model and distance cap always map to the
+    same entry, and changing any of them maps to a new one.
+
+    Args:
+     **params: JSON serialisable parameters that determine the stage output
+
+    Returns:
+     key: 16 character hex digest
+    """
+
+    params_string = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(params_string.encode('utf-8')).hexdigest()[:16]
+
+
+def entry_dir(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key)
+
+
+def stage_path(key, stage, cache_dir=CACHE_DIR, fmt='h5'):
+    return os.path.join(entry_dir(key, cache_dir), stage + CACHE_FORMATS[fmt])
+
+
+def touch(key, cache_dir=CACHE_DIR):
+    """Mark a cache entry as recently used for LRU eviction."""
+    path = entry_dir(key, cache_dir)
+    if os.path.isdir(path):
+        os.utime(path, None)
+
+
+######################
+## STAGE READ/WRITE ##
+######################
+
+def load_stage(key, stage, cache_dir=CACHE_DIR, fmt='h5'):
+    """
+    Load a cached stage dataframe.
+
+    Args:
+     key: cache key from cache_key
+     stage: name of the pipeline stage (e.g. 'nodes', 'edge_times')
+     cache_dir: root directory of the cache
+     fmt: 'h5' or 'parquet'
+
+    Returns:
+     df: cached dataframe, or None on a cache miss
+    """
+
+    path = stage_path(key, stage, cache_dir, fmt)
+    instrument.cache_event(os.path.isfile(path))
+    if not os.path.isfile(path):
+        return None
+
+    if fmt == 'parquet':
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_hdf(path, 'df')
+    touch(key, cache_dir)
+    return df
+
+
+def save_stage(df, key, stage, cache_dir=CACHE_DIR, fmt='h5',
+               max_bytes=MAX_CACHE_BYTES, params=None):
+    """
+    Write a stage dataframe to the cache and evict old entries if the
+    cache has grown over its size bound.
+    Stages must be plain (non-geometry) dataframes.
+
+    Args:
+     df: dataframe to cache
+     key: cache key from cache_key
+     stage: name of the pipeline stage
+     cache_dir: root directory of the cache
+     fmt: 'h5' or 'parquet'
+     max_bytes: size bound for the whole cache
+     params: optional parameters behind the key, saved for inspection
+    """
+
+    path = stage_path(key, stage, cache_dir, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if fmt == 'parquet':
+        df.to_parquet(path)
+    else:
+        df.to_hdf(path, key='df', mode='w')
+
+    if params is not None:
+        with open(os.path.join(entry_dir(key, cache_dir), 'params.json'), 'w') as f:
+            json.dump(params, f, sort_keys=True, default=str)
+
+    touch(key, cache_dir)
+    evict(cache_dir, max_bytes, keep=[key])
+    return path
+
+
+def cached_stage(build_fn, key, stage, cache_dir=CACHE_DIR, fmt='h5',
+                 max_bytes=MAX_CACHE_BYTES):
+    """
+    Return a cached stage, building and caching it on a miss.
+
+    Args:
+     build_fn: no-argument function returning the stage dataframe
+     key: cache key from cache_key
+     stage: name of the pipeline stage
+
+    Returns:
+     df: stage dataframe
+    """
+
+    df = load_stage(key, stage, cache_dir, fmt)
+    if df is None:
+        df = build_fn()
+        save_stage(df, key, stage, cache_dir, fmt, max_bytes)
+    return df
+
+
+###############################
+## INVALIDATION AND EVICTION ##
+###############################
+
+def entry_size(key, cache_dir=CACHE_DIR):
+    total = 0
+    for root, _, files in os.walk(entry_dir(key, cache_dir)):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def invalidate(key=None, stage=None, cache_dir=CACHE_DIR):
+    """
+    Remove cached data.
+     - No key: clear the whole cache
+     - Key only: remove every stage of that entry
+     - Key and stage: remove that stage in every format
+    """
+
+    if key is None:
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+    elif stage is None:
+        shutil.rmtree(entry_dir(key, cache_dir), ignore_errors=True)
+    else:
+        for fmt in CACHE_FORMATS:
+            path = stage_path(key, stage, cache_dir, fmt)
+            if os.path.isfile(path):
+                os.remove(path)
+    return
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, keep=()):
+    """
+    Least recently used eviction.
+    Removes whole entries, oldest use first, until the cache fits in
+    max_bytes. Entries listed in keep are never removed.
+
+    Returns:
+     evicted: list of evicted keys
+    """
+
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = [(os.path.getmtime(entry_dir(key, cache_dir)), key, entry_size(key, cache_dir))
+               for key in os.listdir(cache_dir)
+               if os.path.isdir(entry_dir(key, cache_dir))]
+    total = sum(size for _, _, size in entries)
+
+    evicted = []
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        invalidate(key, cache_dir=cache_dir)
+        total -= size
+        evicted.append(key)
+    return evicted
@@ -0,0 +1,188 @@
+import numpy as np
+import shapely
+import geopandas
+import utils.graph as gr
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+CATCHMENT_THRESHOLDS = (5, 10, 15)
+CATCHMENT_CRS = 'epsg:4326'
+METRES_PER_DEGREE = 111320.0
+
+# Half width (m) of the street buffer around reachable edges
+CATCHMENT_BUFFER = 25.0
+
+# Concave hull tightness for method='alpha' (0: tightest, 1: convex)
+CONCAVE_RATIO = 0.3
+
+
+#######################
+## LOCAL COORDINATES ##
+#######################
+
+def local_frame(graph):
+    """
+    Equirectangular local metres around the graph centre, so buffers are in
+    metres. Returns (to_local, to_lon_lat) coordinate functions for
+    shapely.transform.
+    """
+
+    x0 = np.mean(graph['x']) if len(graph['x']) else 0.0
+    y0 = np.mean(graph['y']) if len(graph['y']) else 0.0
+    x_scale = METRES_PER_DEGREE * np.cos(np.radians(y0))
+
+    def to_local(coords):
+        return np.column_stack([(coords[:, 0] - x0) * x_scale,
+                                (coords[:, 1] - y0) * METRES_PER_DEGREE])
+
+    def to_lon_lat(coords):
+        return np.column_stack([coords[:, 0] / x_scale + x0,
+                                coords[:, 1] / METRES_PER_DEGREE + y0])
+
+    return to_local, to_lon_lat
+
+
+def grouped_geometries(parts, groups, n_groups, collection):
+    """
+    Collect parts into one geometry per group (groups sorted). Groups
+    with no parts get an empty geometry.
+    """
+
+    out = np.full(n_groups, shapely.from_wkt('GEOMETRYCOLLECTION EMPTY'), dtype=object)
+    if len(parts):
+        present, codes = np.unique(groups, return_inverse=True)
+        out[present] = collection(parts, indices=codes)
+    return out
+
+
+################
+## CATCHMENTS ##
+################
+
+def reachable_segments(dist, thresholds, src, dst, weights, coords):
+    """
+    Walkable street segments per (POI, threshold) from one distance block.
+    An arc u -> v with v within the threshold of the POI is reachable from
+    the point where the remaining time runs out, so it is cut at the
+    fraction (threshold - time(v)) / arc time measured from v.
+
+    Args:
+     dist: (#POIs in chunk, #nodes) node -> POI times
+     thresholds: sorted thresholds
+     src, dst, weights: arc arrays of the graph
+     coords: (#nodes, 2) local node coordinates
+
+    Returns:
+     lines: array of segment coordinates (#segments, 2, 2)
+     groups: poi_in_chunk * #thresholds + threshold index per segment
+    """
+
+    lines = []
+    groups = []
+    dist_v = dist[:, dst]
+    for j, threshold in enumerate(thresholds):
+        poi, arc = np.nonzero(dist_v <= threshold)
+        frac = np.minimum((threshold - dist_v[poi, arc]) / weights[arc], 1.0)
+        start = coords[dst[arc]]
+        end = start + frac[:, None] * (coords[src[arc]] - start)
+        lines.append(np.stack([start, end], axis=1))
+        groups.append(poi * len(thresholds) + j)
+
+    lines = np.concatenate(lines)
+    groups = np.concatenate(groups)
+    order = np.argsort(groups, kind='stable')
+    return lines[order], groups[order]
+
+
+def catchments(graph, pois_df, imp, thresholds=CATCHMENT_THRESHOLDS, method='alpha',
+               buffer=CATCHMENT_BUFFER, concave_ratio=CONCAVE_RATIO,
+               chunk_size=gr.POI_CHUNK_SIZE):
+    """
+    Walking time catchment (isochrone) polygons for every POI and threshold.
+    One bounded multi-source search per chunk of POIs, up to the largest
+    threshold, gives every node's time to each POI. The walkable street
+    segments (partial edges included) of all POIs and thresholds in the
+    chunk are then turned into polygons together.
+
+    Args:
+     graph: array graph from graph.build_graph
+     pois_df: dataframe of POIs with lat and lon columns. The index is
+              used as the POI id
+     imp: impedance name, e.g. the hill aware 'time_tobler'
+     thresholds: catchment times, in impedance units
+     method: 'alpha' (concave hull of the segment end points, buffered:
+             milliseconds per polygon) or 'edges' (exact union of the
+             buffered segments: closer to the street shape but about a
+             hundred times slower)
+     buffer: buffer half width (m)
+     concave_ratio: concave hull ratio for method='alpha'
+     chunk_size: number of POIs searched together
+
+    Returns:
+     catchments: GeoDataFrame with one row per POI and threshold: poi_id,
+                 threshold, nodes (reached node count), area_m2 and the
+                 catchment polygon (lon / lat)
+    """
+
+    if method not in ['alpha', 'edges']:
+        raise ValueError("method must be 'alpha' or 'edges'")
+
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    n_thresholds = len(thresholds)
+    poi_positions = gr.get_node_positions(graph, pois_df['lon'].values, pois_df['lat'].values)
+
+    to_local, to_lon_lat = local_frame(graph)
+    coords = to_local(np.column_stack([graph['x'], graph['y']]))
+
+    # Arcs in the node -> POI search direction
+    matrix = gr.graph_matrix(graph, imp, reverse=True)
+    dst = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    src = matrix.indices
+    weights = matrix.data
+
+    polygons = []
+    nodes = []
+    for start, dist in gr.poi_distance_chunks(graph, poi_positions, imp,
+                                               thresholds[-1], chunk_size):
+        n_groups = dist.shape[0] * n_thresholds
+        nodes.append((dist[:, :, None] <= thresholds).sum(axis=1).ravel())
+        lines, groups = reachable_segments(dist, thresholds, src, dst, weights, coords)
+
+        if method == 'alpha':
+            # Nodes are shared by many segments: hull each distinct point once
+            points = np.unique(np.column_stack([np.repeat(groups, 2),
+                                                np.round(lines.reshape(-1, 2), 2)]), axis=0)
+            hulls = grouped_geometries(shapely.points(points[:, 1:]),
+                                       points[:, 0].astype(np.int64), n_groups,
+                                       shapely.multipoints)
+            polygons.append(shapely.buffer(shapely.concave_hull(hulls, concave_ratio),
+                                           buffer, quad_segs=4))
+        else:
+            buffered = shapely.buffer(shapely.linestrings(lines), buffer, quad_segs=4)
+            bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+            polygons.append(np.array([shapely.union_all(buffered[bounds[k]:bounds[k + 1]])
+                                      for k in range(n_groups)], dtype=object))
+
+    polygons = np.concatenate(polygons) if polygons else np.array([], dtype=object)
+    return geopandas.GeoDataFrame(
+        {'poi_id': np.repeat(np.asarray(pois_df.index), n_thresholds),
+         'threshold': np.tile(thresholds, len(pois_df)),
+         'nodes': np.concatenate(nodes) if nodes else np.array([], dtype=np.int64),
+         'area_m2': shapely.area(polygons)},
+        geometry=shapely.transform(polygons, to_lon_lat),
+        crs=CATCHMENT_CRS)
+
+
+def catchment_union(catchments_gdf):
+    """
+    Area reachable from any POI within each threshold (e.g. the city wide
+    5/10/15 min playground catchments).
+
+    Returns:
+     union: GeoDataFrame with one row per threshold
+    """
+
+    return catchments_gdf[['threshold', 'geometry']].dissolve(by='threshold').reset_index()
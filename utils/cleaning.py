@@ -0,0 +1,141 @@
+import inspect
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+import utils.cache as cache
+import utils.instrument as instrument
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Components with fewer nodes are dropped: the count pandana's
+# low_connectivity_nodes pruning used (count=10)
+CLEAN_MIN_COMPONENT = 10
+
+CLEAN_REPORT_KEYS = ['dangling_edges', 'self_loops', 'steep_edges', 'isolated_nodes',
+                     'components', 'largest_component', 'small_component_nodes',
+                     'nodes_kept', 'edges_kept']
+
+
+####################
+## GRAPH CLEANING ##
+####################
+
+@instrument.instrumented
+def clean_graph(nodes_df, edges_df, min_component_size=CLEAN_MIN_COMPONENT,
+                largest_only=False, max_grade=None, twoway=True, connection='weak',
+                u='u', v='v', grade='grade'):
+    """
+    Clean a street network from its node and edge tables in linear time:
+     - dangling edges (an end node missing from nodes_df) and self loops
+       are dropped
+     - edges steeper than max_grade are dropped, if given
+     - nodes left with no edges are dropped
+     - connected components smaller than min_component_size (or all but
+       the largest) are dropped with their edges
+    Replaces pandana's low_connectivity_nodes, which runs a range query
+    from every node, and osmnx's remove_isolated_nodes.
+
+    Args:
+     nodes_df: node dataframe indexed by node id
+     edges_df: edge dataframe with u and v node id columns
+     min_component_size: smallest component kept (nodes)
+     largest_only: keep only the largest component
+     max_grade: steepest edge kept (absolute grade), e.g. 0.3
+     twoway: whether edges can be walked in both directions
+     connection: 'weak' or 'strong' components. Only differs for one-way
+                 edge lists (twoway=False)
+     u, v, grade: edge column names, e.g. 'from' and 'to' for pandana
+
+    Returns:
+     nodes_df, edges_df: cleaned tables
+     report: dict of what was removed at each step (see CLEAN_REPORT_KEYS)
+    """
+
+    n_nodes = len(nodes_df)
+    u_pos = nodes_df.index.get_indexer(edges_df[u].values)
+    v_pos = nodes_df.index.get_indexer(edges_df[v].values)
+
+    report = {}
+    valid = (u_pos >= 0) & (v_pos >= 0)
+    report['dangling_edges'] = int((~valid).sum())
+    loops = valid & (u_pos == v_pos)
+    report['self_loops'] = int(loops.sum())
+    keep_edge = valid & ~loops
+    if max_grade is not None:
+        steep = keep_edge & (np.abs(edges_df[grade].values) > max_grade)
+        report['steep_edges'] = int(steep.sum())
+        keep_edge &= ~steep
+    else:
+        report['steep_edges'] = 0
+
+    degree = np.bincount(np.concatenate([u_pos[keep_edge], v_pos[keep_edge]]),
+                         minlength=n_nodes)
+    isolated = degree == 0
+    report['isolated_nodes'] = int(isolated.sum())
+
+    matrix = sparse.csr_matrix((np.ones(keep_edge.sum(), dtype=np.int8),
+                                (u_pos[keep_edge], v_pos[keep_edge])),
+                               shape=(n_nodes, n_nodes))
+    directed = not twoway and connection == 'strong'
+    _, labels = csgraph.connected_components(matrix, directed=directed, connection=connection)
+    sizes = np.bincount(labels)
+    # Isolated nodes are singleton components: they aren't counted
+    report['components'] = len(np.unique(labels[~isolated]))
+    report['largest_component'] = int(sizes.max()) if n_nodes else 0
+
+    if largest_only:
+        keep_node = ~isolated & (labels == np.argmax(sizes))
+    else:
+        keep_node = ~isolated & (sizes[labels] >= min_component_size)
+    report['small_component_nodes'] = int((~isolated & ~keep_node).sum())
+
+    keep_edge &= keep_node[np.maximum(u_pos, 0)] & keep_node[np.maximum(v_pos, 0)]
+    report['nodes_kept'] = int(keep_node.sum())
+    report['edges_kept'] = int(keep_edge.sum())
+    return nodes_df[keep_node], edges_df[keep_edge], report
+
+
+def clean_params(**clean_kwargs):
+    """
+    Effective clean_graph parameters for the given keyword arguments,
+    defaults included, for keying cached stages on the cleaning rule.
+    """
+
+    bound = inspect.signature(clean_graph).bind_partial(None, None, **clean_kwargs)
+    bound.apply_defaults()
+    return {name: value for name, value in bound.arguments.items()
+            if name not in ['nodes_df', 'edges_df']}
+
+
+def removed_nodes(nodes_df, edges_df, **clean_kwargs):
+    """Node ids clean_graph would remove, e.g. as rm_nodes for network.save_hdf5"""
+    clean_nodes, _, _ = clean_graph(nodes_df, edges_df, **clean_kwargs)
+    return nodes_df.index[~nodes_df.index.isin(clean_nodes.index)].values
+
+
+def cleaned_stage(nodes_df, edges_df, graph_key, cache_dir=cache.CACHE_DIR, fmt='h5',
+                  **clean_kwargs):
+    """
+    Cleaned node and edge tables as a cached pipeline stage, keyed on the
+    raw graph's key and the effective cleaning parameters (defaults
+    included, so changing CLEAN_MIN_COMPONENT makes a new entry). The
+    cleaning report is saved with the entry's params.
+
+    Returns:
+     nodes_df, edges_df: cleaned tables
+     clean_key: cache key of the stage, for keying later stages on
+    """
+
+    params = clean_params(**clean_kwargs)
+    clean_key = cache.cache_key(stage='clean', graph=graph_key, **params)
+    clean_nodes = cache.load_stage(clean_key, 'nodes', cache_dir, fmt)
+    clean_edges = cache.load_stage(clean_key, 'edges', cache_dir, fmt)
+    if clean_nodes is None or clean_edges is None:
+        clean_nodes, clean_edges, report = clean_graph(nodes_df, edges_df, **clean_kwargs)
+        cache.save_stage(clean_nodes, clean_key, 'nodes', cache_dir, fmt,
+                         params=dict(params, graph=graph_key, report=report))
+        cache.save_stage(clean_edges, clean_key, 'edges', cache_dir, fmt)
+    return clean_nodes, clean_edges, clean_key
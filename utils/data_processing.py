@@ -1,18 +1,23 @@
 import pandas as pd
-import requests
+import numpy as np
 import os
 import ast
-from shapely.geometry import Point
-import geopandas
-import osmnx as ox
+import utils.instrument as instrument
+import utils.lazy as lazy
 import utils.util as ut
 
+requests = lazy.lazy_import('requests')
+shapely = lazy.lazy_import('shapely')
+geopandas = lazy.lazy_import('geopandas')
+ox = lazy.lazy_import('osmnx')
+
 ########################
 ##  GLOBAL PARAMETERS ##
 ########################
 
-toblers = [6.0, 3.5, 0.05]
-brunsdon = [3.557, 2.03, 0.13]
+# Speed model parameters live in the util speed model registry
+toblers = ut.toblers
+brunsdon = ut.brunsdon
 
 
 ########################
@@ -43,7 +48,8 @@ def replace_categorical_with_int(df, level):
 
 def generate_overpass_query(tags, objects,
                             osm_bbox,
-                            entities=["amenity"]):
+                            entities=["amenity"],
+                            timeout=60):
     """
     Generate and return Overpass query string
     Permuation of entities, tags and objects.
@@ -54,12 +60,13 @@ def generate_overpass_query(tags, objects,
      objects: list of objects (e.g. nodes, ways)
      osm_bbox: vertex list of OSM bounding box convention. Order is: (S, W, N, E)
      entities: list of entities (amenity by default)
+     timeout: Overpass server timeout (seconds)
 
     Returns:
      compactOverpassQLstring: query string
     """
 
-    compactOverpassQLstring = '[out:json][timeout:60];('
+    compactOverpassQLstring = '[out:json][timeout:%d];(' % timeout
     for entity in entities:
         for tag in tags:
             for obj in objects:
@@ -72,7 +79,9 @@ def generate_overpass_query(tags, objects,
     return compactOverpassQLstring
 
 
-def get_osm_data(compactOverpassQLstring, osm_bbox):
+@instrument.instrumented
+def get_osm_data(compactOverpassQLstring, osm_bbox,
+                 osmurl='http://overpass-api.de/api/interpreter'):
     """
     Get Data from OSM via Overpass. Convert JSON to Pandas dataframe. Save.
     If data has been downloaded previously, read from csv
@@ -80,22 +89,25 @@ def get_osm_data(compactOverpassQLstring, osm_bbox):
     Args:
      compactOverpassQLstring: Query string
      osm_bbox: OSM-spec'd bounding box as list
+     osmurl: Overpass API endpoint
 
     Returns:
      osmdf: pandas dataframe of extracted JSON
+
+    For large bounding boxes use osm_ingest.stream_osm_data instead
     """
 
     # Filename
     bbox_string = '_'.join([str(x) for x in osm_bbox])
     osm_filename = 'data/osm_data_{}.csv'.format(bbox_string)
 
+    instrument.cache_event(os.path.isfile(osm_filename))
     if os.path.isfile(osm_filename):
         osm_df = pd.read_csv(osm_filename)
 
     else:
         # Request data from Overpass
         osmrequest = {'data': compactOverpassQLstring}
-        osmurl = 'http://overpass-api.de/api/interpreter'
 
         # Ask the API
         osm = requests.get(osmurl, params=osmrequest)
@@ -113,9 +125,11 @@ def get_osm_data(compactOverpassQLstring, osm_bbox):
             else:
                 pass
         osm_df = pd.DataFrame(osmdata)
+        osm_df.to_csv(osm_filename, index=False)
     return osm_df
 
 
+@instrument.instrumented
 def separate_elevation_graph_by_direction(G):
     """
     """
@@ -141,6 +155,10 @@ def separate_elevation_graph_by_direction(G):
                                                          edges_gdfs_undir_inv['length'],
                                                          params_list=toblers)
 
+    # Return trip time on the forward edges, so one network can carry
+    # both directions as separate impedances
+    edges_gdfs_undir['time_tobler_inv'] = edges_gdfs_undir_inv['time_tobler']
+
     # Create the expected indices for pandana edges
     edges_gdfs_undir['from_idx'] = edges_gdfs_undir['u']
     edges_gdfs_undir['to_idx'] = edges_gdfs_undir['v']
@@ -156,56 +174,249 @@ def separate_elevation_graph_by_direction(G):
     return edges_gdfs_undir_inv, edges_gdfs_undir, nodes_gdfs_undir
 
 
+@instrument.instrumented
+def graph_to_edge_table(G, geometry=False):
+    """
+    Compact undirected edge table of an osmnx graph.
+    Reciprocal edges (u, v, k) and (v, u, k) are collapsed to one edge as in
+    G.to_undirected(), without copying the graph or building GeoDataFrames.
+
+    Args:
+     G: osmnx graph with length and grade edge attributes
+     geometry: also return edge geometries. Edges without one get a
+               straight line between their end nodes.
+
+    Returns:
+     nodes_df: node dataframe (x, y and elevation if present) indexed by osmid
+     edges: dict of NumPy arrays u, v, length and grade
+            (and a geometry list if asked for)
+    """
+
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    node_data = {'x': [G.nodes[n]['x'] for n in node_ids],
+                 'y': [G.nodes[n]['y'] for n in node_ids]}
+    if node_ids.size and 'elevation' in G.nodes[node_ids[0]]:
+        node_data['elevation'] = [G.nodes[n]['elevation'] for n in node_ids]
+    nodes_df = pd.DataFrame(node_data, index=pd.Index(node_ids, name='osmid'))
+
+    n_edges = G.number_of_edges()
+    edge_list = list(G.edges(keys=True, data=True))
+    u = np.fromiter((e[0] for e in edge_list), dtype=np.int64, count=n_edges)
+    v = np.fromiter((e[1] for e in edge_list), dtype=np.int64, count=n_edges)
+    k = np.fromiter((e[2] for e in edge_list), dtype=np.int64, count=n_edges)
+    length = np.fromiter((e[3]['length'] for e in edge_list), dtype=np.float64, count=n_edges)
+    grade = np.fromiter((e[3].get('grade', np.nan) for e in edge_list),
+                        dtype=np.float64, count=n_edges)
+
+    # Collapse reciprocal edges: keep the first of each unordered (u, v, k)
+    lo = np.minimum(u, v)
+    hi = np.maximum(u, v)
+    _, keep = np.unique(np.stack([lo, hi, k], axis=1), axis=0, return_index=True)
+    keep.sort()
+
+    edges = {'u': u[keep], 'v': v[keep], 'length': length[keep], 'grade': grade[keep]}
+
+    if geometry:
+        from shapely.geometry import LineString
+        edges['geometry'] = [edge_list[i][3]['geometry'] if 'geometry' in edge_list[i][3]
+                             else LineString([(G.nodes[edge_list[i][0]]['x'], G.nodes[edge_list[i][0]]['y']),
+                                              (G.nodes[edge_list[i][1]]['x'], G.nodes[edge_list[i][1]]['y'])])
+                             for i in keep]
+
+    return nodes_df, edges
+
+
+@instrument.instrumented
+def directional_edge_times(length, grade, speed_model=toblers, lookup=False):
+    """
+    Forward and reverse travel times for every edge in one vectorized sweep.
+    The reverse direction walks the same edge with the grade inverted.
+
+    Args:
+     length: array of edge lengths (m)
+     grade: array of edge grades in the u -> v direction
+     speed_model: speed model name from ut.SPEED_MODELS, (kernel, params)
+                  pair or hiking params list (e.g. toblers, brunsdon)
+     lookup: gather speeds from a quantized grade lookup table
+
+    Returns:
+     forward: array of u -> v times (mins)
+     reverse: array of v -> u times (mins)
+    """
+
+    length = np.asarray(length, dtype=np.float64)
+    grade = np.asarray(grade, dtype=np.float64)
+    both_grades = np.stack([grade, -grade])
+    model_lookup = None
+    if lookup:
+        model_lookup = (ut.grade_index(both_grades), ut.speed_lookup_table(speed_model))
+    times = ut.travel_time(both_grades, length, speed_model, lookup=model_lookup)
+    return times[0], times[1]
+
+
+@instrument.instrumented
+def edge_tables_by_direction(G, speed_model=toblers, geometry=False):
+    """
+    Array-backed replacement for separate_elevation_graph_by_direction.
+    Returns the same three frames, with the same columns and (u, v)
+    pandana edge index, but built from the compact edge table and without
+    geometry unless asked for. The forward frame also carries
+    time_tobler_inv, the return trip time along each edge.
+
+    Args:
+     G: osmnx graph with length and grade edge attributes
+     speed_model: speed model name, (kernel, params) pair or params list
+     geometry: keep edge geometries
+
+    Returns:
+     edges_inv_df: edges with u and v swapped and the grade inverted
+     edges_df: edges with flat and hiking travel times
+     nodes_df: node dataframe
+    """
+
+    nodes_df, edges = graph_to_edge_table(G, geometry=geometry)
+    forward, reverse = directional_edge_times(edges['length'], edges['grade'], speed_model)
+    time_5khr = ut.flat_travel_time(edges['length'])
+
+    edges_df = pd.DataFrame({'u': edges['u'],
+                             'v': edges['v'],
+                             'length': edges['length'],
+                             'grade': edges['grade'],
+                             'time_5khr': time_5khr,
+                             'time_tobler': forward,
+                             'time_tobler_inv': reverse},
+                            index=pd.MultiIndex.from_arrays([edges['u'], edges['v']],
+                                                            names=['', '']))
+    edges_inv_df = pd.DataFrame({'u': edges['v'],
+                                 'v': edges['u'],
+                                 'length': edges['length'],
+                                 'grade': -edges['grade'],
+                                 'time_5khr': time_5khr,
+                                 'time_tobler': reverse},
+                                index=pd.MultiIndex.from_arrays([edges['v'], edges['u']],
+                                                                names=['', '']))
+
+    if geometry:
+        edges_df['geometry'] = edges['geometry']
+        edges_inv_df['geometry'] = edges['geometry']
+
+    return edges_inv_df, edges_df, nodes_df
+
+
 ##########################
 ## GEOPANDAS PROCESSING ##
 ##########################
 
-def extend_ways_to_node_view(osmdf):
+def parse_node_lists(nodes):
     """
+    Parse way node lists in bulk into flat CSR arrays.
+    Handles lists (fresh Overpass JSON) and '[a, b, c]' strings (csv cache)
+    without a Python call per way.
+
+    Args:
+     nodes: series of node lists or node list strings
+
+    Returns:
+     offsets: array of #ways + 1 offsets. Way i's nodes are
+              values[offsets[i]:offsets[i + 1]]
+     values: flat array of node ids
     """
 
-    osmdf_ways = osmdf.query('type == "way"')[['id', 'nodes', 'type']]
-    osmdf_nodes = osmdf.query('type == "node"')[['id', 'lat', 'lon']]
+    nodes = nodes.values
+    if len(nodes) and isinstance(nodes[0], str):
+        stripped = pd.Series(nodes).str.strip('[] ')
+        lengths = np.where(stripped.str.len() > 0, stripped.str.count(',') + 1, 0)
+        joined = ','.join(stripped[lengths > 0]).replace(' ', '')
+        values = np.array(joined.split(',') if joined else [], dtype=np.int64)
+    else:
+        lengths = np.fromiter((len(way) for way in nodes), dtype=np.int64, count=len(nodes))
+        values = np.fromiter((n for way in nodes for n in way), dtype=np.int64,
+                             count=int(lengths.sum()))
+
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets, values
+
 
-    # Expanding way node list to one row per node. So many
-    osmdf_ways['nodes'] = osmdf_ways['nodes'].apply(convert_list_string)
-    osmdf_ways_clean = (osmdf_ways
-                        .set_index(['id', 'type'])['nodes']
-                        .apply(pd.Series)
-                        .stack()
-                        .reset_index())
-    osmdf_ways_clean.columns = ['way_id', 'type', 'sample_num', 'nodes']
+@instrument.instrumented
+def extend_ways_to_node_view(osmdf):
+    """
+    Expand ways to one row per way node, with the node coordinates.
+    Node lists are parsed in bulk (parse_node_lists) and joined to the
+    nodes through an index lookup.
 
-    # Merge cleaned ways with nodes with one row per node.
-    # Way df is now has many rows per way_id
-    osmdf_clean = pd.merge(osmdf_ways_clean,
-                           osmdf_nodes,
-                           left_on='nodes',
-                           right_on='id').drop(['nodes'], axis=1)
+    Args:
+     osmdf: dataframe of OSM elements (e.g. from get_osm_data)
 
+    Returns:
+     osmdf_clean: dataframe with way_id, type, sample_num (position in
+                  the way), id, lat and lon. Way nodes missing from
+                  osmdf are dropped
+    """
+
+    osmdf_ways = osmdf[osmdf['type'] == 'way']
+    osmdf_nodes = (osmdf[osmdf['type'] == 'node'][['id', 'lat', 'lon']]
+                   .drop_duplicates('id'))
+
+    offsets, values = parse_node_lists(osmdf_ways['nodes'])
+    lengths = np.diff(offsets)
+    way_pos = np.repeat(np.arange(len(osmdf_ways)), lengths)
+    sample_num = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
+
+    # Indexed join to the node coordinates
+    node_pos = pd.Index(osmdf_nodes['id'].values).get_indexer(values)
+    found = node_pos >= 0
+    way_pos = way_pos[found]
+    node_pos = node_pos[found]
+
+    osmdf_clean = pd.DataFrame({'way_id': osmdf_ways['id'].values[way_pos],
+                                'type': osmdf_ways['type'].values[way_pos],
+                                'sample_num': sample_num[found],
+                                'id': osmdf_nodes['id'].values[node_pos],
+                                'lat': osmdf_nodes['lat'].values[node_pos],
+                                'lon': osmdf_nodes['lon'].values[node_pos]})
     return osmdf_clean
 
 
+@instrument.instrumented
 def coords_df_to_geopandas_points(osmdf, crs={'init': u'epsg:4167'}):
     """
+    Point GeoDataFrame from lat and lon columns.
+    Points are built in one vectorized call.
     """
 
-    osmdf['Coordinates'] = list(zip(osmdf.lon, osmdf.lat))
-    osmdf['Coordinates'] = osmdf['Coordinates'].apply(Point)
+    osmdf['Coordinates'] = geopandas.points_from_xy(osmdf.lon, osmdf.lat)
     points_osmdf_clean = geopandas.GeoDataFrame(osmdf, geometry='Coordinates', crs=crs)
     return points_osmdf_clean
 
 
+@instrument.instrumented
 def geopandas_points_to_poly(points_df, crs={'init': u'epsg:4167'}):
     """
+    One polygon per way from the way's node points, in sample order.
+    Ways with fewer than 3 nodes can't form a polygon and are dropped.
+    With shapely 2 all polygons are built in one vectorized call.
     """
 
-    points_df['geometry'] = points_df['Coordinates'].apply(lambda x: x.coords[0])
-    poly_osmdf_clean = (points_df
-                        .groupby('way_id')['geometry']
-                        .apply(lambda x: Polygon(x.tolist()))
-                        .reset_index())
-    poly_osmdf_clean = geopandas.GeoDataFrame(poly_osmdf_clean, crs=crs)
+    points_df = points_df.sort_values(['way_id', 'sample_num'] if 'sample_num' in points_df
+                                      else 'way_id', kind='stable')
+    way_ids, way_pos, counts = np.unique(points_df['way_id'].values,
+                                         return_inverse=True, return_counts=True)
+    way_pos = way_pos.ravel()
+    keep = (counts >= 3)[way_pos]
+    coords = np.column_stack([points_df['Coordinates'].x.values,
+                              points_df['Coordinates'].y.values])[keep]
+    way_pos = way_pos[keep]
+    way_ids = way_ids[counts >= 3]
+
+    if hasattr(shapely, 'polygons'):
+        rings = shapely.linearrings(coords, indices=np.unique(way_pos, return_inverse=True)[1])
+        polygons = shapely.polygons(rings)
+    else:
+        boundaries = np.flatnonzero(np.diff(way_pos)) + 1
+        polygons = [shapely.geometry.Polygon(ring) for ring in np.split(coords, boundaries)]
+
+    poly_osmdf_clean = geopandas.GeoDataFrame({'way_id': way_ids}, geometry=polygons, crs=crs)
     return poly_osmdf_clean
 
 
@@ -213,15 +424,17 @@ def getXY(pt):
     return (pt.x, pt.y)
 
 
+@instrument.instrumented
 def lat_lon_to_geopandas(df):
     """
     """
     # Convert intersection points to Geopandas
-    geometry = [Point(xy) for xy in zip(df.lon, df.lat)]
+    geometry = [shapely.geometry.Point(xy) for xy in zip(df.lon, df.lat)]
     gpd_df = geopandas.GeoDataFrame(pd.DataFrame({'geometry': geometry}), crs=None, geometry=geometry)
     gpd_df = gpd_df[['geometry']]
     return gpd_df
 
+@instrument.instrumented
 def geopandas_to_lat_lon(gpd_df, column):
     x,y = [list(t) for t in zip(*map(getXY, gpd_df[column]))]
     df = pd.DataFrame({'lon': x, 'lat': y})
@@ -0,0 +1,219 @@
+import json
+import numpy as np
+import utils.lazy as lazy
+
+nx = lazy.lazy_import('networkx')
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Raster window edge length (pixels) read per tile when sampling
+DEM_TILE_SIZE = 1024
+NODE_CRS = 'epsg:4326'
+
+
+#################
+## DEM LOADING ##
+#################
+
+def load_dem(dem_file, transform=None, crs=None, nodata=None):
+    """
+    Open a DEM raster without reading it into memory.
+     - .npy rasters are memory-mapped. The geotransform is read from a
+    sidecar <dem_file>.json ({"transform": [x0, dx, y0, dy], "crs": ...,
+    "nodata": ...}) unless given.
+     - GeoTIFFs are opened with rasterio and read window by window.
+
+    Args:
+     dem_file: path to .npy or GeoTIFF raster
+     transform: (x0, dx, y0, dy) of the raster's top left corner and
+                pixel size. dy is negative for north-up rasters
+     crs: raster CRS string (e.g. 'epsg:2193')
+     nodata: raster nodata value
+
+    Returns:
+     dem: dict with a window reader, geotransform, shape, crs and nodata
+    """
+
+    if dem_file.endswith('.npy'):
+        raster = np.load(dem_file, mmap_mode='r')
+        if transform is None:
+            with open(dem_file + '.json') as f:
+                meta = json.load(f)
+            transform = meta['transform']
+            crs = meta.get('crs', crs)
+            nodata = meta.get('nodata', nodata)
+
+        def read_window(row_start, row_stop, col_start, col_stop):
+            return np.asarray(raster[row_start:row_stop, col_start:col_stop],
+                              dtype=np.float64)
+
+        shape = raster.shape
+    else:
+        import rasterio
+        from rasterio.windows import Window
+
+        dataset = rasterio.open(dem_file)
+        if transform is None:
+            affine = dataset.transform
+            transform = (affine.c, affine.a, affine.f, affine.e)
+        crs = crs or (dataset.crs.to_string() if dataset.crs else None)
+        nodata = nodata if nodata is not None else dataset.nodata
+
+        def read_window(row_start, row_stop, col_start, col_stop):
+            window = Window(col_start, row_start,
+                            col_stop - col_start, row_stop - row_start)
+            return dataset.read(1, window=window).astype(np.float64)
+
+        shape = (dataset.height, dataset.width)
+
+    return {'read_window': read_window,
+            'transform': tuple(transform),
+            'shape': shape,
+            'crs': crs,
+            'nodata': nodata}
+
+
+def project_to_dem(dem, x, y, from_crs=NODE_CRS):
+    """
+    Reproject node coordinates into the DEM CRS (needs pyproj when the
+    CRS differ).
+    """
+
+    if dem['crs'] is None or dem['crs'].lower() == from_crs.lower():
+        return x, y
+
+    from pyproj import Transformer
+    transformer = Transformer.from_crs(from_crs, dem['crs'], always_xy=True)
+    return transformer.transform(x, y)
+
+
+##################
+## DEM SAMPLING ##
+##################
+
+def sample_dem(dem, x, y, tile_size=DEM_TILE_SIZE):
+    """
+    Bilinear interpolation of DEM heights at many points.
+    Points are grouped by raster tile and each tile window (plus a one
+    pixel halo) is read once, so memory is bounded by the tile size and
+    not by the raster or the number of points.
+
+    Args:
+     dem: raster from load_dem
+     x, y: point coordinates in the DEM CRS
+     tile_size: window edge length in pixels
+
+    Returns:
+     heights: array of heights. NaN outside the raster or on nodata
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x0, dx, y0, dy = dem['transform']
+    n_rows, n_cols = dem['shape']
+
+    # Fractional pixel positions, relative to pixel centres
+    rows = (y - y0) / dy - 0.5
+    cols = (x - x0) / dx - 0.5
+    inside = ((rows > -0.5) & (rows < n_rows - 0.5) &
+              (cols > -0.5) & (cols < n_cols - 0.5))
+    rows = np.clip(rows, 0, n_rows - 1)
+    cols = np.clip(cols, 0, n_cols - 1)
+
+    heights = np.full(len(x), np.nan)
+    point_idx = np.flatnonzero(inside)
+    if len(point_idx) == 0:
+        return heights
+
+    # Group points by the tile their top left neighbour pixel falls in
+    row_floor = np.floor(rows[point_idx]).astype(np.int64)
+    col_floor = np.floor(cols[point_idx]).astype(np.int64)
+    n_tile_cols = n_cols // tile_size + 1
+    tile_id = (row_floor // tile_size) * n_tile_cols + col_floor // tile_size
+    order = np.argsort(tile_id, kind='stable')
+    tile_id = tile_id[order]
+    point_idx = point_idx[order]
+    boundaries = np.flatnonzero(np.diff(tile_id)) + 1
+
+    for tile_points in np.split(point_idx, boundaries):
+        r = rows[tile_points]
+        c = cols[tile_points]
+        row_start = int(np.floor(r.min()))
+        col_start = int(np.floor(c.min()))
+        row_stop = min(int(np.floor(r.max())) + 2, n_rows)
+        col_stop = min(int(np.floor(c.max())) + 2, n_cols)
+        window = dem['read_window'](row_start, row_stop, col_start, col_stop)
+        if dem['nodata'] is not None:
+            window[window == dem['nodata']] = np.nan
+
+        # Neighbour indices within the window
+        r -= row_start
+        c -= col_start
+        r0 = np.minimum(np.floor(r).astype(np.int64), window.shape[0] - 1)
+        c0 = np.minimum(np.floor(c).astype(np.int64), window.shape[1] - 1)
+        r1 = np.minimum(r0 + 1, window.shape[0] - 1)
+        c1 = np.minimum(c0 + 1, window.shape[1] - 1)
+        fr = r - r0
+        fc = c - c0
+
+        heights[tile_points] = (window[r0, c0] * (1 - fr) * (1 - fc) +
+                                window[r0, c1] * (1 - fr) * fc +
+                                window[r1, c0] * fr * (1 - fc) +
+                                window[r1, c1] * fr * fc)
+    return heights
+
+
+###########################
+## GRAPH ELEVATION STAGE ##
+###########################
+
+def add_node_elevations_from_dem(G, dem, tile_size=DEM_TILE_SIZE):
+    """
+    Offline replacement for ox.add_node_elevations.
+    Samples every node height from a local DEM in one vectorized pass.
+
+    Args:
+     G: osmnx graph with x (lon) and y (lat) node attributes
+     dem: raster from load_dem
+     tile_size: window edge length in pixels
+
+    Returns:
+     G: graph with an elevation attribute on every node
+    """
+
+    node_ids = list(G.nodes)
+    x = np.fromiter((G.nodes[n]['x'] for n in node_ids), dtype=np.float64, count=len(node_ids))
+    y = np.fromiter((G.nodes[n]['y'] for n in node_ids), dtype=np.float64, count=len(node_ids))
+    dem_x, dem_y = project_to_dem(dem, x, y)
+    heights = sample_dem(dem, dem_x, dem_y, tile_size)
+    nx.set_node_attributes(G, dict(zip(node_ids, np.round(heights, 3))), name='elevation')
+    return G
+
+
+def add_edge_grades(G):
+    """
+    Vectorized equivalent of ox.add_edge_grades.
+    Grade is the elevation change over edge length, rounded to 4 dp.
+    Zero length edges get a NaN grade.
+
+    Args:
+     G: graph with node elevations and edge lengths
+
+    Returns:
+     G: graph with a grade attribute on every edge
+    """
+
+    edges = list(G.edges(keys=True, data='length'))
+    elevation = nx.get_node_attributes(G, 'elevation')
+    rise = np.array([elevation[v] - elevation[u] for u, v, _, _ in edges], dtype=np.float64)
+    length = np.array([d for _, _, _, d in edges], dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grade = np.where(length > 0, np.round(rise / length, 4), np.nan)
+
+    nx.set_edge_attributes(G, {(u, v, k): g for (u, v, k, _), g in zip(edges, grade)},
+                           name='grade')
+    return G
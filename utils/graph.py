@@ -0,0 +1,343 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Zero impedance edges are nudged up so sparse searches keep them
+MIN_IMPEDANCE = 1e-6
+
+# Number of POIs searched together. Each search holds a
+# POI_CHUNK_SIZE x #nodes distance block in memory.
+POI_CHUNK_SIZE = 32
+
+
+#################
+## ARRAY GRAPH ##
+#################
+
+def build_graph(nodes_df, edges_df, impedances, twoway=True):
+    """
+    Array (CSR) street graph sharing one topology between impedances.
+    Takes the same node and edge frames as a pandana network. Parallel
+    edges are reduced to the cheapest edge per impedance.
+
+    Args:
+     nodes_df: node dataframe with x and y columns, indexed by node id
+     edges_df: edge dataframe with u, v and impedance columns
+     impedances: list of impedance columns to carry
+     twoway: whether edges can be walked in both directions
+
+    Returns:
+     graph: dict of node_ids, x, y, CSR indptr and indices, per-impedance
+            weights aligned to indices, and twoway
+    """
+
+    node_ids = np.asarray(nodes_df.index.values, dtype=np.int64)
+    node_index = pd.Index(node_ids)
+    from_pos = node_index.get_indexer(edges_df['u'].values)
+    to_pos = node_index.get_indexer(edges_df['v'].values)
+    valid = (from_pos >= 0) & (to_pos >= 0)
+    from_pos = from_pos[valid]
+    to_pos = to_pos[valid]
+    weights = {imp: np.maximum(np.asarray(edges_df[imp].values, dtype=np.float64)[valid],
+                               MIN_IMPEDANCE)
+               for imp in impedances}
+
+    if twoway:
+        from_pos, to_pos = np.concatenate([from_pos, to_pos]), np.concatenate([to_pos, from_pos])
+        weights = {imp: np.concatenate([w, w]) for imp, w in weights.items()}
+
+    # Sort by (from, to) and keep the cheapest of any parallel edges
+    order = np.lexsort((to_pos, from_pos))
+    from_pos = from_pos[order]
+    to_pos = to_pos[order]
+    new_pair = np.ones(len(from_pos), dtype=bool)
+    new_pair[1:] = (from_pos[1:] != from_pos[:-1]) | (to_pos[1:] != to_pos[:-1])
+    starts = np.flatnonzero(new_pair)
+    weights = {imp: np.minimum.reduceat(w[order], starts) if len(starts) else w
+               for imp, w in weights.items()}
+    from_pos = from_pos[starts]
+    to_pos = to_pos[starts]
+
+    # int32 CSR arrays match scipy's sparse index dtype, so graph_matrix
+    # can wrap memory-mapped arrays without copying them
+    n_nodes = len(node_ids)
+    indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(from_pos, minlength=n_nodes), out=indptr[1:])
+
+    return {'node_ids': node_ids,
+            'x': np.asarray(nodes_df['x'].values, dtype=np.float64),
+            'y': np.asarray(nodes_df['y'].values, dtype=np.float64),
+            'indptr': indptr,
+            'indices': to_pos.astype(np.int32),
+            'weights': weights,
+            'twoway': twoway}
+
+
+def graph_matrix(graph, imp, reverse=False):
+    """
+    Sparse adjacency matrix for one impedance. A new CSR matrix object
+    over the graph's arrays: memory-mapped arrays are referenced, not
+    copied, except the transpose built for reverse one-way searches.
+    scipy's csgraph searches still convert the weights to float64 on
+    every call, so a search is not zero-copy.
+
+    Args:
+     graph: array graph from build_graph
+     imp: impedance name
+     reverse: transpose the graph, for searches towards a node
+
+    Returns:
+     matrix: scipy CSR matrix of edge impedances
+    """
+
+    n_nodes = len(graph['node_ids'])
+    matrix = sparse.csr_matrix((graph['weights'][imp], graph['indices'], graph['indptr']),
+                               shape=(n_nodes, n_nodes))
+    if reverse and not graph['twoway']:
+        matrix = matrix.T.tocsr()
+    return matrix
+
+
+def get_node_positions(graph, x, y):
+    """
+    Snap coordinates to the nearest graph node.
+    Longitudes are scaled by cos(latitude) so the KD-tree distance is
+    close to ground distance. The tree is built once and kept on the graph.
+
+    Args:
+     graph: array graph from build_graph
+     x, y: arrays of lon and lat
+
+    Returns:
+     positions: array of node positions (row numbers, not node ids)
+    """
+
+    if 'kdtree' not in graph:
+        graph['x_scale'] = np.cos(np.radians(np.mean(graph['y']))) if len(graph['y']) else 1.0
+        graph['kdtree'] = cKDTree(np.column_stack([graph['x'] * graph['x_scale'], graph['y']]))
+
+    points = np.column_stack([np.asarray(x, dtype=np.float64) * graph['x_scale'],
+                              np.asarray(y, dtype=np.float64)])
+    _, positions = graph['kdtree'].query(points)
+    return positions
+
+
+###################
+## GRAPH STORAGE ##
+###################
+
+GRAPH_ARRAYS = ['node_ids', 'x', 'y', 'indptr', 'indices']
+
+# Impedances are stored as float32 on disk: half the page cache of
+# float64, and far more precise than travel times need
+GRAPH_WEIGHT_DTYPE = np.float32
+
+
+def save_graph(graph, graph_dir, weight_dtype=GRAPH_WEIGHT_DTYPE):
+    """
+    Save an array graph as one flat .npy file per array plus a small JSON
+    description, so it can be memory-mapped by load_graph.
+    The CSR arrays are int32 node positions. Node ids stay int64 (OSM ids
+    overflow int32) in their own lookup array.
+    """
+
+    os.makedirs(graph_dir, exist_ok=True)
+    for name in GRAPH_ARRAYS:
+        np.save(os.path.join(graph_dir, name + '.npy'), graph[name])
+    for imp, weights in graph['weights'].items():
+        np.save(os.path.join(graph_dir, 'weight_' + imp + '.npy'),
+                np.asarray(weights, dtype=weight_dtype))
+    with open(os.path.join(graph_dir, 'graph.json'), 'w') as f:
+        json.dump({'impedances': list(graph['weights']),
+                   'twoway': graph['twoway'],
+                   'nodes': len(graph['node_ids']),
+                   'arcs': len(graph['indices'])}, f)
+    return graph_dir
+
+
+def load_graph(graph_dir, mmap=True):
+    """
+    Load an array graph saved by save_graph.
+    With mmap the arrays are read-only memory maps: nothing is read until
+    it is used, and processes loading the same graph share one
+    page-cached copy.
+    """
+
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(graph_dir, 'graph.json')) as f:
+        meta = json.load(f)
+
+    graph = {name: np.load(os.path.join(graph_dir, name + '.npy'), mmap_mode=mmap_mode)
+             for name in GRAPH_ARRAYS}
+    graph['weights'] = {imp: np.load(os.path.join(graph_dir, 'weight_' + imp + '.npy'),
+                                     mmap_mode=mmap_mode)
+                        for imp in meta['impedances']}
+    graph['twoway'] = meta['twoway']
+    return graph
+
+
+def is_saved_graph(graph_dir):
+    return os.path.isfile(os.path.join(graph_dir, 'graph.json'))
+
+
+######################
+## PANDANA EXCHANGE ##
+######################
+
+def graph_from_pandana(network, impedances=None, twoway=True):
+    """
+    Array graph of a pandana network's nodes and edges.
+
+    Args:
+     network: pandana network
+     impedances: impedance columns to keep. Defaults to all of them
+     twoway: whether the network was built with twoway edges
+
+    Returns:
+     graph: array graph (see build_graph)
+    """
+
+    edges_df = network.edges_df.rename(columns={'from': 'u', 'to': 'v'})
+    impedances = impedances or list(network.impedance_names)
+    return build_graph(network.nodes_df, edges_df, impedances, twoway=twoway)
+
+
+def graph_edges(graph, impedances=None):
+    """
+    Edge table of an array graph. Twoway graphs give each undirected
+    edge once.
+
+    Returns:
+     edges_df: dataframe of u, v (node ids) and one column per impedance
+    """
+
+    impedances = impedances or list(graph['weights'])
+    indptr = np.asarray(graph['indptr'])
+    from_pos = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    to_pos = np.asarray(graph['indices'])
+    keep = from_pos < to_pos if graph['twoway'] else slice(None)
+
+    edges_df = pd.DataFrame({'u': graph['node_ids'][from_pos[keep]],
+                             'v': graph['node_ids'][to_pos[keep]]})
+    for imp in impedances:
+        edges_df[imp] = np.asarray(graph['weights'][imp][keep], dtype=np.float64)
+    return edges_df
+
+
+def graph_to_pandana(graph, impedances=None):
+    """
+    pandana network built straight from (memory-mapped) graph arrays.
+    pandana still copies the arrays into its own structures, but nothing
+    goes through HDF5 or pandas parsing.
+    """
+
+    import pandana
+
+    edges_df = graph_edges(graph, impedances)
+    node_index = pd.Index(graph['node_ids'], name='id')
+    return pandana.Network(pd.Series(graph['x'], index=node_index),
+                           pd.Series(graph['y'], index=node_index),
+                           edges_df['u'], edges_df['v'],
+                           edges_df.drop(columns=['u', 'v']),
+                           twoway=graph['twoway'])
+
+
+######################
+## BOUNDED SEARCHES ##
+######################
+
+def poi_distance_chunks(graph, poi_positions, imp, distance, chunk_size=POI_CHUNK_SIZE):
+    """
+    Bounded shortest path searches from POIs, a chunk at a time.
+    Distances are node -> POI (the search runs on the reversed graph for
+    one-way networks), which is what accessibility measures.
+
+    Args:
+     graph: array graph from build_graph
+     poi_positions: array of POI node positions
+     imp: impedance name
+     distance: search limit, in impedance units
+     chunk_size: number of POIs searched together
+
+    Yields:
+     start: index of the first POI in the chunk
+     dist: (chunk, #nodes) array of distances. inf beyond the limit
+    """
+
+    matrix = graph_matrix(graph, imp, reverse=True)
+    poi_positions = np.asarray(poi_positions, dtype=np.int64)
+    for start in range(0, len(poi_positions), chunk_size):
+        sources = poi_positions[start:start + chunk_size]
+        dist = csgraph.dijkstra(matrix, directed=True, indices=sources, limit=distance)
+        yield start, np.atleast_2d(dist)
+
+
+def merge_nearest(best_dist, best_poi, new_dist, new_poi, num_pois):
+    """
+    Merge candidate POI distances into a k-nearest table.
+
+    Args:
+     best_dist, best_poi: (#nodes, k) current table, inf / -1 when empty
+     new_dist, new_poi: (#nodes, c) candidates
+     num_pois: k
+
+    Returns:
+     best_dist, best_poi: merged (#nodes, k) table, sorted by distance
+    """
+
+    dist = np.concatenate([best_dist, new_dist], axis=1)
+    poi = np.concatenate([best_poi, new_poi], axis=1)
+    if dist.shape[1] > num_pois:
+        keep = np.argpartition(dist, num_pois - 1, axis=1)[:, :num_pois]
+        dist = np.take_along_axis(dist, keep, axis=1)
+        poi = np.take_along_axis(poi, keep, axis=1)
+    order = np.argsort(dist, axis=1, kind='stable')
+    return np.take_along_axis(dist, order, axis=1), np.take_along_axis(poi, order, axis=1)
+
+
+def nearest_pois(graph, poi_positions, imp, distance, num_pois=10,
+                 chunk_size=POI_CHUNK_SIZE):
+    """
+    k nearest POIs for every node, without a #nodes x #POIs matrix.
+
+    Args:
+     graph: array graph from build_graph
+     poi_positions: array of POI node positions
+     imp: impedance name
+     distance: search limit, in impedance units
+     num_pois: k
+     chunk_size: number of POIs searched together
+
+    Returns:
+     best_dist: (#nodes, k) distances, inf where fewer than k POIs in reach
+     best_poi: (#nodes, k) indices into poi_positions, -1 where empty
+    """
+
+    n_nodes = len(graph['node_ids'])
+    best_dist = np.full((n_nodes, num_pois), np.inf)
+    best_poi = np.full((n_nodes, num_pois), -1, dtype=np.int64)
+    for start, dist in poi_distance_chunks(graph, poi_positions, imp, distance, chunk_size):
+        chunk_poi = np.broadcast_to(np.arange(start, start + dist.shape[0]), (n_nodes, dist.shape[0]))
+        best_dist, best_poi = merge_nearest(best_dist, best_poi, dist.T, chunk_poi, num_pois)
+    return best_dist, best_poi
+
+
+def accessibility_frame(graph, best_dist, distance):
+    """
+    k-nearest table as a pandana style accessibility dataframe: one column
+    per POI rank (1..k), unreached entries filled with the distance cap.
+    """
+
+    frame = pd.DataFrame(np.where(np.isinf(best_dist), distance, best_dist),
+                         index=pd.Index(graph['node_ids'], name='id'),
+                         columns=np.arange(1, best_dist.shape[1] + 1))
+    return frame
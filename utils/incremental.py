@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+import utils.graph as gr
+
+
+#####################
+## POI TABLE STATE ##
+#####################
+
+def build_poi_state(graph, pois_df, imp, distance=60, num_pois=10):
+    """
+    Full k-nearest POI computation, kept as state for incremental updates.
+    Adding or removing a POI afterwards only touches the nodes inside that
+    POI's catchment.
+
+    Args:
+     graph: array graph from graph.build_graph
+     pois_df: dataframe of POIs with lat and lon columns. The index is
+              used as the POI id
+     imp: impedance name
+     distance: Limit of accessibility analysis.
+     num_pois: integer to calculate nth closest POIS
+
+    Returns:
+     state: dict with the graph, search settings, POI arrays and the
+            k-nearest distance and POI tables
+    """
+
+    poi_positions = gr.get_node_positions(graph, pois_df['lon'].values, pois_df['lat'].values)
+    best_dist, best_poi = gr.nearest_pois(graph, poi_positions, imp, distance, num_pois)
+
+    return {'graph': graph,
+            'imp': imp,
+            'distance': distance,
+            'num_pois': num_pois,
+            'poi_ids': list(pois_df.index),
+            'poi_positions': np.asarray(poi_positions, dtype=np.int64),
+            'active': np.ones(len(poi_positions), dtype=bool),
+            'dist': best_dist,
+            'poi': best_poi}
+
+
+def poi_index(state, poi_id):
+    return state['poi_ids'].index(poi_id)
+
+
+def accessibility(state):
+    """Current pandana style accessibility dataframe (see graph.accessibility_frame)"""
+    return gr.accessibility_frame(state['graph'], state['dist'], state['distance'])
+
+
+#########################
+## INCREMENTAL UPDATES ##
+#########################
+
+def add_poi(state, lat, lon, poi_id=None):
+    """
+    Add a POI and update only the nodes within its catchment.
+
+    Args:
+     state: POI state from build_poi_state
+     lat, lon: POI location
+     poi_id: id for the new POI, which must not be in use. Defaults to
+             one past the largest integer id
+
+    Returns:
+     affected: node positions whose k-nearest entries changed
+    """
+
+    graph = state['graph']
+    position = gr.get_node_positions(graph, [lon], [lat])[0]
+    if poi_id is None:
+        int_ids = [i for i in state['poi_ids'] if isinstance(i, (int, np.integer))]
+        poi_id = int(max(int_ids)) + 1 if int_ids else len(state['poi_ids'])
+    elif poi_id in state['poi_ids']:
+        raise ValueError('POI id {} is already in use'.format(poi_id))
+    state['poi_ids'].append(poi_id)
+    state['poi_positions'] = np.append(state['poi_positions'], position)
+    state['active'] = np.append(state['active'], True)
+    new_poi = len(state['poi_ids']) - 1
+
+    _, dist = next(gr.poi_distance_chunks(graph, [position], state['imp'], state['distance']))
+    reached = np.flatnonzero(np.isfinite(dist[0]))
+
+    # Only nodes where the new POI beats the current kth entry change
+    affected = reached[dist[0, reached] < state['dist'][reached, -1]]
+    new_dist, new_poi_idx = gr.merge_nearest(state['dist'][affected], state['poi'][affected],
+                                             dist[0, affected][:, None],
+                                             np.full((len(affected), 1), new_poi),
+                                             state['num_pois'])
+    state['dist'][affected] = new_dist
+    state['poi'][affected] = new_poi_idx
+    return affected
+
+
+def removal_update(state, poi_id):
+    """
+    k-nearest entries for the nodes affected by removing a POI, without
+    changing the state.
+    Only nodes that had the POI in their table change. Any POI that can
+    replace it lies within twice the distance cap of the removed POI
+    (node -> removed POI plus node -> replacement), so only those
+    candidates are searched, and only their distances to affected nodes
+    are kept.
+
+    Returns:
+     affected: node positions that had the POI in their table
+     new_dist, new_poi: replacement (#affected, k) table rows
+    """
+
+    graph = state['graph']
+    removed = poi_index(state, poi_id)
+    affected = np.flatnonzero((state['poi'] == removed).any(axis=1))
+    num_pois = state['num_pois']
+
+    new_dist = np.full((len(affected), num_pois), np.inf)
+    new_poi = np.full((len(affected), num_pois), -1, dtype=np.int64)
+    if len(affected) == 0:
+        return affected, new_dist, new_poi
+
+    # Candidate replacements, found on the undirected graph
+    matrix = gr.graph_matrix(graph, state['imp'])
+    reach = csgraph.dijkstra(matrix, directed=False,
+                             indices=state['poi_positions'][removed],
+                             limit=2 * state['distance'])
+    candidates = np.flatnonzero(state['active'] &
+                                np.isfinite(reach[state['poi_positions']]))
+    candidates = candidates[candidates != removed]
+
+    for start, dist in gr.poi_distance_chunks(graph, state['poi_positions'][candidates],
+                                              state['imp'], state['distance']):
+        chunk = candidates[start:start + dist.shape[0]]
+        new_dist, new_poi = gr.merge_nearest(new_dist, new_poi,
+                                             dist[:, affected].T,
+                                             np.broadcast_to(chunk, (len(affected), len(chunk))),
+                                             num_pois)
+    return affected, new_dist, new_poi
+
+
+def remove_poi(state, poi_id):
+    """
+    Remove (close) a POI and update only the nodes that relied on it.
+
+    Args:
+     state: POI state from build_poi_state
+     poi_id: id of the POI to remove
+
+    Returns:
+     affected: node positions whose k-nearest entries changed
+    """
+
+    affected, new_dist, new_poi = removal_update(state, poi_id)
+    state['dist'][affected] = new_dist
+    state['poi'][affected] = new_poi
+    state['active'][poi_index(state, poi_id)] = False
+    return affected
+
+
+def closure_impact(state, poi_ids, rank=1):
+    """
+    Evaluate many single closure scenarios without changing the state.
+
+    Args:
+     state: POI state from build_poi_state
+     poi_ids: POIs to close, one scenario each
+     rank: nth nearest POI to compare
+
+    Returns:
+     impact: dataframe with one row per closed POI: affected nodes,
+             mean increase in accessibility over affected nodes and over
+             all nodes. Unreached nodes count at the distance cap.
+    """
+
+    distance = state['distance']
+    n_nodes = len(state['graph']['node_ids'])
+    rows = []
+    for poi_id in poi_ids:
+        affected, new_dist, _ = removal_update(state, poi_id)
+        before = np.minimum(state['dist'][affected, rank - 1], distance)
+        after = np.minimum(new_dist[:, rank - 1], distance)
+        increase = (after - before).sum()
+        rows.append({'poi_id': poi_id,
+                     'affected_nodes': len(affected),
+                     'mean_increase_affected': increase / len(affected) if len(affected) else 0.0,
+                     'mean_increase_all': increase / n_nodes})
+    return pd.DataFrame(rows)
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import inspect
+import contextlib
+import logging
+import resource
+import functools
+import threading
+import pandas as pd
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Active sinks. Stages are only measured while there is at least one
+INSTRUMENT_SINKS = []
+
+# Setting this to a file path records JSON lines events from import time,
+# e.g. for nightly runs
+INSTRUMENT_ENV = 'ACCESSIBILITY_INSTRUMENT'
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+RSS_TO_MB = 1e-6 if sys.platform == 'darwin' else 1.0 / 1024
+
+_ACTIVE = threading.local()
+
+
+###########
+## SINKS ##
+###########
+
+class MemorySink(object):
+    """Collect events in memory, e.g. for a notebook or a test run."""
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def frame(self):
+        return pd.DataFrame(self.events)
+
+
+class JsonLinesSink(object):
+    """Append one JSON line per event to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def __call__(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+
+class LogSink(object):
+    """Write one log line per event."""
+
+    def __init__(self, logger='accessibility', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def __call__(self, event):
+        sizes = ' '.join('{}={}'.format(key, event[key]) for key in SIZE_KEYS if key in event)
+        self.logger.log(self.level, '%s wall=%.3fs cpu=%.3fs rss=%.0fMB %s%s',
+                        event['stage'], event['wall_s'], event['cpu_s'],
+                        event['max_rss_mb'], sizes,
+                        ' cache={}/{}'.format(event['cache_hits'], event['cache_misses'])
+                        if event['cache_hits'] or event['cache_misses'] else '')
+
+
+def add_sink(sink):
+    INSTRUMENT_SINKS.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in INSTRUMENT_SINKS:
+        INSTRUMENT_SINKS.remove(sink)
+
+
+@contextlib.contextmanager
+def recording(*sinks):
+    """
+    Record stage events to the given sinks (a MemorySink by default)
+    within a with block, e.g.
+        with instrument.recording() as sink:
+            ...
+        sink.frame()
+    """
+    sinks = sinks or (MemorySink(),)
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield sinks[0] if len(sinks) == 1 else sinks
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+def emit(event):
+    for sink in list(INSTRUMENT_SINKS):
+        sink(event)
+
+
+#################
+## INPUT SIZES ##
+#################
+
+SIZE_KEYS = ['nodes', 'edges', 'pois', 'observations', 'rows']
+
+
+def object_sizes(name, value):
+    """
+    Input sizes of one argument: street networks (pandana, networkx or
+    array graphs) give nodes and edges, POI frames give pois, Stan data
+    and accessibility frames give observations.
+    """
+
+    if hasattr(value, 'nodes_df') and hasattr(value, 'edges_df'):
+        return {'nodes': len(value.nodes_df), 'edges': len(value.edges_df)}
+    if hasattr(value, 'number_of_nodes') and hasattr(value, 'number_of_edges'):
+        return {'nodes': value.number_of_nodes(), 'edges': value.number_of_edges()}
+    if isinstance(value, dict):
+        if 'indptr' in value and 'node_ids' in value:
+            return {'nodes': len(value['node_ids']), 'edges': len(value['indices'])}
+        if 'N' in value:
+            return {'observations': int(value['N'])}
+        return {}
+    if isinstance(value, pd.DataFrame):
+        if 'poi' in name:
+            return {'pois': len(value)}
+        if name.startswith('nodes'):
+            return {'nodes': len(value)}
+        if name.startswith('edges'):
+            return {'edges': len(value)}
+        if 'accessibility' in value.columns:
+            return {'observations': len(value)}
+        return {'rows': len(value)}
+    return {}
+
+
+def input_sizes(fn, args, kwargs):
+    try:
+        bound = inspect.signature(fn).bind_partial(*args, **kwargs)
+    except TypeError:
+        return {}
+    sizes = {}
+    for name, value in bound.arguments.items():
+        for key, size in object_sizes(name, value).items():
+            sizes.setdefault(key, size)
+    return sizes
+
+
+#################
+## STAGE TIMER ##
+#################
+
+def cache_event(hit):
+    """Record a cache hit or miss against the stage currently running."""
+    stack = getattr(_ACTIVE, 'stack', None)
+    if stack:
+        stack[-1]['cache_hits' if hit else 'cache_misses'] += 1
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_TO_MB
+
+
+def instrumented(fn=None, stage=None):
+    """
+    Decorator recording a stage event per call: wall and CPU time, peak
+    RSS, input sizes, cache hits and misses, nesting and any error.
+    With no sinks the call goes straight through.
+    """
+
+    if fn is None:
+        return functools.partial(instrumented, stage=stage)
+    stage = stage or '{}.{}'.format(fn.__module__.split('.')[-1], fn.__name__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not INSTRUMENT_SINKS:
+            return fn(*args, **kwargs)
+
+        stack = getattr(_ACTIVE, 'stack', None)
+        if stack is None:
+            stack = _ACTIVE.stack = []
+        event = {'event': 'stage',
+                 'stage': stage,
+                 'parent': stack[-1]['stage'] if stack else None,
+                 'depth': len(stack),
+                 'pid': os.getpid(),
+                 'start': time.time(),
+                 'cache_hits': 0,
+                 'cache_misses': 0}
+        event.update(input_sizes(fn, args, kwargs))
+        rss_before = max_rss_mb()
+        stack.append(event)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            event['error'] = repr(error)
+            raise
+        finally:
+            event['wall_s'] = time.perf_counter() - wall
+            event['cpu_s'] = time.process_time() - cpu
+            event['max_rss_mb'] = max_rss_mb()
+            event['rss_growth_mb'] = event['max_rss_mb'] - rss_before
+            stack.pop()
+            emit(event)
+
+    return wrapper
+
+
+def summarise_events(events):
+    """
+    Per-stage totals of recorded events.
+
+    Args:
+     events: list of events or a MemorySink
+
+    Returns:
+     summary: dataframe with calls, total and mean wall time, CPU time,
+              peak RSS and cache hits / misses per stage, slowest first
+    """
+
+    events_df = pd.DataFrame(getattr(events, 'events', events))
+    summary = (events_df
+               .groupby('stage')
+               .agg(calls=('wall_s', 'size'),
+                    wall_s=('wall_s', 'sum'),
+                    mean_wall_s=('wall_s', 'mean'),
+                    cpu_s=('cpu_s', 'sum'),
+                    max_rss_mb=('max_rss_mb', 'max'),
+                    cache_hits=('cache_hits', 'sum'),
+                    cache_misses=('cache_misses', 'sum'))
+               .sort_values('wall_s', ascending=False)
+               .reset_index())
+    return summary
+
+
+if os.environ.get(INSTRUMENT_ENV):
+    add_sink(JsonLinesSink(os.environ[INSTRUMENT_ENV]))
@@ -0,0 +1,40 @@
+import sys
+import types
+import importlib
+
+
+#################
+## LAZY IMPORT ##
+#################
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a heavy module (plotting, Stan, OSM download, GIS),
+    imported on first attribute access. Pure numeric callers never pay its
+    import time or memory, and a missing optional dependency only raises
+    when it is actually used.
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # Later lookups hit the copied attributes directly
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self.__name__)
+
+
+def lazy_import(name):
+    """
+    Module name, imported on first use, e.g.
+        plt = lazy.lazy_import('matplotlib.pyplot')
+    Returns the module itself if something already imported it.
+    """
+
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def is_loaded(name):
+    """Whether a module has really been imported (not just a lazy stand-in)"""
+    return name in sys.modules
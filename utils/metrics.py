@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import utils.graph as gr
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# (kernel, parameter) pairs: the threshold for cumulative and linear,
+# the decay rate for exponential and power, the spread for gaussian
+DEFAULT_METRICS = [('cumulative', 5), ('cumulative', 10), ('cumulative', 15),
+                   ('exponential', 0.1)]
+
+# Unbounded kernels are cut where they fall below this weight, which
+# sets the search limit when none is given
+KERNEL_TOLERANCE = 1e-3
+
+# Power decay is flat below this distance, so a POI on the node itself
+# doesn't get an infinite weight
+MIN_DECAY_DISTANCE = 1.0
+
+
+#############
+## KERNELS ##
+#############
+
+def decay(kind, param, dist):
+    """Weight of POIs at the given distances under one kernel"""
+    if kind == 'cumulative':
+        return (dist <= param).astype(np.float64)
+    if kind == 'linear':
+        return np.maximum(1 - dist / param, 0)
+    if kind == 'exponential':
+        return np.exp(-param * dist)
+    if kind == 'gaussian':
+        return np.exp(-dist**2 / (2 * param**2))
+    if kind == 'power':
+        return np.maximum(dist, MIN_DECAY_DISTANCE)**-param
+    raise ValueError('unknown kernel {}'.format(kind))
+
+
+def kernel_reach(kind, param, tolerance=KERNEL_TOLERANCE):
+    """Distance beyond which a kernel's weights are zero (or below tolerance)"""
+    if kind in ['cumulative', 'linear']:
+        return param
+    if kind == 'exponential':
+        return -np.log(tolerance) / param
+    if kind == 'gaussian':
+        return param * np.sqrt(-2 * np.log(tolerance))
+    if kind == 'power':
+        return max(tolerance**(-1.0 / param), MIN_DECAY_DISTANCE)
+    raise ValueError('unknown kernel {}'.format(kind))
+
+
+def metric_name(kind, param):
+    return '{}_{:g}'.format(kind, param)
+
+
+#############
+## WEIGHTS ##
+#############
+
+def poi_weights(pois_df, category=None, weights=()):
+    """
+    POI weight matrix: one column per (category, weight) pair, zero for
+    POIs outside the category. 'count' weights every POI by 1.
+
+    Returns:
+     matrix: (#POIs, #categories x #weights) array
+     columns: list of (category, weight) pairs
+    """
+
+    values = np.column_stack([np.ones(len(pois_df))] +
+                             [pois_df[w].fillna(0).values.astype(np.float64) for w in weights])
+    names = ['count'] + list(weights)
+    if category is None:
+        return values, [('all', name) for name in names]
+
+    codes, categories = pd.factorize(pois_df[category], sort=True)
+    member = codes[:, None] == np.arange(len(categories))
+    matrix = (member[:, :, None] * values[:, None, :]).reshape(len(pois_df), -1)
+    return matrix, [(c, name) for c in categories for name in names]
+
+
+#########################
+## OPPORTUNITY METRICS ##
+#########################
+
+def opportunity_metrics(graph, pois_df, imp, metrics=DEFAULT_METRICS, distance=None,
+                        category=None, weights=(), chunk_size=gr.POI_CHUNK_SIZE):
+    """
+    Cumulative opportunity and gravity accessibility over every POI each
+    node reaches, not just the k nearest. One bounded search per chunk of
+    POIs serves every kernel, threshold, category and weight: reached
+    (POI, node) pairs are kept sparse, weighted by each kernel, and summed
+    per node with a sparse product against the POI weight matrix. No
+    #nodes x #POIs matrix is built.
+
+    Args:
+     graph: array graph from graph.build_graph
+     pois_df: dataframe of POIs with lat and lon columns, plus any
+              category and weight columns
+     imp: impedance name, e.g. 'time_tobler'
+     metrics: list of (kernel, parameter) pairs. Kernels: 'cumulative'
+              (count within a threshold), 'linear' (1 - d / threshold),
+              'exponential' (exp(-beta d)), 'gaussian' (spread) and
+              'power' (d^-beta)
+     distance: search limit, in impedance units. Defaults to the reach of
+               the widest kernel (see kernel_reach)
+     category: POI column to split the metrics by, e.g. 'type'
+     weights: POI attribute columns to sum, e.g. ['area', 'equipment']
+     chunk_size: number of POIs searched together
+
+    Returns:
+     metrics_df: dataframe indexed by node id with (metric, category,
+                 weight) columns, e.g. ('cumulative_15', 'all', 'count')
+                 for the number of POIs within 15 minutes
+    """
+
+    if distance is None:
+        distance = max(kernel_reach(kind, param) for kind, param in metrics)
+    matrix, columns = poi_weights(pois_df, category, weights)
+    poi_positions = gr.get_node_positions(graph, pois_df['lon'].values, pois_df['lat'].values)
+
+    n_nodes = len(graph['node_ids'])
+    totals = np.zeros((len(metrics), n_nodes, matrix.shape[1]))
+    for start, dist in gr.poi_distance_chunks(graph, poi_positions, imp, distance, chunk_size):
+        poi, node = np.nonzero(np.isfinite(dist))
+        reached = dist[poi, node]
+        chunk_weights = matrix[start:start + dist.shape[0]]
+        for m, (kind, param) in enumerate(metrics):
+            kernel = sparse.csr_matrix((decay(kind, param, reached), (node, poi)),
+                                       shape=(n_nodes, dist.shape[0]))
+            totals[m] += kernel @ chunk_weights
+
+    index = pd.MultiIndex.from_tuples([(metric_name(kind, param),) + column
+                                       for kind, param in metrics for column in columns],
+                                      names=['metric', 'category', 'weight'])
+    return pd.DataFrame(np.concatenate(totals, axis=1),
+                        index=pd.Index(graph['node_ids'], name='id'),
+                        columns=index)
@@ -0,0 +1,205 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csgraph
+import utils.batch as batch
+import utils.cache as cache
+import utils.graph as gr
+import utils.instrument as instrument
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Sources searched together. Each search holds an OD_CHUNK_SIZE x #nodes
+# distance block in memory
+OD_CHUNK_SIZE = gr.POI_CHUNK_SIZE
+
+# Travel times are stored as float32: half the size of float64 and far
+# more precise than travel times need
+OD_DTYPE = np.float32
+
+# Search matrices built by each worker process, keyed on the graph
+# directory, impedance and direction
+_MATRICES = {}
+
+
+############
+## KEYING ##
+############
+
+def graph_fingerprint(graph, imp):
+    """Content hash of a graph's structure and one impedance"""
+    digest = hashlib.sha256()
+    for array in [graph['node_ids'], graph['indptr'], graph['indices'], graph['weights'][imp]]:
+        digest.update(np.ascontiguousarray(array).view(np.uint8))
+    digest.update(str(graph['twoway']).encode())
+    return digest.hexdigest()[:16]
+
+
+def endpoints_fingerprint(points_df):
+    """Content hash of an endpoint set: ids and coordinates, in order"""
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(points_df.index.to_series(), index=False).values)
+    digest.update(np.ascontiguousarray(points_df[['lon', 'lat']].values, dtype=np.float64))
+    return digest.hexdigest()[:16]
+
+
+##############
+## SEARCHES ##
+##############
+
+def search_matrix(graph_dir, imp, reverse):
+    key = (graph_dir, imp, reverse)
+    if key not in _MATRICES:
+        _MATRICES[key] = gr.graph_matrix(batch.worker_graph(graph_dir), imp, reverse=reverse)
+    return _MATRICES[key]
+
+
+def od_chunk(job):
+    """
+    Bounded searches from one chunk of sources, keeping the target columns.
+    Runs in a worker process on a memory-mapped graph, or in-process when
+    given the search matrix itself.
+    """
+
+    graph_or_dir, imp, reverse, start, sources, targets, distance = job
+    if isinstance(graph_or_dir, str):
+        matrix = search_matrix(graph_or_dir, imp, reverse)
+    else:
+        matrix = graph_or_dir
+    dist = csgraph.dijkstra(matrix, directed=True, indices=sources, limit=distance)
+    return start, np.atleast_2d(dist)[:, targets].astype(OD_DTYPE)
+
+
+@instrument.instrumented
+def od_matrix(graph, origins_df, destinations_df, imp, distance=np.inf,
+              chunk_size=OD_CHUNK_SIZE, processes=1, cache_dir=None):
+    """
+    Many-to-many shortest path travel times between two point sets, e.g.
+    meshblock centroids x playgrounds. Both sets are snapped to nodes once,
+    and bounded searches run from the distinct nodes of the smaller set
+    (on the reversed graph when those are the destinations), in chunks and
+    optionally in parallel.
+
+    Args:
+     graph: array graph (graph.build_graph, or graph.graph_from_pandana for
+            a network from accessibility_analysis), or the directory of a
+            saved graph (graph.save_graph). Parallel runs need a directory:
+            workers memory-map it
+     origins_df, destinations_df: dataframes with lat and lon columns. The
+                                  indexes label the matrix
+     imp: impedance name, e.g. 'time_5khr' or 'time_tobler'
+     distance: search limit, in impedance units. Pairs beyond it are inf
+     chunk_size: number of sources searched together
+     processes: worker processes
+     cache_dir: if given, matrices are cached there, keyed on the graph
+                content, impedance, endpoint sets and distance
+
+    Returns:
+     od_df: (#origins, #destinations) float32 dataframe of travel times
+    """
+
+    graph_dir = graph if isinstance(graph, str) else None
+    if graph_dir is not None:
+        graph = gr.load_graph(graph_dir, mmap=True)
+    elif processes > 1:
+        raise ValueError('processes > 1 needs a saved graph directory (graph.save_graph)')
+
+    if cache_dir is not None:
+        key = cache.cache_key(stage='od', graph=graph_fingerprint(graph, imp), imp=imp,
+                              origins=endpoints_fingerprint(origins_df),
+                              destinations=endpoints_fingerprint(destinations_df),
+                              distance=distance)
+        od_file = os.path.join(cache.entry_dir(key, cache_dir), 'od.npy')
+        instrument.cache_event(os.path.isfile(od_file))
+        if os.path.isfile(od_file):
+            cache.touch(key, cache_dir)
+            return pd.DataFrame(np.load(od_file), index=origins_df.index,
+                                columns=destinations_df.index)
+
+    origin_pos = gr.get_node_positions(graph, origins_df['lon'].values, origins_df['lat'].values)
+    dest_pos = gr.get_node_positions(graph, destinations_df['lon'].values,
+                                     destinations_df['lat'].values)
+
+    # Search from the smaller side. Distances are always origin -> destination
+    reverse = len(np.unique(dest_pos)) < len(np.unique(origin_pos))
+    source_pos, target_pos = (dest_pos, origin_pos) if reverse else (origin_pos, dest_pos)
+    sources, source_idx = np.unique(source_pos, return_inverse=True)
+
+    search = graph_dir if graph_dir is not None else gr.graph_matrix(graph, imp, reverse=reverse)
+    jobs = [(search, imp, reverse, start, sources[start:start + chunk_size], target_pos, distance)
+            for start in range(0, len(sources), chunk_size)]
+    blocks = np.empty((len(sources), len(target_pos)), dtype=OD_DTYPE)
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = pool.map(od_chunk, jobs)
+            for start, block in results:
+                blocks[start:start + len(block)] = block
+    else:
+        for job in jobs:
+            start, block = od_chunk(job)
+            blocks[start:start + len(block)] = block
+
+    od = blocks[source_idx]
+    od = od.T if reverse else od
+    od = np.ascontiguousarray(od)
+
+    if cache_dir is not None:
+        os.makedirs(os.path.dirname(od_file), exist_ok=True)
+        np.save(od_file, od)
+        cache.touch(key, cache_dir)
+        cache.evict(cache_dir, keep=[key])
+    return pd.DataFrame(od, index=origins_df.index, columns=destinations_df.index)
+
+
+############
+## ROUTES ##
+############
+
+def od_routes(graph, origins_df, destinations_df, imp, pairs=None, chunk_size=OD_CHUNK_SIZE):
+    """
+    Shortest path node sequences between origins and destinations, e.g.
+    for the presentation route maps. One search with predecessors per
+    chunk of distinct origin nodes serves all their destinations.
+
+    Args:
+     graph: array graph
+     origins_df, destinations_df: dataframes with lat and lon columns
+     imp: impedance name
+     pairs: list of (origin id, destination id). Defaults to all pairs
+     chunk_size: number of origins searched together
+
+    Returns:
+     routes: dict of (origin id, destination id) to the list of node ids
+             along the route, empty if unreachable
+    """
+
+    if pairs is None:
+        pairs = [(o, d) for o in origins_df.index for d in destinations_df.index]
+    pairs_df = pd.DataFrame(pairs, columns=['origin', 'destination'])
+    origins = origins_df.loc[pairs_df['origin']]
+    destinations = destinations_df.loc[pairs_df['destination']]
+    origin_pos = gr.get_node_positions(graph, origins['lon'].values, origins['lat'].values)
+    dest_pos = gr.get_node_positions(graph, destinations['lon'].values, destinations['lat'].values)
+
+    matrix = gr.graph_matrix(graph, imp)
+    node_ids = np.asarray(graph['node_ids'])
+    sources, source_idx = np.unique(origin_pos, return_inverse=True)
+    routes = {}
+    for start in range(0, len(sources), chunk_size):
+        chunk = sources[start:start + chunk_size]
+        _, predecessors = csgraph.dijkstra(matrix, directed=True, indices=chunk,
+                                           return_predecessors=True)
+        predecessors = np.atleast_2d(predecessors)
+        for i in np.flatnonzero((source_idx >= start) & (source_idx < start + len(chunk))):
+            row = predecessors[source_idx[i] - start]
+            path = [dest_pos[i]]
+            while path[-1] != origin_pos[i] and row[path[-1]] >= 0:
+                path.append(row[path[-1]])
+            reached = path[-1] == origin_pos[i]
+            routes[tuple(pairs[i])] = node_ids[path[::-1]].tolist() if reached else []
+    return routes
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import codecs
+import shutil
+import numpy as np
+import pandas as pd
+import utils.data_processing as dp
+import utils.lazy as lazy
+
+requests = lazy.lazy_import('requests')
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+OVERPASS_URL = 'http://overpass-api.de/api/interpreter'
+
+# Tile edge (degrees) and elements per written part
+OSM_TILE_SIZE = 0.05
+OSM_BATCH_SIZE = 20000
+
+
+###########
+## TILES ##
+###########
+
+def split_bbox(osm_bbox, tile_size=OSM_TILE_SIZE):
+    """
+    Split an OSM bounding box (S, W, N, E) into a grid of tiles no larger
+    than tile_size degrees on a side.
+
+    Returns:
+     tiles: list of (S, W, N, E) tiles
+    """
+
+    south, west, north, east = osm_bbox
+    n_rows = max(int(np.ceil((north - south) / tile_size)), 1)
+    n_cols = max(int(np.ceil((east - west) / tile_size)), 1)
+    lats = np.linspace(south, north, n_rows + 1)
+    lons = np.linspace(west, east, n_cols + 1)
+    return [(round(lats[i], 7), round(lons[j], 7), round(lats[i + 1], 7), round(lons[j + 1], 7))
+            for i in range(n_rows) for j in range(n_cols)]
+
+
+#######################
+## STREAMING PARSING ##
+#######################
+
+def iter_overpass_elements(byte_chunks):
+    """
+    Incrementally parse the 'elements' array of an Overpass JSON response.
+    Only the current partial element is buffered, never the whole response.
+
+    Args:
+     byte_chunks: iterable of response body bytes
+
+    Yields:
+     element: one OSM element dict at a time
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_elements = False
+    finished = False
+
+    for chunk in byte_chunks:
+        buffer += text_decoder.decode(chunk)
+        if finished:
+            continue
+
+        if not in_elements:
+            match = re.search(r'"elements"\s*:\s*\[', buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            in_elements = True
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                finished = True
+                break
+            try:
+                element, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                break
+            yield element
+        buffer = buffer[pos:]
+
+    # Overpass reports timeouts and memory errors in a remark after the data
+    remark = re.search(r'"remark"\s*:\s*"([^"]*)"', buffer)
+    if remark is not None:
+        raise RuntimeError('Overpass error: {}'.format(remark.group(1)))
+    if not finished:
+        raise ValueError('Truncated Overpass response')
+    return
+
+
+def flatten_element(element):
+    """
+    Flatten an OSM element the way get_osm_data does: tags become columns.
+    Way node lists are kept as a '[a, b, c]' string, as in the csv cache.
+    """
+
+    flat = {key: val for key, val in element.items() if key != 'tags'}
+    flat.update(element.get('tags', {}))
+    if 'nodes' in flat:
+        flat['nodes'] = '[' + ', '.join(str(n) for n in flat['nodes']) + ']'
+    return flat
+
+
+######################
+## COLUMNAR STORAGE ##
+######################
+
+def osm_store_dir(osm_bbox, data_dir='data'):
+    bbox_string = '_'.join([str(x) for x in osm_bbox])
+    return os.path.join(data_dir, 'osm_data_{}'.format(bbox_string))
+
+
+def write_part(elements, store_dir, part_name):
+    path = os.path.join(store_dir, part_name + '.parquet')
+    df = pd.DataFrame(elements)
+    df.columns = [str(col) for col in df.columns]
+    # Tag values are free text: keep them as strings across parts
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype(str).where(df[col].notnull(), None)
+    df.to_parquet(path, index=False)
+    return path
+
+
+def read_osm_store(store_dir, columns=None):
+    """
+    Read an ingested OSM store back into one dataframe, with the same
+    layout as get_osm_data.
+
+    Args:
+     store_dir: store directory from stream_osm_data
+     columns: optional subset of columns to read
+
+    Returns:
+     osm_df: dataframe of flattened OSM elements
+    """
+
+    parts = sorted(f for f in os.listdir(store_dir) if f.endswith('.parquet'))
+    frames = []
+    for part in parts:
+        df = pd.read_parquet(os.path.join(store_dir, part))
+        if columns is not None:
+            df = df[[col for col in columns if col in df.columns]]
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+###############
+## INGESTION ##
+###############
+
+def stream_osm_data(tags, objects, osm_bbox, entities=["amenity"],
+                    tile_size=OSM_TILE_SIZE, timeout=180,
+                    overpass_url=OVERPASS_URL, data_dir='data',
+                    batch_size=OSM_BATCH_SIZE, overwrite=False):
+    """
+    Streaming replacement for get_osm_data over large bounding boxes.
+     - The bbox is split into tiles, each queried separately
+     - Responses are parsed element by element as they arrive
+     - Flattened elements are written to Parquet parts in batches
+     - Elements shared by tiles (ways crossing tile edges and their
+    nodes) are written once
+    Finished tiles are recorded, so an interrupted ingest resumes where it
+    stopped and a finished one is read straight from disk.
+
+    Args:
+     tags: list of tags (e.g. 'fuel')
+     objects: list of objects (e.g. nodes, ways)
+     osm_bbox: OSM bounding box (S, W, N, E)
+     entities: list of entities (amenity by default)
+     tile_size: tile edge in degrees
+     timeout: Overpass server timeout per tile (seconds)
+     overpass_url: Overpass API endpoint, e.g. a local stand-in server
+     data_dir: directory for the store
+     batch_size: elements per Parquet part
+     overwrite: discard any existing store
+
+    Returns:
+     osm_df: dataframe of flattened OSM elements
+    """
+
+    store_dir = osm_store_dir(osm_bbox, data_dir)
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+    if overwrite and os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Tile numbers only mean the same tiles for the same bbox and tile size
+    query_spec = [list(tags), list(objects), list(entities)]
+    bbox = [float(x) for x in osm_bbox]
+    manifest = {'query': query_spec, 'bbox': bbox, 'tile_size': float(tile_size),
+                'tiles_done': []}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['query'] != query_spec:
+            raise ValueError('{} holds a different query. Use overwrite=True'.format(store_dir))
+        if manifest.get('bbox') != bbox or manifest.get('tile_size') != float(tile_size):
+            raise ValueError('{} was tiled with a different bbox or tile size. '
+                             'Use overwrite=True'.format(store_dir))
+
+    # Parts of tiles that did not finish are rewritten
+    for part in os.listdir(store_dir):
+        if part.startswith('tile') and int(part[4:9]) not in manifest['tiles_done']:
+            os.remove(os.path.join(store_dir, part))
+
+    # Elements already written by earlier tiles
+    seen = set()
+    if manifest['tiles_done']:
+        written = read_osm_store(store_dir, columns=['type', 'id'])
+        seen = set(zip(written['type'], written['id'].astype(np.int64)))
+
+    for tile_num, tile in enumerate(split_bbox(osm_bbox, tile_size)):
+        if tile_num in manifest['tiles_done']:
+            continue
+
+        query = dp.generate_overpass_query(tags, objects, tile, entities, timeout=timeout)
+        response = requests.get(overpass_url, params={'data': query},
+                                stream=True, timeout=timeout + 30)
+        response.raise_for_status()
+
+        batch = []
+        part_num = 0
+        for element in iter_overpass_elements(response.iter_content(chunk_size=65536)):
+            element_key = (element['type'], element['id'])
+            if element_key in seen:
+                continue
+            seen.add(element_key)
+            batch.append(flatten_element(element))
+            if len(batch) >= batch_size:
+                write_part(batch, store_dir, 'tile{:05d}_{:05d}'.format(tile_num, part_num))
+                batch = []
+                part_num += 1
+        if batch:
+            write_part(batch, store_dir, 'tile{:05d}_{:05d}'.format(tile_num, part_num))
+
+        manifest['tiles_done'].append(tile_num)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f)
+
+    return read_osm_store(store_dir)
@@ -0,0 +1,304 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+import utils.batch as batch
+import utils.graph as gr
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Tile edge (degrees) of the core regions
+PARTITION_TILE_SIZE = 0.1
+METRES_PER_DEGREE = 111320.0
+
+# Halos are widened a little beyond the bound, to cover the flat earth
+# approximation of arc lengths
+HALO_SAFETY = 1.05
+
+# Nodes / arcs read per pass over the memory-mapped arrays
+SCAN_CHUNK = 1000000
+
+
+##################
+## GRAPH BOUNDS ##
+##################
+
+def scan_chunks(n, chunk=SCAN_CHUNK):
+    for start in range(0, n, chunk):
+        yield start, min(start + chunk, n)
+
+
+def graph_bounds(graph):
+    """(S, W, N, E) of the graph nodes, read a chunk at a time"""
+    bounds = [np.inf, np.inf, -np.inf, -np.inf]
+    for start, end in scan_chunks(len(graph['x'])):
+        x = np.asarray(graph['x'][start:end])
+        y = np.asarray(graph['y'][start:end])
+        bounds = [min(bounds[0], y.min()), min(bounds[1], x.min()),
+                  max(bounds[2], y.max()), max(bounds[3], x.max())]
+    return bounds
+
+
+def metres_per_impedance(graph, imp):
+    """
+    Upper bound on the straight line metres covered per unit impedance
+    along any arc (e.g. the fastest walking speed in m/min). A path within
+    the distance cap can't end further than distance x this bound from
+    where it starts, which sizes the tile halos.
+    """
+
+    indptr = graph['indptr']
+    weights = graph['weights'][imp]
+    bound = 0.0
+    for start, end in scan_chunks(len(indptr) - 1):
+        from_pos = np.repeat(np.arange(start, end), np.diff(np.asarray(indptr[start:end + 1])))
+        arcs = slice(indptr[start], indptr[end])
+        to_pos = np.asarray(graph['indices'][arcs])
+        lat = np.radians(np.asarray(graph['y'])[from_pos])
+        dx = (np.asarray(graph['x'])[to_pos] - np.asarray(graph['x'])[from_pos]) * np.cos(lat)
+        dy = np.asarray(graph['y'])[to_pos] - np.asarray(graph['y'])[from_pos]
+        metres = np.hypot(dx, dy) * METRES_PER_DEGREE
+        if len(metres):
+            bound = max(bound, np.max(metres / np.asarray(weights[arcs], dtype=np.float64)))
+    return bound
+
+
+###########
+## TILES ##
+###########
+
+def tile_layout(bounds, tile_size=PARTITION_TILE_SIZE):
+    """
+    Grid of core tiles over the graph bounds.
+
+    Returns:
+     layout: dict of bounds, grid lines (lats, lons) and tile count
+    """
+
+    south, west, north, east = bounds
+    n_rows = max(int(np.ceil((north - south) / tile_size)), 1)
+    n_cols = max(int(np.ceil((east - west) / tile_size)), 1)
+    return {'bounds': list(bounds),
+            'lats': np.linspace(south, north, n_rows + 1),
+            'lons': np.linspace(west, east, n_cols + 1),
+            'n_rows': n_rows,
+            'n_cols': n_cols}
+
+
+def core_tile(layout, x, y):
+    """Core tile number of each point. Every node is in exactly one core."""
+    south, west, north, east = layout['bounds']
+    row = np.clip(((y - south) / (north - south or 1) * layout['n_rows']).astype(np.int64),
+                  0, layout['n_rows'] - 1)
+    col = np.clip(((x - west) / (east - west or 1) * layout['n_cols']).astype(np.int64),
+                  0, layout['n_cols'] - 1)
+    return row * layout['n_cols'] + col
+
+
+def halo_box(layout, tile, halo_m):
+    """(S, W, N, E) of a tile's core widened by the halo."""
+    row, col = divmod(tile, layout['n_cols'])
+    south, north = layout['lats'][row], layout['lats'][row + 1]
+    west, east = layout['lons'][col], layout['lons'][col + 1]
+    halo_lat = halo_m / METRES_PER_DEGREE
+    widest = np.cos(np.radians(min(max(abs(south), abs(north)) + halo_lat, 89.0)))
+    halo_lon = halo_m / (METRES_PER_DEGREE * widest)
+    return [south - halo_lat, west - halo_lon, north + halo_lat, east + halo_lon]
+
+
+def nodes_in_box(graph, box):
+    """Sorted positions of the nodes inside an (S, W, N, E) box"""
+    south, west, north, east = box
+    positions = []
+    for start, end in scan_chunks(len(graph['x'])):
+        x = np.asarray(graph['x'][start:end])
+        y = np.asarray(graph['y'][start:end])
+        inside = (y >= south) & (y <= north) & (x >= west) & (x <= east)
+        positions.append(np.flatnonzero(inside) + start)
+    return np.concatenate(positions)
+
+
+def subgraph(graph, positions, imp):
+    """
+    Array graph of the nodes at the given (sorted) positions and the arcs
+    between them, for one impedance. Only the selected CSR rows are read.
+    """
+
+    indptr = np.asarray(graph['indptr'])
+    starts = indptr[positions]
+    counts = indptr[positions + 1] - starts
+    arc_idx = (np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) +
+               np.arange(counts.sum()))
+    from_local = np.repeat(np.arange(len(positions)), counts)
+
+    to_global = np.asarray(graph['indices'][arc_idx])
+    to_local = np.minimum(np.searchsorted(positions, to_global), len(positions) - 1)
+    keep = positions[to_local] == to_global
+
+    indptr_sub = np.zeros(len(positions) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(from_local[keep], minlength=len(positions)), out=indptr_sub[1:])
+    return {'node_ids': np.asarray(graph['node_ids'][positions]),
+            'x': np.asarray(graph['x'][positions]),
+            'y': np.asarray(graph['y'][positions]),
+            'indptr': indptr_sub,
+            'indices': to_local[keep].astype(np.int32),
+            'weights': {imp: np.asarray(graph['weights'][imp][arc_idx[keep]], dtype=np.float64)},
+            'twoway': graph['twoway']}
+
+
+##########
+## POIS ##
+##########
+
+def snap_pois(graph, pois_df):
+    """
+    Nearest node of every POI over the whole graph, as
+    graph.get_node_positions, but building KD-trees a chunk of nodes at a
+    time instead of over all nodes.
+    """
+
+    n_nodes = len(graph['y'])
+    mean_lat = sum(np.asarray(graph['y'][start:end]).sum()
+                   for start, end in scan_chunks(n_nodes)) / n_nodes
+    x_scale = np.cos(np.radians(mean_lat))
+    points = np.column_stack([pois_df['lon'].values * x_scale, pois_df['lat'].values])
+
+    best = np.full(len(points), np.inf)
+    positions = np.zeros(len(points), dtype=np.int64)
+    for start, end in scan_chunks(n_nodes):
+        tree = cKDTree(np.column_stack([np.asarray(graph['x'][start:end]) * x_scale,
+                                        np.asarray(graph['y'][start:end])]))
+        dist, idx = tree.query(points)
+        closer = dist < best
+        best[closer] = dist[closer]
+        positions[closer] = idx[closer] + start
+    return positions
+
+
+##########################
+## PARTITIONED ANALYSIS ##
+##########################
+
+def tile_output(out_dir, tile):
+    return os.path.join(out_dir, 'tile{:06d}.h5'.format(tile))
+
+
+def tile_outputs(out_dir):
+    return sorted(f for f in os.listdir(out_dir) if f.startswith('tile') and f.endswith('.h5'))
+
+
+def pois_fingerprint(poi_positions):
+    """Content hash of the POI set as snapped to the graph, in any order"""
+    positions = np.sort(np.asarray(poi_positions, dtype=np.int64))
+    return hashlib.sha256(positions.view(np.uint8)).hexdigest()[:16]
+
+
+def run_tile(job):
+    """
+    Accessibility for one tile's core nodes, computed on the core plus
+    halo subgraph. Writes the core rows and returns a record.
+    """
+
+    graph_dir, layout, tile, halo_m, poi_positions, imp, distance, num_pois, out_dir = job
+    graph = batch.worker_graph(graph_dir)
+
+    positions = nodes_in_box(graph, halo_box(layout, tile, halo_m))
+    core = np.zeros(len(positions), dtype=bool)
+    if len(positions):
+        core = core_tile(layout, np.asarray(graph['x'][positions]),
+                         np.asarray(graph['y'][positions])) == tile
+
+    if core.any():
+        sub = subgraph(graph, positions, imp)
+        in_tile = np.isin(poi_positions, positions)
+        local_pois = np.searchsorted(positions, poi_positions[in_tile])
+        best_dist, _ = gr.nearest_pois(sub, local_pois, imp, distance, num_pois)
+        accessibility = gr.accessibility_frame(sub, best_dist, distance)[core]
+    else:
+        accessibility = pd.DataFrame(columns=np.arange(1, num_pois + 1), dtype=np.float64)
+    accessibility.columns = accessibility.columns.astype(str)
+    accessibility.to_hdf(tile_output(out_dir, tile), key='accessibility', mode='w')
+
+    return {'tile': tile, 'core_nodes': int(core.sum()), 'tile_nodes': len(positions)}
+
+
+def partitioned_accessibility(graph_dir, pois_df, imp, out_dir, distance=60, num_pois=10,
+                              tile_size=PARTITION_TILE_SIZE, halo_m=None,
+                              processes=None, overwrite=False):
+    """
+    Accessibility over a graph too large to search in memory at once.
+    The graph is split into core tiles, each searched with a halo wide
+    enough that every path within the distance cap from a core node stays
+    inside it, so the stitched core results are identical to a single run
+    on the whole graph. Workers memory-map the saved graph and only read
+    their tile's nodes and arcs, so memory is bounded by tile size.
+    Tiles with existing output are skipped unless overwrite is set. The
+    run's parameters and POI set are recorded in a manifest, and an
+    output directory holding a different run is refused.
+
+    Args:
+     graph_dir: graph saved with graph.save_graph
+     pois_df: dataframe of POIs with lat and lon columns
+     imp: impedance name
+     out_dir: output directory for per-tile results
+     distance: Limit of accessibility analysis.
+     num_pois: integer to calculate nth closest POIS
+     tile_size: core tile edge (degrees)
+     halo_m: halo width (m). Defaults to the distance cap times the
+             fastest speed on any arc of the graph
+     processes: worker count. Defaults to the number of CPUs
+     overwrite: discard any existing output and recompute every tile
+
+    Returns:
+     records: dataframe with one row per computed tile
+    """
+
+    graph = gr.load_graph(graph_dir, mmap=True)
+    if halo_m is None:
+        halo_m = distance * metres_per_impedance(graph, imp) * HALO_SAFETY
+    layout = tile_layout(graph_bounds(graph), tile_size)
+    poi_positions = snap_pois(graph, pois_df)
+
+    manifest_file = os.path.join(out_dir, 'partition.json')
+    os.makedirs(out_dir, exist_ok=True)
+    if overwrite:
+        for f in tile_outputs(out_dir) + ['partition.json']:
+            if os.path.isfile(os.path.join(out_dir, f)):
+                os.remove(os.path.join(out_dir, f))
+
+    run_spec = {'imp': imp, 'distance': float(distance), 'num_pois': int(num_pois),
+                'tile_size': float(tile_size), 'halo_m': float(halo_m),
+                'bounds': [float(b) for b in layout['bounds']],
+                'pois': pois_fingerprint(poi_positions)}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f) != run_spec:
+                raise ValueError('{} holds a different run. Use overwrite=True'.format(out_dir))
+    elif tile_outputs(out_dir):
+        raise ValueError('{} holds tiles of an unknown run. Use overwrite=True'.format(out_dir))
+    else:
+        with open(manifest_file, 'w') as f:
+            json.dump(run_spec, f)
+
+    tiles = [tile for tile in range(layout['n_rows'] * layout['n_cols'])
+             if not os.path.isfile(tile_output(out_dir, tile))]
+    jobs = ((graph_dir, layout, tile, halo_m, poi_positions, imp, distance, num_pois, out_dir)
+            for tile in tiles)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        records = list(pool.map(run_tile, jobs))
+    return pd.DataFrame(records, columns=['tile', 'core_nodes', 'tile_nodes'])
+
+
+def read_partitioned(out_dir):
+    """Stitch the per-tile core results into one accessibility dataframe."""
+    accessibility = pd.concat([pd.read_hdf(os.path.join(out_dir, f), 'accessibility')
+                               for f in tile_outputs(out_dir)])
+    accessibility.columns = accessibility.columns.astype(int)
+    return accessibility
@@ -0,0 +1,283 @@
+import json
+import time
+import asyncio
+import numpy as np
+from scipy.spatial import cKDTree
+import utils.graph as gr
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+METRES_PER_DEGREE = 111320.0
+
+# Points further than this from every node are outside the network and
+# get NaN times
+MAX_SNAP_M = 500.0
+
+QUERY_HOST = '127.0.0.1'
+QUERY_PORT = 8765
+
+# Largest accepted request body (bytes), about 100k points
+MAX_BODY_BYTES = 8 * 1024 * 1024
+
+
+###########
+## INDEX ##
+###########
+
+def query_index(nodes_df, accessibility, max_snap_m=MAX_SNAP_M):
+    """
+    In-memory index answering point accessibility queries without any
+    network search: a KD-tree over the node coordinates and one dense
+    (#nodes, k) float32 table per scenario, in node order.
+
+    Args:
+     nodes_df: node dataframe with x and y columns, indexed by node id
+     accessibility: tidy dataframe from
+                    accessibility_analysis.get_multi_accessibility
+                    (node_id, poi_rank and one column per scenario)
+     max_snap_m: snapping limit (m)
+
+    Returns:
+     index: dict of node ids, KD-tree, POI ranks and scenario tables
+    """
+
+    node_ids = nodes_df.index.values
+    ranks = np.sort(accessibility['poi_rank'].unique())
+    scenarios = [c for c in accessibility.columns if c not in ['node_id', 'poi_rank']]
+
+    row = nodes_df.index.get_indexer(accessibility['node_id'].values)
+    col = np.searchsorted(ranks, accessibility['poi_rank'].values)
+    found = row >= 0
+    tables = {}
+    for scenario in scenarios:
+        table = np.full((len(node_ids), len(ranks)), np.nan, dtype=np.float32)
+        table[row[found], col[found]] = accessibility[scenario].values[found]
+        tables[scenario] = table
+
+    return kdtree_index(node_ids, nodes_df['x'].values, nodes_df['y'].values,
+                        ranks, tables, max_snap_m)
+
+
+def graph_query_index(graph, pois_df, impedances, distance=60, num_pois=3,
+                      max_snap_m=MAX_SNAP_M):
+    """
+    Query index straight from an array graph, with the k nearest POI
+    tables computed once per impedance (see graph.nearest_pois).
+
+    Args:
+     graph: array graph from graph.build_graph or graph.load_graph
+     pois_df: dataframe of POIs with lat and lon columns
+     impedances: dict of scenario name to impedance name, e.g.
+                 accessibility_analysis.SCENARIO_IMPEDANCES
+     distance: Limit of accessibility analysis.
+     num_pois: integer to calculate nth closest POIS
+     max_snap_m: snapping limit (m)
+
+    Returns:
+     index: see query_index
+    """
+
+    poi_positions = gr.get_node_positions(graph, pois_df['lon'].values, pois_df['lat'].values)
+    tables = {}
+    for scenario, imp in impedances.items():
+        best_dist, _ = gr.nearest_pois(graph, poi_positions, imp, distance, num_pois)
+        tables[scenario] = gr.accessibility_frame(graph, best_dist, distance).values.astype(np.float32)
+    if 'flat' in tables:
+        tables['flat_total'] = tables['flat'] * 2
+    if 'there' in tables and 'back' in tables:
+        tables['round_trip'] = tables['there'] + tables['back']
+
+    return kdtree_index(np.asarray(graph['node_ids']), np.asarray(graph['x']),
+                        np.asarray(graph['y']), np.arange(1, num_pois + 1), tables, max_snap_m)
+
+
+def kdtree_index(node_ids, x, y, ranks, tables, max_snap_m=MAX_SNAP_M):
+    x_scale = np.cos(np.radians(np.mean(y))) if len(y) else 1.0
+    return {'node_ids': node_ids,
+            'x_scale': x_scale,
+            'kdtree': cKDTree(np.column_stack([x * x_scale, y])),
+            'ranks': np.asarray(ranks),
+            'tables': tables,
+            'max_snap_m': max_snap_m}
+
+
+#############
+## QUERIES ##
+#############
+
+def query_points(index, lat, lon, scenarios=None, ranks=None):
+    """
+    Accessibility of a batch of points: one KD-tree query snaps every
+    point to its nearest node, then the scenario tables are indexed.
+
+    Args:
+     index: index from query_index or graph_query_index
+     lat, lon: arrays of point coordinates
+     scenarios: scenario names (default: all)
+     ranks: POI ranks, e.g. [1, 2, 3] (default: all)
+
+    Returns:
+     result: dict of node_id, snap_m (distance to the node) and one
+             (#points, #ranks) array per scenario, NaN for points beyond
+             the snapping limit
+    """
+
+    points = np.column_stack([np.asarray(lon, dtype=np.float64) * index['x_scale'],
+                              np.asarray(lat, dtype=np.float64)])
+    dist, positions = index['kdtree'].query(points)
+    snap_m = dist * METRES_PER_DEGREE
+    outside = snap_m > index['max_snap_m']
+
+    if ranks is not None:
+        unknown = np.setdiff1d(np.asarray(ranks).ravel(), index['ranks'])
+        if len(unknown):
+            raise ValueError('unknown ranks: {} (index has {})'.format(
+                unknown.tolist(), index['ranks'].tolist()))
+    cols = slice(None) if ranks is None else np.searchsorted(index['ranks'], ranks)
+    result = {'node_id': index['node_ids'][positions],
+              'snap_m': snap_m}
+    for scenario in scenarios or index['tables']:
+        times = index['tables'][scenario][positions][:, cols]
+        times[outside] = np.nan
+        result[scenario] = times
+    return result
+
+
+def query_latency(index, n_points=1000, repeats=200, seed=0):
+    """
+    Latency of batched queries on random points over the node extent.
+
+    Returns:
+     latency: dict of p50, p99 and max batch latency (ms)
+    """
+
+    rng = np.random.RandomState(seed)
+    data = index['kdtree'].data
+    lo, hi = data.min(axis=0), data.max(axis=0)
+    times = []
+    for _ in range(repeats):
+        points = rng.uniform(lo, hi, size=(n_points, 2))
+        start = time.perf_counter()
+        query_points(index, points[:, 1], points[:, 0] / index['x_scale'])
+        times.append((time.perf_counter() - start) * 1000)
+    return {'points': n_points,
+            'p50_ms': float(np.percentile(times, 50)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'max_ms': float(np.max(times))}
+
+
+##################
+## HTTP SERVICE ##
+##################
+
+def query_response(index, request):
+    """
+    JSON query body to a JSON-ready response. The body has lat and lon
+    lists (or points as [lat, lon] pairs) and optional scenarios and
+    ranks lists.
+    """
+
+    if 'points' in request:
+        points = np.asarray(request['points'], dtype=np.float64).reshape(-1, 2)
+        lat, lon = points[:, 0], points[:, 1]
+    else:
+        lat, lon = request['lat'], request['lon']
+    scenarios = request.get('scenarios')
+    unknown = set(scenarios or []) - set(index['tables'])
+    if unknown:
+        raise ValueError('unknown scenarios: {}'.format(sorted(unknown)))
+
+    ranks = request.get('ranks')
+    result = query_points(index, lat, lon, scenarios, ranks)
+    response = {'ranks': [int(r) for r in (index['ranks'] if ranks is None else ranks)],
+                'node_id': result.pop('node_id').tolist(),
+                'snap_m': np.round(result.pop('snap_m'), 1).tolist()}
+    for scenario, times in result.items():
+        # NaN is not valid JSON: only the rows holding one are patched
+        missing = np.flatnonzero(np.isnan(times).any(axis=1))
+        times = np.round(times.astype(np.float64), 2).tolist()
+        for i in missing:
+            times[i] = [None if t != t else t for t in times[i]]
+        response[scenario] = times
+    return response
+
+
+async def handle_connection(index, reader, writer):
+    """
+    Minimal HTTP/1.1 handler with keep-alive:
+     GET /health            -> node count and scenarios
+     POST /accessibility    -> query_response of the JSON body
+    """
+
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path = request_line.decode('latin-1').split()[:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY_BYTES:
+                status, payload = '413 Payload Too Large', {'error': 'body too large'}
+                headers['connection'] = 'close'
+            else:
+                body = await reader.readexactly(length) if length else b''
+                status, payload = route(index, method, path, body)
+
+            data = json.dumps(payload).encode()
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\nConnection: {}\r\n\r\n'
+                         .format(status, len(data), 'keep-alive' if keep_alive else 'close')
+                         .encode() + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def route(index, method, path, body):
+    if method == 'GET' and path == '/health':
+        return '200 OK', {'nodes': len(index['node_ids']),
+                          'scenarios': list(index['tables']),
+                          'ranks': index['ranks'].tolist()}
+    if method == 'POST' and path == '/accessibility':
+        try:
+            return '200 OK', query_response(index, json.loads(body))
+        except (ValueError, KeyError, TypeError) as error:
+            return '400 Bad Request', {'error': str(error)}
+    return '404 Not Found', {'error': 'unknown route {} {}'.format(method, path)}
+
+
+async def start_server(index, host=QUERY_HOST, port=QUERY_PORT):
+    """Start the query service on the running event loop."""
+    return await asyncio.start_server(
+        lambda reader, writer: handle_connection(index, reader, writer), host, port)
+
+
+def serve(index, host=QUERY_HOST, port=QUERY_PORT):
+    """
+    Serve point accessibility queries until interrupted, e.g.
+        curl -d '{"points": [[-41.29, 174.78]], "ranks": [1, 2, 3]}' \\
+             localhost:8765/accessibility
+    """
+
+    async def run():
+        server = await start_server(index, host, port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
@@ -0,0 +1,242 @@
+import os
+import json
+import numpy as np
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+NODE_CRS = 'epsg:4326'
+RASTER_CRS = 'epsg:2193'
+
+# Finest cell edge (m) and pixels per pre-rendered tile edge
+RASTER_CELL_SIZE = 25.0
+RASTER_TILE_SIZE = 256
+
+# GDAL overview resampling closest to each reducer, for GeoTIFF output
+OVERVIEW_RESAMPLING = {'mean': 'AVERAGE', 'min': 'MIN', 'max': 'MAX',
+                       'median': 'MED', 'count': 'SUM'}
+
+
+##########
+## GRID ##
+##########
+
+def project_nodes(x, y, from_crs=NODE_CRS, to_crs=RASTER_CRS):
+    """Node lon / lat to projected metres (NZTM2000 by default)."""
+    from pyproj import Transformer
+    transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return transformer.transform(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+
+def raster_grid(x, y, cell_size=RASTER_CELL_SIZE, snap=None):
+    """
+    Regular grid covering projected points.
+    The origin is snapped to a multiple of snap (default: the cell size)
+    so grids of the same area line up between runs.
+
+    Returns:
+     grid: dict of west, north, cell_size, width, height and an affine
+           transform (cell, 0, west, 0, -cell, north)
+    """
+
+    snap = snap or cell_size
+    west = np.floor(np.min(x) / snap) * snap
+    north = np.ceil(np.max(y) / snap) * snap
+    width = int(np.floor((np.max(x) - west) / cell_size)) + 1
+    height = int(np.floor((north - np.min(y)) / cell_size)) + 1
+    return {'west': float(west),
+            'north': float(north),
+            'cell_size': float(cell_size),
+            'width': width,
+            'height': height,
+            'transform': [float(cell_size), 0.0, float(west), 0.0, -float(cell_size), float(north)]}
+
+
+def coarser_grid(grid, factor=2):
+    """Grid with cells factor times larger, sharing the same origin"""
+    cell_size = grid['cell_size'] * factor
+    return {'west': grid['west'],
+            'north': grid['north'],
+            'cell_size': cell_size,
+            'width': int(np.ceil(grid['width'] / factor)),
+            'height': int(np.ceil(grid['height'] / factor)),
+            'transform': [cell_size, 0.0, grid['west'], 0.0, -cell_size, grid['north']]}
+
+
+#################
+## RASTERIZING ##
+#################
+
+def rasterize(x, y, values, grid, reducer='mean'):
+    """
+    Bin point values onto a grid in one vectorized pass.
+
+    Args:
+     x, y: projected point coordinates
+     values: point values (e.g. node accessibility). NaNs are ignored
+     grid: grid from raster_grid
+     reducer: 'mean', 'min', 'max', 'count', 'median' or a quantile as
+              'q' + percent, e.g. 'q90'
+
+    Returns:
+     raster: (height, width) float32 array, NaN in cells with no points
+             (0 for count)
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    col = np.floor((np.asarray(x) - grid['west']) / grid['cell_size']).astype(np.int64)
+    row = np.floor((grid['north'] - np.asarray(y)) / grid['cell_size']).astype(np.int64)
+    keep = ((col >= 0) & (col < grid['width']) & (row >= 0) & (row < grid['height']) &
+            ~np.isnan(values))
+    cells = row[keep] * grid['width'] + col[keep]
+    values = values[keep]
+    n_cells = grid['width'] * grid['height']
+
+    count = np.bincount(cells, minlength=n_cells)
+    if reducer == 'count':
+        return count.reshape(grid['height'], grid['width']).astype(np.float32)
+
+    out = np.full(n_cells, np.nan)
+    if reducer == 'mean':
+        filled = count > 0
+        out[filled] = np.bincount(cells, weights=values, minlength=n_cells)[filled] / count[filled]
+    elif reducer in ['min', 'max']:
+        order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[order]
+        starts = np.flatnonzero(np.diff(sorted_cells, prepend=-1))
+        ufunc = np.minimum if reducer == 'min' else np.maximum
+        if len(starts):
+            out[sorted_cells[starts]] = ufunc.reduceat(values[order], starts)
+    else:
+        q = 0.5 if reducer == 'median' else float(reducer[1:]) / 100
+        order = np.lexsort((values, cells))
+        sorted_values = values[order]
+        filled = np.flatnonzero(count)
+        starts = np.concatenate([[0], np.cumsum(count)[:-1]])[filled]
+        position = starts + q * (count[filled] - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        frac = position - lower
+        out[filled] = sorted_values[lower] * (1 - frac) + sorted_values[upper] * frac
+
+    return out.reshape(grid['height'], grid['width']).astype(np.float32)
+
+
+def accessibility_pyramid(x, y, values, cell_size=RASTER_CELL_SIZE, levels=6,
+                          reducer='mean', from_crs=NODE_CRS, to_crs=RASTER_CRS):
+    """
+    Multi-resolution accessibility surfaces. Every level is binned from
+    the node values themselves (not from the level below), so quantile
+    and mean reducers stay exact at every resolution.
+
+    Args:
+     x, y: node lon / lat (e.g. network.nodes_df x and y)
+     values: accessibility per node, aligned with x and y
+     cell_size: finest cell edge (m)
+     levels: number of levels. Each level doubles the cell size
+     reducer: see rasterize
+     from_crs, to_crs: node and raster CRS
+
+    Returns:
+     pyramid: list of (raster, grid), finest first
+    """
+
+    px, py = project_nodes(x, y, from_crs, to_crs)
+    grid = raster_grid(px, py, cell_size, snap=cell_size * 2**(levels - 1))
+    pyramid = []
+    for level in range(levels):
+        pyramid.append((rasterize(px, py, values, grid, reducer), grid))
+        grid = coarser_grid(grid)
+    return pyramid
+
+
+############
+## OUTPUT ##
+############
+
+def write_geotiff(pyramid, path, crs=RASTER_CRS, reducer='mean'):
+    """
+    Write the finest level as a Cloud-Optimized GeoTIFF (needs rasterio
+    with GDAL >= 3.1). Overviews are built by GDAL with the resampling
+    closest to the reducer.
+    """
+
+    import rasterio
+    from rasterio.transform import Affine
+
+    raster, grid = pyramid[0]
+    profile = {'driver': 'COG',
+               'width': grid['width'],
+               'height': grid['height'],
+               'count': 1,
+               'dtype': 'float32',
+               'nodata': np.nan,
+               'crs': crs,
+               'transform': Affine(*grid['transform']),
+               'blocksize': RASTER_TILE_SIZE,
+               'overview_count': len(pyramid) - 1,
+               'overview_resampling': OVERVIEW_RESAMPLING.get(reducer, 'AVERAGE'),
+               'compress': 'deflate'}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(raster, 1)
+    return path
+
+
+def colourize(raster, cmap='viridis_r', vmin=0, vmax=60):
+    """RGBA uint8 image of a raster, transparent where there is no data"""
+    import matplotlib
+    colourmap = matplotlib.colormaps[cmap]
+    scaled = (raster - vmin) / float(vmax - vmin)
+    rgba = colourmap(np.clip(np.nan_to_num(scaled), 0, 1), bytes=True)
+    rgba[np.isnan(raster), 3] = 0
+    return rgba
+
+
+def write_png_tiles(pyramid, out_dir, cmap='viridis_r', vmin=0, vmax=60,
+                    tile_size=RASTER_TILE_SIZE, crs=RASTER_CRS):
+    """
+    Pre-render a pyramid as PNG tiles: out_dir/{z}/{col}/{row}.png, with
+    z = 0 the coarsest level and tiles counted from the shared grid
+    origin (top left). Empty tiles are not written. A tiles.json file
+    describes the tile matrix (CRS, origin, cell size per zoom, colour
+    scale) for the web map.
+
+    Returns:
+     tiles: number of tiles written
+    """
+
+    from PIL import Image
+
+    levels = []
+    tiles = 0
+    for z, (raster, grid) in enumerate(reversed(pyramid)):
+        rgba = colourize(raster, cmap, vmin, vmax)
+        n_rows = int(np.ceil(grid['height'] / tile_size))
+        n_cols = int(np.ceil(grid['width'] / tile_size))
+        for row in range(n_rows):
+            for col in range(n_cols):
+                window = rgba[row * tile_size:(row + 1) * tile_size,
+                              col * tile_size:(col + 1) * tile_size]
+                if not window[..., 3].any():
+                    continue
+                tile = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+                tile[:window.shape[0], :window.shape[1]] = window
+                tile_dir = os.path.join(out_dir, str(z), str(col))
+                os.makedirs(tile_dir, exist_ok=True)
+                Image.fromarray(tile, 'RGBA').save(os.path.join(tile_dir, '{}.png'.format(row)))
+                tiles += 1
+        levels.append({'z': z, 'cell_size': grid['cell_size'],
+                       'matrix_width': n_cols, 'matrix_height': n_rows})
+
+    with open(os.path.join(out_dir, 'tiles.json'), 'w') as f:
+        json.dump({'crs': crs,
+                   'origin': [pyramid[0][1]['west'], pyramid[0][1]['north']],
+                   'tile_size': tile_size,
+                   'levels': levels,
+                   'cmap': cmap,
+                   'vmin': vmin,
+                   'vmax': vmax}, f, indent=1)
+    return tiles
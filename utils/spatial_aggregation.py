@@ -0,0 +1,180 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+NODE_CRS = 'epsg:4167'
+UNASSIGNED = -1
+
+
+############################
+## NODE REGION ASSIGNMENT ##
+############################
+
+def assign_nodes_to_regions(nodes_df, layers, crs=NODE_CRS):
+    """
+    Assign every node to a region at every hierarchy level in one pass per
+    level. Each polygon layer is queried through its STR-tree spatial
+    index with all node points at once, instead of a geopandas.sjoin on a
+    GeoDataFrame of points per analysis.
+
+    Args:
+     nodes_df: node dataframe with x (lon) and y (lat), indexed by node id
+     layers: dict of level name to (GeoDataFrame, name column), e.g.
+             {'suburb': (wcc_suburbs, 'suburb'),
+              'meshblock': (wlg_meshblock, 'MB2019_V1_00')}
+     crs: CRS of the node coordinates
+
+    Returns:
+     mapping: dataframe indexed by node id with one integer region code
+              column per level (-1 outside every region)
+     levels: dict of level name to array of region names, indexed by code
+    """
+
+    points = geopandas.GeoSeries(geopandas.points_from_xy(nodes_df['x'], nodes_df['y']),
+                                 crs=crs)
+    mapping = pd.DataFrame(index=nodes_df.index.copy())
+    levels = {}
+
+    for level, (layer, name_col) in layers.items():
+        layer = layer.to_crs(crs) if layer.crs is not None else layer
+        names, codes = np.unique(layer[name_col].astype(str).values, return_inverse=True)
+
+        # Bulk tree query of all points (query_bulk before geopandas 0.12)
+        query = getattr(layer.sindex, 'query_bulk', layer.sindex.query)
+        point_idx, poly_idx = query(points, predicate='within')
+
+        # Points exactly on a boundary aren't within any polygon there and
+        # stay unassigned. Points in overlapping polygons keep the one that
+        # comes first in the layer
+        order = np.lexsort((poly_idx, point_idx))
+        point_idx, poly_idx = point_idx[order], poly_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        node_codes = np.full(len(points), UNASSIGNED, dtype=np.int32)
+        node_codes[point_idx[first]] = codes.ravel()[poly_idx[first]]
+
+        mapping[level] = node_codes
+        levels[level] = names
+
+    return mapping, levels
+
+
+def layer_fingerprint(layer, name_col):
+    """Content hash of a polygon layer: CRS, geometries and region names, in order"""
+    digest = hashlib.sha256(str(layer.crs).encode())
+    for geom in layer.geometry.values:
+        digest.update(geom.wkb if geom is not None else b'')
+    digest.update(pd.util.hash_pandas_object(layer[name_col].astype(str), index=False).values)
+    return digest.hexdigest()[:16]
+
+
+def save_region_mapping(mapping, levels, mapping_file, fingerprints=None):
+    """Persist a node -> region mapping, its level names and layer hashes to HDF5."""
+    os.makedirs(os.path.dirname(mapping_file) or '.', exist_ok=True)
+    mapping.to_hdf(mapping_file, key='mapping', mode='w')
+    for level, names in levels.items():
+        pd.Series(names).to_hdf(mapping_file, key='levels/' + level, mode='a')
+    if fingerprints is not None:
+        pd.Series(fingerprints).to_hdf(mapping_file, key='fingerprints', mode='a')
+    return mapping_file
+
+
+def load_region_mapping(mapping_file):
+    """Load a mapping saved by save_region_mapping."""
+    mapping = pd.read_hdf(mapping_file, 'mapping')
+    levels = {level: pd.read_hdf(mapping_file, 'levels/' + level).values
+              for level in mapping.columns}
+    return mapping, levels
+
+
+def load_fingerprints(mapping_file):
+    """Layer hashes saved with a mapping, or None for files saved without them."""
+    with pd.HDFStore(mapping_file, mode='r') as store:
+        if '/fingerprints' not in store.keys():
+            return None
+        return store['fingerprints'].to_dict()
+
+
+def get_region_mapping(nodes_df, layers, mapping_file, crs=NODE_CRS):
+    """
+    Load the node -> region mapping from disk, building and saving it if
+    it is missing or was built for a different node set, levels or layer
+    contents (see layer_fingerprint).
+    """
+
+    fingerprints = {level: layer_fingerprint(layer, name_col)
+                    for level, (layer, name_col) in layers.items()}
+    if os.path.isfile(mapping_file):
+        mapping, levels = load_region_mapping(mapping_file)
+        if (mapping.index.equals(nodes_df.index) and
+                load_fingerprints(mapping_file) == fingerprints):
+            return mapping, levels
+
+    mapping, levels = assign_nodes_to_regions(nodes_df, layers, crs)
+    save_region_mapping(mapping, levels, mapping_file, fingerprints)
+    return mapping, levels
+
+
+######################
+## REGION SUMMARIES ##
+######################
+
+def summarise_by_region(accessibility, mapping, levels, level,
+                        quantiles=(0.25, 0.5, 0.75), thresholds=(15,)):
+    """
+    Per-region accessibility statistics from the cached integer mapping.
+    A groupby on region codes, with no spatial join.
+
+    Args:
+     accessibility: series of accessibility values indexed by node id
+     mapping, levels: node -> region mapping (see get_region_mapping)
+     level: hierarchy level to summarise (a mapping column)
+     quantiles: quantiles to report
+     thresholds: report the share of nodes with accessibility over each
+
+    Returns:
+     summary: dataframe with one row per region: nodes, mean, std,
+              quantiles (q25 ...) and shares over thresholds (over_15 ...)
+    """
+
+    codes = mapping[level].reindex(accessibility.index).fillna(UNASSIGNED).astype(np.int64).values
+    values = accessibility.values.astype(np.float64)
+    keep = (codes != UNASSIGNED) & ~np.isnan(values)
+    codes = codes[keep]
+    values = values[keep]
+    n_regions = len(levels[level])
+
+    count = np.bincount(codes, minlength=n_regions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=values, minlength=n_regions) / count
+        mean_sq = np.bincount(codes, weights=values**2, minlength=n_regions) / count
+        summary = pd.DataFrame({level: levels[level],
+                                'nodes': count,
+                                'mean': mean,
+                                'std': np.sqrt(np.maximum(mean_sq - mean**2, 0))})
+        for threshold in thresholds:
+            over = np.bincount(codes, weights=(values > threshold), minlength=n_regions)
+            summary['over_{}'.format(threshold)] = over / count
+
+    # Quantiles from one sort by (region, value)
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    for q in quantiles:
+        position = starts + q * np.maximum(count - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        has_nodes = count > 0
+        quantile = np.full(n_regions, np.nan)
+        frac = position - lower
+        quantile[has_nodes] = (sorted_values[lower[has_nodes]] * (1 - frac[has_nodes]) +
+                               sorted_values[upper[has_nodes]] * frac[has_nodes])
+        summary['q{:g}'.format(q * 100)] = quantile
+
+    return summary[summary['nodes'] > 0].reset_index(drop=True)
@@ -1,11 +1,19 @@
+import time
 import pickle
-import pystan
+import hashlib
 import os
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 import utils.data_processing as dp
-import matplotlib.pyplot as plt
+import utils.instrument as instrument
+import utils.lazy as lazy
 import numpy as np
-import seaborn as sns
+
+pystan = lazy.lazy_import('pystan')
+plt = lazy.lazy_import('matplotlib.pyplot')
+sns = lazy.lazy_import('seaborn')
+optimize = lazy.lazy_import('scipy.optimize')
+special = lazy.lazy_import('scipy.special')
 
 def save(obj, filename):
     """Save compiled models for reuse."""
@@ -18,15 +26,21 @@ def load(filename):
     return pickle.load(open(filename, 'rb'))
 
 
+@instrument.instrumented
 def load_or_generate_stan_model(model_folder,
                                 model='univariate_normal'):
     """
     Loads saved Stan Model or compiles and saves Stan Model
+    Compiled models are keyed by a hash of the Stan source, so editing
+    the .stan file triggers a recompile instead of loading a stale model.
     """
-    pkl_file = model_folder + '/' + model + '.pkl'
     stan_file = model_folder + '/' + model + '.stan'
+    with open(stan_file, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+    pkl_file = model_folder + '/' + model + '_' + source_hash + '.pkl'
 
     print(pkl_file)
+    instrument.cache_event(os.path.isfile(pkl_file))
     if os.path.isfile(pkl_file):
         sm = pickle.load(open(pkl_file, 'rb'))
     else:
@@ -48,6 +62,357 @@ def convert_categorical_to_ID(df, level):
     return df
 
 
+#####################
+## INFERENCE MODES ##
+#####################
+
+# nuts: full sampling, advi: variational, map: posterior mode,
+# closed_form: per-level truncated normal MLE without Stan
+INFERENCE_MODES = ['nuts', 'advi', 'map', 'closed_form']
+SUMMARY_QUANTILES = [2.5, 25, 50, 75, 97.5]
+
+
+class ApproxFit(object):
+    """
+    Draws (or a single point estimate) from a fast inference mode,
+    exposing the parts of the StanFit interface used here: summary() for
+    summarise_variable / df_for_forestplot and fit['param'].
+    """
+
+    def __init__(self, params, inference):
+        # params: dict of parameter name to array of shape (draws,) + dims
+        self.params = params
+        self.inference = inference
+
+    def __getitem__(self, name):
+        return self.params[name]
+
+    def summary(self, pars):
+        rownames = []
+        rows = []
+        for par in pars:
+            draws = np.asarray(self.params[par], dtype=np.float64)
+            draws = draws.reshape(len(draws), -1, order='F')
+            dims = self.params[par].shape[1:]
+            for j, flat in enumerate(flat_param_names(par, dims)):
+                values = draws[:, j]
+                sd = values.std(ddof=1) if len(values) > 1 else np.nan
+                rownames.append(flat)
+                rows.append([values.mean(), np.nan, sd] +
+                            list(np.percentile(values, SUMMARY_QUANTILES)) +
+                            [np.nan, np.nan])
+        return {'summary': np.array(rows), 'summary_rownames': np.array(rownames)}
+
+
+def flat_param_names(name, dims):
+    """Stan style names, e.g. mu_l[1], in Stan's column-major order"""
+    if len(dims) == 0:
+        return [name]
+    return ['{}[{}]'.format(name, ','.join(str(i + 1) for i in idx[::-1]))
+            for idx in np.ndindex(*dims[::-1])]
+
+
+def vb_fit(model, data, seed=344, output_samples=1000, **kwargs):
+    """ADVI draws from pystan's vb output, as an ApproxFit"""
+    vb_results = model.vb(data=data, seed=seed, output_samples=output_samples, **kwargs)
+    draws = {}
+    for flat, values in zip(vb_results['sampler_param_names'], vb_results['sampler_params']):
+        # Vector elements come back as mu_l.1 or mu_l[1]
+        name = flat.split('[')[0].split('.')[0]
+        draws.setdefault(name, []).append(np.asarray(values))
+    return ApproxFit({name: np.column_stack(values) if len(values) > 1 else values[0]
+                      for name, values in draws.items()},
+                     'advi')
+
+
+def map_fit(model, data, seed=344, **kwargs):
+    """Posterior mode from pystan's optimizing, as a one draw ApproxFit"""
+    mode = model.optimizing(data=data, seed=seed, **kwargs)
+    return ApproxFit({name: np.asarray(value)[None] for name, value in mode.items()}, 'map')
+
+
+def truncated_normal_mle(n, ybar, ss, lower, mu_bounds=(0, 60), sigma_bounds=(1e-3, 30)):
+    """
+    Maximum likelihood mu and sigma of a lower truncated normal from
+    sufficient statistics (count, mean, sum of squared deviations).
+    Starts from the untruncated closed form (sample mean and sd).
+    """
+
+    def negative_log_likelihood(theta):
+        mu, sigma = theta
+        return (n * np.log(sigma) + (ss + n * (ybar - mu)**2) / (2 * sigma**2) +
+                n * special.log_ndtr((mu - lower) / sigma))
+
+    start = [np.clip(ybar, *mu_bounds), np.clip(np.sqrt(ss / max(n, 1)), *sigma_bounds)]
+    result = optimize.minimize(negative_log_likelihood, start, method='L-BFGS-B',
+                               bounds=[mu_bounds, sigma_bounds])
+    return result.x
+
+
+def closed_form_fit(data):
+    """
+    Per-level truncated normal MLE from any Stan data layout used here
+    (suburb_data or hierarchical_data), as a one draw ApproxFit.
+    Levels are estimated independently: there is no partial pooling.
+    """
+
+    if 'l' not in data:
+        # Single suburb model: mu and sigma, lower bound L
+        y = np.asarray(data['y'], dtype=np.float64)
+        mu, sigma = truncated_normal_mle(len(y), y.mean(), ((y - y.mean())**2).sum(),
+                                         data['L'], sigma_bounds=(1e-3, 20))
+        return ApproxFit({'mu': np.array([mu]), 'sigma': np.array([sigma])}, 'closed_form')
+
+    if 'ybar_l' in data:
+        n, ybar, ss = data['n_l'], data['ybar_l'], data['ss_l']
+    else:
+        level_id = np.asarray(data['level']) - 1
+        y = np.asarray(data['y'], dtype=np.float64)
+        n = np.bincount(level_id, minlength=data['L'])
+        ybar = np.bincount(level_id, weights=y, minlength=data['L']) / n
+        ss = np.bincount(level_id, weights=(y - ybar[level_id])**2, minlength=data['L'])
+
+    estimates = np.array([truncated_normal_mle(n[i], ybar[i], ss[i], data['l'])
+                          for i in range(data['L'])])
+    return ApproxFit({'mu_l': estimates[None, :, 0], 'sigma_l': estimates[None, :, 1]},
+                     'closed_form')
+
+
+@instrument.instrumented
+def fit_model(model, data, inference='nuts', chains=4, iter=2000, n_jobs=-1, seed=344):
+    """
+    Fit a Stan model with the chosen inference mode.
+
+    Args:
+     model: compiled and loaded Stan model (unused for closed_form)
+     data: Stan data dict
+     inference: one of INFERENCE_MODES
+     chains, iter, n_jobs: NUTS settings
+     seed: random seed
+
+    Returns:
+     fit: StanFit (nuts) or ApproxFit. Both work with summarise_variable
+          and df_for_forestplot
+    """
+    if inference == 'nuts':
+        return model.sampling(data=data, iter=iter, chains=chains, n_jobs=n_jobs, seed=seed)
+    if inference == 'advi':
+        return vb_fit(model, data, seed=seed)
+    if inference == 'map':
+        return map_fit(model, data, seed=seed)
+    if inference == 'closed_form':
+        return closed_form_fit(data)
+    raise ValueError('inference must be one of {}'.format(INFERENCE_MODES))
+
+
+@instrument.instrumented
+def compare_inference(model, data, params, modes=INFERENCE_MODES, reference='nuts',
+                      **fit_kwargs):
+    """
+    Wall-clock time and error of each inference mode against a reference
+    (NUTS) fit of the same model and data.
+
+    Args:
+     model: compiled and loaded Stan model
+     data: Stan data dict
+     params: parameters to compare, e.g. ['mu_l', 'sigma_l']
+     modes: inference modes to time
+     reference: mode used as the reference
+     fit_kwargs: passed to fit_model
+
+    Returns:
+     comparison: dataframe with one row per mode: seconds, speedup over
+                 the reference, mean and max absolute error of posterior
+                 means, and mean absolute error in reference posterior sds
+    """
+
+    summaries = {}
+    seconds = {}
+    for mode in [reference] + [m for m in modes if m != reference]:
+        start = time.time()
+        fit = fit_model(model, data, mode, **fit_kwargs)
+        seconds[mode] = time.time() - start
+        summaries[mode] = fit_summary(fit, params).set_index('index')
+
+    ref = summaries[reference]
+    rows = []
+    for mode, summ_df in summaries.items():
+        error = (summ_df['mean'] - ref['mean']).abs()
+        rows.append({'inference': mode,
+                     'seconds': seconds[mode],
+                     'speedup': seconds[reference] / seconds[mode],
+                     'mean_abs_error': error.mean(),
+                     'max_abs_error': error.max(),
+                     'mean_abs_error_sd': (error / ref['sd']).mean()})
+    return pd.DataFrame(rows)
+
+
+##########################
+## POSTERIOR PREDICTIVE ##
+##########################
+
+# The Stan models only sample parameters: predictive values are drawn
+# here from the mu / sigma draws, streamed through fixed-size
+# accumulators. At most this many values are held at once
+PREDICTIVE_CHUNK_VALUES = 1000000
+
+# Histogram bins span the truncation bounds, narrowed to this many sd
+# either side of the mu draws, so the bins follow the data's units
+PREDICTIVE_NUM_BINS = 100
+PREDICTIVE_SPAN_SD = 6
+
+
+def truncated_normal_rng(mu, sigma, lower=-np.inf, upper=np.inf, rng=None):
+    """
+    Vectorized truncated normal draws by inverse CDF, one per element of
+    the broadcast mu, sigma and bounds. Intervals above the mean are
+    sampled as their mirror image below it, so the CDF stays away from 1
+    and far tails keep their precision.
+    """
+
+    rng = rng if rng is not None else np.random.default_rng()
+    mu, sigma, lower, upper = np.broadcast_arrays(mu, sigma, lower, upper)
+    a = (lower - mu) / sigma
+    b = (upper - mu) / sigma
+    flip = a > 0
+    lo = np.where(flip, -b, a)
+    hi = np.where(flip, -a, b)
+    p_lo = special.ndtr(lo)
+    p_hi = special.ndtr(hi)
+    u = rng.uniform(size=mu.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = special.ndtri(p_lo + u * (p_hi - p_lo))
+        # Intervals past double precision (~38 sd out): exponential tail
+        z = np.where(p_hi <= p_lo, hi + np.log(u) / np.abs(hi), z)
+    z = np.clip(z, lo, hi)
+    return mu + sigma * np.where(flip, -z, z)
+
+
+def predictive_bins(mu, sigma, lower=0, upper=np.inf, num_bins=PREDICTIVE_NUM_BINS,
+                    span_sd=PREDICTIVE_SPAN_SD):
+    """
+    Histogram bin edges for the predictive values of the given draws:
+    [lower, upper] where finite, narrowed to span_sd sd beyond the most
+    extreme mu draws. A mean outside the bounds still gets span_sd sd
+    inside them, where its truncated values pile up.
+    """
+
+    mu = np.ravel(mu)
+    spread = span_sd * np.ravel(sigma)
+    lo = np.clip(np.minimum(mu, upper) - spread, lower, upper).min()
+    hi = np.clip(np.maximum(mu, lower) + spread, lower, upper).max()
+    return np.linspace(lo, hi, num_bins + 1)
+
+
+class PredictiveSummary(object):
+    """
+    Fixed memory summary of streamed predictive values: counts over fixed
+    histogram bins (values outside the bins are counted, not binned),
+    plus count, sum and sum of squares for the mean and sd.
+    """
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def update(self, values):
+        values = np.ravel(values)
+        self.counts += np.histogram(values, self.bins)[0]
+        self.below += int((values < self.bins[0]).sum())
+        self.above += int((values > self.bins[-1]).sum())
+        self.n += len(values)
+        self.total += values.sum()
+        self.total_sq += (values**2).sum()
+
+    @property
+    def mean(self):
+        return self.total / self.n
+
+    @property
+    def sd(self):
+        return np.sqrt(max(self.total_sq / self.n - self.mean**2, 0))
+
+    def density(self):
+        """Histogram density, normalised over all values (as plt.hist(density=True))"""
+        return self.counts / (self.n * np.diff(self.bins))
+
+    def quantiles(self, q=SUMMARY_QUANTILES):
+        """Quantiles (percent) interpolated within bins. Tails outside the bins clip to the edges."""
+        cumulative = np.concatenate([[self.below], self.below + np.cumsum(self.counts)])
+        return np.interp(np.asarray(q) / 100.0 * self.n, cumulative, self.bins)
+
+
+def posterior_predictive(mu, sigma, n_obs=1, lower=0, upper=np.inf, bins=None,
+                         seed=344, chunk_values=PREDICTIVE_CHUNK_VALUES):
+    """
+    Posterior predictive distribution of a truncated normal model,
+    streamed a chunk of draws at a time so memory doesn't grow with the
+    number of draws or observations.
+
+    Args:
+     mu, sigma: posterior draws (e.g. fit['mu'], fit['sigma'], or
+                fit['mu_l'][:, j] for one level of a hierarchical fit)
+     n_obs: replicated observations per draw, e.g. the suburb's node count
+     lower, upper: truncation bounds (L and U of the Stan data)
+     bins: histogram bin edges. Defaults to predictive_bins of the draws
+     seed: random seed
+     chunk_values: largest number of predictive values held at once
+
+    Returns:
+     summary: PredictiveSummary of every predictive value
+     replicated: dataframe of the mean and sd of each draw's replicated
+                 dataset, for posterior predictive p-values
+    """
+
+    mu = np.ravel(mu)
+    sigma = np.ravel(sigma)
+    rng = np.random.default_rng(seed)
+    if bins is None:
+        bins = predictive_bins(mu, sigma, lower, upper)
+    summary = PredictiveSummary(bins)
+    chunk_draws = max(chunk_values // n_obs, 1)
+    rep_mean = np.empty(len(mu))
+    rep_sd = np.empty(len(mu))
+    for start in range(0, len(mu), chunk_draws):
+        draws = slice(start, start + chunk_draws)
+        shape = (len(mu[draws]), n_obs)
+        y_rep = truncated_normal_rng(np.broadcast_to(mu[draws, None], shape),
+                                     sigma[draws, None], lower, upper, rng=rng)
+        summary.update(y_rep)
+        rep_mean[draws] = y_rep.mean(axis=1)
+        rep_sd[draws] = y_rep.std(axis=1, ddof=1) if n_obs > 1 else np.nan
+    return summary, pd.DataFrame({'mean': rep_mean, 'sd': rep_sd})
+
+
+def predictive_check(mu, sigma, y, lower=0, upper=np.inf, bins=None, seed=344):
+    """
+    Posterior predictive check of observed values against replicated
+    datasets of the same size.
+
+    Returns:
+     check: dataframe of observed and predictive mean, sd and quantiles
+     p_values: posterior predictive p-values P(replicated >= observed) of
+               the mean and sd
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    summary, replicated = posterior_predictive(mu, sigma, len(y), lower, upper, bins, seed)
+    index = ['mean', 'sd'] + ['q{:g}'.format(q) for q in SUMMARY_QUANTILES]
+    check = pd.DataFrame({'observed': [y.mean(), y.std(ddof=1)] +
+                                      list(np.percentile(y, SUMMARY_QUANTILES)),
+                          'predictive': [summary.mean, summary.sd] +
+                                        list(summary.quantiles())},
+                         index=index)
+    p_values = {'mean': (replicated['mean'] >= y.mean()).mean(),
+                'sd': (replicated['sd'] >= y.std(ddof=1)).mean()}
+    return check, p_values
+
+
 ############################
 ## SUMMARIES AND PLOTTING ##
 ############################
@@ -64,6 +429,41 @@ def summarise_variable(stanfit, var):
 
 
 
+def suburb_data(df, suburb_name, level='suburb', L=0, U=80):
+    """
+    Stan data for one suburb's accessibility values.
+    """
+    suburb_df = df[df[level] == suburb_name]
+    suburb_df_dat = {'N': suburb_df.shape[0],
+                     'L': L,
+                     'U': U,
+                     'y': suburb_df['accessibility'].values,}
+    return suburb_df_dat
+
+
+def plot_suburb_fit(suburb_trunc_fit, df, suburb_name, L=0, U=80):
+    """
+    Plot model posterior predictive against raw values.
+    The predictive histogram is streamed from the mu and sigma draws
+    (see posterior_predictive) with the model's truncation bounds: pass
+    the L and U of the Stan data the fit was sampled with.
+    """
+    suburb_df = df[df['suburb'] == suburb_name]
+    summary, _ = posterior_predictive(suburb_trunc_fit['mu'], suburb_trunc_fit['sigma'],
+                                      n_obs=len(suburb_df), lower=L, upper=U)
+
+    fig, (ax1, ax2) = plt.subplots(ncols=2, sharex=True, sharey=True, figsize=(8,6))
+    ax1.stairs(summary.density(), summary.bins, fill=True);
+    ax1.set_title('Model accessibility values for {:s}'.format(suburb_name));
+
+    ax2.hist(suburb_df['accessibility'], bins=100, density=True);
+    ax2.set_title('Raw accessibility values for {:s}'.format(suburb_name));
+
+    plt.xlim(summary.bins[0], summary.bins[-1])
+    return
+
+
+@instrument.instrumented
 def run_plot_suburb_stan(df, model, suburb_name='Karori'):
     """
     Sample from lower truncated normal model for mean and sd
@@ -76,25 +476,11 @@ def run_plot_suburb_stan(df, model, suburb_name='Karori'):
      plot of raw vs. modelled values of accessibiity
     """
 
-    # Set up data
-    suburb_df = df[df['suburb'] == suburb_name]
-    suburb_df_dat = {'N': suburb_df.shape[0],
-                     'L': 0,
-                     'U': 80,
-                     'y': suburb_df['accessibility'].values,}
-
     # Run Stan model for suburb
-    suburb_trunc_fit = model.sampling(suburb_df_dat, chains=4)
+    data = suburb_data(df, suburb_name)
+    suburb_trunc_fit = model.sampling(data, chains=4)
 
-    # Plot model posterior predictive against raw values
-    fig, (ax1, ax2) = plt.subplots(ncols=2, sharex=True, sharey=True, figsize=(8,6))
-    ax1.hist(suburb_trunc_fit['y_pred'], bins=100, density=True);
-    ax1.set_title('Model accessibility values for {:s}'.format(suburb_name));
-
-    ax2.hist(suburb_df['accessibility'], bins=100, density=True);
-    ax2.set_title('Raw accessibility values for {:s}'.format(suburb_name));
-
-    plt.xlim(0,80)
+    plot_suburb_fit(suburb_trunc_fit, df, suburb_name, L=data['L'], U=data['U'])
     return
 
 
@@ -110,60 +496,95 @@ def run_plot_suburb(df, model, suburb_name='Karori'):
      plot of raw vs. modelled values of accessibiity
     """
 
-    # Set up data
-    suburb_df = df[df['suburb'] == suburb_name]
-    suburb_df_dat = {'N': suburb_df.shape[0],
-                     'L': 0,
-                     'U': 80,
-                     'y': suburb_df['accessibility'].values,}
+    run_plot_suburb_stan(df, model, suburb_name)
+    return
 
-    # Run Stan model for suburb
-    suburb_trunc_fit = model.sampling(suburb_df_dat, chains=4)
 
-    # Plot model posterior predictive against raw values
-    fig, (ax1, ax2) = plt.subplots(ncols=2, sharex=True, sharey=True, figsize=(8,6))
-    ax1.hist(suburb_trunc_fit['y_pred'], bins=100, density=True);
-    ax1.set_title('Model accessibility values for {:s}'.format(suburb_name));
+# Stan data layouts for the hierarchical models:
+#  - observations: univariate_normal_hierarchical_single_level
+#  - grouped: univariate_normal_hierarchical_single_level_grouped
+#  - sufficient: univariate_normal_hierarchical_single_level_suffstats
+HIERARCHICAL_DATA_MODES = ['observations', 'grouped', 'sufficient']
 
-    ax2.hist(suburb_df['accessibility'], bins=100, density=True);
-    ax2.set_title('Raw accessibility values for {:s}'.format(suburb_name));
 
-    plt.xlim(0,80)
-    return
+@instrument.instrumented
+def hierarchical_data(df, level='suburb', data_mode='observations', l=0):
+    """
+    Stan data for a single level hierarchical model.
 
+    Args:
+     df: accessibility df containing the level column
+     level: column of level names
+     data_mode: 'observations' (one row per node, in df order),
+                'grouped' (observations sorted by level, plus counts per
+                level) or 'sufficient' (per-level count, mean and sum of
+                squared deviations only)
+     l: lower truncation bound
 
+    Returns:
+     data: Stan data dict
+     level_lookup: dict of level name to 0-based level ID
+    """
+    if data_mode not in HIERARCHICAL_DATA_MODES:
+        raise ValueError('data_mode must be one of {}'.format(HIERARCHICAL_DATA_MODES))
+
+    level_lookup = dp.replace_categorical_with_int(df, level)
+    level_id = df[level].map(level_lookup).values.astype(np.int64)
+    y = df['accessibility'].values.astype(np.float64)
+    n_levels = len(level_lookup)
+
+    if data_mode == 'observations':
+        data = {'N': len(y),
+                'level': level_id + 1, # Stan counts starting at 1
+                'L': n_levels,
+                'l': l,
+                'y': y}
+        return data, level_lookup
+
+    counts = np.bincount(level_id, minlength=n_levels)
+    if data_mode == 'grouped':
+        order = np.argsort(level_id, kind='stable')
+        data = {'N': len(y),
+                'level': level_id[order] + 1,
+                'L': n_levels,
+                'n_l': counts,
+                'l': l,
+                'y': y[order]}
+        return data, level_lookup
+
+    ybar = np.bincount(level_id, weights=y, minlength=n_levels) / counts
+    ss = np.bincount(level_id, weights=(y - ybar[level_id])**2, minlength=n_levels)
+    data = {'L': n_levels,
+            'n_l': counts,
+            'l': l,
+            'ybar_l': ybar,
+            'ss_l': ss}
+    return data, level_lookup
+
+
+@instrument.instrumented
 def train_acc_hierarchical(df, normal_model, level='suburb',
-                           return_stanfit=False, return_levels_stanfit=False):
+                           return_stanfit=False, return_levels_stanfit=False,
+                           chains=1, iter=1000, n_jobs=-1,
+                           data_mode='observations', inference='nuts'):
     """
     Single level is sizechart at the moment. Should I make it more flexible?
     Yes, Try out a brand level one?
+    chains are sampled in parallel across n_jobs cores (-1 for all).
+    data_mode must match the model (see hierarchical_data): 'grouped' and
+    'sufficient' models cost O(levels) truncation terms per gradient.
+    inference selects NUTS, ADVI, MAP or closed_form (see fit_model).
     """
-    # Generate mapping from sizechart name to ID
-    level_values = df[level].unique()
-    level_lookup = dict(zip(level_values, range(len(level_values))))
-    level_lookup_df = pd.DataFrame({'level_id': list(level_lookup.values()),
-                                    'level': list(level_lookup.keys())})
-
-    level = df['level_id'] = (df[level]
-                              .replace(dp.replace_categorical_with_int(df, level)).values)
-
-    df = pd.merge(df,
-                     (df
-                     .groupby(['level_id'])
-                     .size()
-                     .reset_index(name='samples')))
+    partial_pool_data, level_lookup = hierarchical_data(df, level, data_mode)
+    df['level_id'] = df[level].map(level_lookup).values
 
     # Run the model
-    partial_pool_data = {'N': len(df),
-                         'level': df['level_id']+1, # Stan counts starting at 1,
-                         'L': len(level_values),
-                         'l': 0,
-                         'y': df['accessibility']}
-
-    partial_pool_fit = normal_model.sampling(data=partial_pool_data,
-                                             iter=1000,
-                                             chains=1,
-                                             seed=344)
+    partial_pool_fit = fit_model(normal_model, partial_pool_data,
+                                 inference=inference,
+                                 iter=iter,
+                                 chains=chains,
+                                 n_jobs=n_jobs,
+                                 seed=344)
 
     if return_stanfit:
         return partial_pool_fit
@@ -210,3 +631,133 @@ def custom_forestplot(df, param_categorical,
     if avg_min is not None:
         plt.axvspan(avg_min, avg_max, alpha=0.1, color='black')
     return
+
+
+#####################
+## FITTING SERVICE ##
+#####################
+
+# Per-process cache of compiled models used by fitting workers
+_MODELS = {}
+
+
+def worker_model(model_folder, model):
+    """Load a compiled model once per process."""
+    if (model_folder, model) not in _MODELS:
+        _MODELS[(model_folder, model)] = load_or_generate_stan_model(model_folder, model)
+    return _MODELS[(model_folder, model)]
+
+
+def fit_summary(stanfit, params):
+    """summarise_variable for several parameters in one frame"""
+    return pd.concat([summarise_variable(stanfit, param) for param in params],
+                     ignore_index=True)
+
+
+def _fit_level_worker(job):
+    model_folder, model, level_value, data, params, inference, sampling_kwargs = job
+    start = time.time()
+    stan_model = None if inference == 'closed_form' else worker_model(model_folder, model)
+    stanfit = fit_model(stan_model, data, inference, **sampling_kwargs)
+    summ_df = fit_summary(stanfit, params)
+    summ_df.insert(0, 'level', level_value)
+    summ_df['inference'] = inference
+    summ_df['seconds'] = time.time() - start
+    return summ_df
+
+
+@instrument.instrumented
+def fit_levels(df, model_folder='stan', model='lower_truncated_univariate_normal',
+               level='suburb', params=('mu', 'sigma'), processes=None,
+               chains=4, iter=2000, seed=344, L=0, U=80, inference='nuts'):
+    """
+    Fit the truncated normal model separately for every value of a level
+    (e.g. every suburb) in parallel, without plotting.
+    Each fit samples its chains serially in its own worker, so fits and
+    chains together are spread across all the cores.
+
+    Args:
+     df: accessibility df containing the level column
+     model_folder: folder of Stan models
+     model: Stan model name
+     level: column to fit separately for each value
+     params: parameters to summarise
+     processes: number of worker processes. Defaults to the CPU count
+     chains, iter, seed: Stan sampling settings
+     L, U: truncation bounds
+     inference: one of INFERENCE_MODES
+
+    Returns:
+     summ_df: summarise_variable rows for each level value, with level,
+              inference and fit time (seconds) columns
+    """
+
+    # Compile (or load) once up front so workers only ever load
+    if inference != 'closed_form':
+        load_or_generate_stan_model(model_folder, model)
+
+    sampling_kwargs = {'chains': chains, 'iter': iter, 'seed': seed, 'n_jobs': 1}
+    jobs = [(model_folder, model, level_value,
+             suburb_data(df, level_value, level, L, U), params, inference, sampling_kwargs)
+            for level_value in df[level].unique()]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        summaries = list(pool.map(_fit_level_worker, jobs))
+    return pd.concat(summaries, ignore_index=True)
+
+
+def _fit_hierarchical_worker(job):
+    model_folder, model, df, level, params, chains, iter, data_mode, inference = job
+    start = time.time()
+    stan_model = None if inference == 'closed_form' else worker_model(model_folder, model)
+    fit = train_acc_hierarchical(df, stan_model, level=level,
+                                 return_levels_stanfit=True,
+                                 chains=chains, iter=iter, n_jobs=chains,
+                                 data_mode=data_mode, inference=inference)
+    summ_df = fit_summary(fit['stanfit'], params)
+    summ_df['inference'] = inference
+    summ_df['seconds'] = time.time() - start
+
+    # Vector parameters like mu_l[3] map back to level names
+    level_names = np.array(list(fit['level_lookup']))
+    level_idx = summ_df['index'].str.extract(r'\[(\d+)\]')[0]
+    summ_df.insert(0, 'level_name', [level_names[int(i) - 1] if isinstance(i, str) else None
+                                     for i in level_idx])
+    summ_df.insert(0, 'level', level)
+    return summ_df
+
+
+@instrument.instrumented
+def fit_hierarchical(df, model_folder='stan',
+                     model='univariate_normal_hierarchical_single_level',
+                     levels=('suburb',), params=('mu_l', 'sigma_l'),
+                     processes=None, chains=4, iter=1000, data_mode='observations',
+                     inference='nuts'):
+    """
+    Hierarchical fits for several hierarchy levels (e.g. suburb, SA2) in
+    parallel processes, each sampling its chains in parallel. No plotting.
+
+    Args:
+     df: accessibility df containing the level columns
+     model_folder: folder of Stan models
+     model: hierarchical Stan model name
+     levels: level columns, one hierarchical fit each
+     params: parameters to summarise
+     processes: number of worker processes. Defaults to one per level
+     chains, iter: Stan sampling settings
+     data_mode: Stan data layout matching the model (see hierarchical_data)
+     inference: one of INFERENCE_MODES
+
+    Returns:
+     summ_df: summarise_variable rows with level, level_name, inference
+              and fit time (seconds) columns
+    """
+
+    if inference != 'closed_form':
+        load_or_generate_stan_model(model_folder, model)
+
+    jobs = [(model_folder, model, df, level, params, chains, iter, data_mode, inference)
+            for level in levels]
+    with ProcessPoolExecutor(max_workers=processes or len(jobs)) as pool:
+        summaries = list(pool.map(_fit_hierarchical_worker, jobs))
+    return pd.concat(summaries, ignore_index=True)
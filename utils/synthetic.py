@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy.spatial import cKDTree
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+# Synthetic networks are laid out from central Wellington
+ORIGIN = (174.77, -41.29)
+METRES_PER_DEGREE = 111320.0
+
+# Node spacing (m) and terrain relief (m) similar to Wellington streets
+NODE_SPACING = 80.0
+TERRAIN_RELIEF = 150.0
+TERRAIN_WAVELENGTH = 2000.0
+
+
+#############
+## TERRAIN ##
+#############
+
+def terrain_elevation(x, y, relief=TERRAIN_RELIEF, wavelength=TERRAIN_WAVELENGTH):
+    """
+    Smooth synthetic hills: a sum of two sinusoids over local metres.
+    Grades reach about relief * 2 pi / wavelength.
+    """
+    k = 2 * np.pi / wavelength
+    return relief * (0.5 + 0.3 * np.sin(k * x) * np.cos(k * y) +
+                     0.2 * np.sin(0.37 * k * x + 0.61 * k * y))
+
+
+def metres_to_lon_lat(x, y, origin=ORIGIN):
+    lon0, lat0 = origin
+    lat = lat0 + y / METRES_PER_DEGREE
+    lon = lon0 + x / (METRES_PER_DEGREE * np.cos(np.radians(lat0)))
+    return lon, lat
+
+
+def network_frames(x, y, u, v, origin=ORIGIN, relief=TERRAIN_RELIEF):
+    """
+    Node and edge frames in the layout used by the rest of the package.
+
+    Args:
+     x, y: node positions in local metres
+     u, v: edge end node positions
+     origin: (lon, lat) of the local origin
+     relief: terrain relief (m)
+
+    Returns:
+     nodes_df: x (lon), y (lat) and elevation, indexed by osmid
+     edges_df: u, v (osmids), length (m) and grade (u -> v)
+    """
+
+    elevation = terrain_elevation(x, y, relief)
+    lon, lat = metres_to_lon_lat(x, y, origin)
+    node_ids = np.arange(1, len(x) + 1, dtype=np.int64)
+    nodes_df = pd.DataFrame({'x': lon, 'y': lat, 'elevation': elevation},
+                            index=pd.Index(node_ids, name='osmid'))
+
+    length = np.maximum(np.hypot(x[v] - x[u], y[v] - y[u]), 1.0)
+    edges_df = pd.DataFrame({'u': node_ids[u],
+                             'v': node_ids[v],
+                             'length': length,
+                             'grade': (elevation[v] - elevation[u]) / length})
+    return nodes_df, edges_df
+
+
+##############
+## NETWORKS ##
+##############
+
+def grid_network(n_nodes, spacing=NODE_SPACING, origin=ORIGIN,
+                 relief=TERRAIN_RELIEF, seed=0):
+    """
+    Square street grid with about n_nodes intersections. Node positions
+    are jittered so edge lengths and grades vary.
+
+    Returns:
+     nodes_df, edges_df: see network_frames
+    """
+
+    rng = np.random.default_rng(seed)
+    side = max(int(np.ceil(np.sqrt(n_nodes))), 2)
+    rows, cols = np.divmod(np.arange(side * side), side)
+    x = cols * spacing + rng.uniform(-0.2, 0.2, side * side) * spacing
+    y = rows * spacing + rng.uniform(-0.2, 0.2, side * side) * spacing
+
+    node = np.arange(side * side).reshape(side, side)
+    u = np.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    v = np.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    return network_frames(x, y, u, v, origin, relief)
+
+
+def random_geometric_network(n_nodes, mean_degree=4, spacing=NODE_SPACING,
+                             origin=ORIGIN, relief=TERRAIN_RELIEF, seed=0):
+    """
+    Random geometric walk network: nodes scattered uniformly at the given
+    mean spacing, joined to every node within the radius that gives
+    mean_degree neighbours on average. Unlike the grid it has dead ends,
+    disconnected pieces and uneven density.
+
+    Returns:
+     nodes_df, edges_df: see network_frames
+    """
+
+    rng = np.random.default_rng(seed)
+    width = np.sqrt(n_nodes) * spacing
+    x = rng.uniform(0, width, n_nodes)
+    y = rng.uniform(0, width, n_nodes)
+    radius = spacing * np.sqrt(mean_degree / np.pi)
+    pairs = cKDTree(np.column_stack([x, y])).query_pairs(radius, output_type='ndarray')
+    return network_frames(x, y, pairs[:, 0], pairs[:, 1], origin, relief)
+
+
+SYNTHETIC_NETWORKS = {'grid': grid_network,
+                      'random_geometric': random_geometric_network}
+
+
+def synthetic_network(kind, n_nodes, seed=0):
+    """Synthetic nodes_df, edges_df by kind name (see SYNTHETIC_NETWORKS)"""
+    return SYNTHETIC_NETWORKS[kind](n_nodes, seed=seed)
+
+
+def to_osmnx_graph(nodes_df, edges_df):
+    """
+    osmnx style MultiDiGraph (both directions, x / y / elevation on nodes,
+    length / grade on edges) for the graph based processing functions.
+    """
+
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_nodes_from((osmid, {'osmid': osmid, 'x': x, 'y': y, 'elevation': z})
+                     for osmid, x, y, z in zip(nodes_df.index, nodes_df['x'],
+                                               nodes_df['y'], nodes_df['elevation']))
+    u = edges_df['u'].values
+    v = edges_df['v'].values
+    length = edges_df['length'].values
+    grade = edges_df['grade'].values
+    G.add_edges_from((u[i], v[i], 0, {'length': length[i], 'grade': grade[i]})
+                     for i in range(len(u)))
+    G.add_edges_from((v[i], u[i], 0, {'length': length[i], 'grade': -grade[i]})
+                     for i in range(len(u)))
+    return G
+
+
+##########
+## POIS ##
+##########
+
+def random_pois(nodes_df, n_pois, seed=0):
+    """
+    POIs scattered over the network's bounding box.
+
+    Returns:
+     pois_df: dataframe with lat and lon columns
+    """
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'lat': rng.uniform(nodes_df['y'].min(), nodes_df['y'].max(), n_pois),
+                         'lon': rng.uniform(nodes_df['x'].min(), nodes_df['x'].max(), n_pois)})
+
+
+def region_grid(nodes_df, n_side, name_col='region'):
+    """
+    Square regions tiling the network's bounding box, standing in for
+    suburb or meshblock polygons.
+
+    Returns:
+     regions: GeoDataFrame with a name column and polygon geometry
+    """
+
+    import geopandas
+    from shapely.geometry import box
+
+    x_edges = np.linspace(nodes_df['x'].min(), nodes_df['x'].max(), n_side + 1)
+    y_edges = np.linspace(nodes_df['y'].min(), nodes_df['y'].max(), n_side + 1)
+    # Widen the outer edges so boundary nodes fall inside a region
+    x_edges[[0, -1]] += [-1e-6, 1e-6]
+    y_edges[[0, -1]] += [-1e-6, 1e-6]
+    cells = [(i, j) for i in range(n_side) for j in range(n_side)]
+    return geopandas.GeoDataFrame(
+        {name_col: ['{}_{}_{}'.format(name_col, i, j) for i, j in cells]},
+        geometry=[box(x_edges[j], y_edges[i], x_edges[j + 1], y_edges[i + 1]) for i, j in cells],
+        crs='epsg:4326')
@@ -1,13 +1,169 @@
-
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import utils.lazy as lazy
+
+plt = lazy.lazy_import('matplotlib.pyplot')
+
+
+########################
+##  GLOBAL PARAMETERS ##
+########################
+
+toblers = [6.0, 3.5, 0.05]
+brunsdon = [3.557, 2.03, 0.13]
+
+# Quantized grade grid shared by all lookup tables: (min, max, step)
+GRADE_LOOKUP_GRID = (-1.0, 1.0, 0.0005)
+
+
+##################
+## SPEED MODELS ##
+##################
+
+# Speed kernels: vectorized functions of (grade array, params) -> km/hr
+
+def exponential_speed(grade, params):
+    """Tobler-style hiking speed: a * exp(-b * |grade + c|)"""
+    return params[0] * np.exp(-params[1] * np.abs(grade + params[2]))
+
+
+def constant_speed(grade, params):
+    """Grade independent speed: params[0]"""
+    return np.full(np.shape(grade), float(params[0]))
+
+
+def piecewise_speed(grade, params):
+    """
+    Speed curve interpolated between (grade, speed) breakpoints.
+    For user-defined curves such as wheelchair, pram or cycling speeds.
+    params is (grades, speeds) with grades increasing. Speeds are held
+    constant beyond the end breakpoints.
+    """
+    return np.interp(grade, params[0], params[1])
+
+
+SPEED_MODELS = {'tobler': (exponential_speed, toblers),
+                'brunsdon': (exponential_speed, brunsdon),
+                'flat': (constant_speed, [5.0])}
+
+
+def register_speed_model(name, kernel, params):
+    """
+    Add a speed model to the registry.
+
+    Args:
+     name: model name used by travel_time etc.
+     kernel: vectorized function of (grade, params) returning km/hr
+     params: parameters passed to the kernel
+
+    Example:
+     register_speed_model('pram', piecewise_speed,
+                          ([-0.1, 0.0, 0.1], [3.0, 4.5, 2.5]))
+    """
+    SPEED_MODELS[name] = (kernel, params)
+    return
+
+
+def get_speed_model(model):
+    """
+    Resolve a model name, a (kernel, params) pair or a bare parameter list
+    (the old params_list convention, exponential kernel) to (kernel, params).
+    """
+    if isinstance(model, str):
+        return SPEED_MODELS[model]
+    if callable(model[0]):
+        return model
+    return exponential_speed, model
+
+
+def speed_model_key(model):
+    """JSON serialisable description of a speed model, for cache keys."""
+    kernel, params = get_speed_model(model)
+    return [kernel.__name__, np.asarray(params, dtype=object).tolist()]
+
+
+def model_speed(grade, model='tobler'):
+    kernel, params = get_speed_model(model)
+    return kernel(np.asarray(grade, dtype=np.float64), params)
+
+
+#########################
+## GRADE LOOKUP TABLES ##
+#########################
+
+def grade_index(grade, grid=GRADE_LOOKUP_GRID):
+    """
+    Quantize grades onto the lookup grid. Compute once per edge set and
+    reuse for every model in a sweep. Grades outside the grid are clipped,
+    NaN grades get index -1.
+    """
+    grade_min, grade_max, step = grid
+    grade = np.asarray(grade, dtype=np.float64)
+    idx = np.rint((np.clip(grade, grade_min, grade_max) - grade_min) / step)
+    return np.where(np.isnan(grade), -1, np.nan_to_num(idx)).astype(np.int32)
+
+
+def speed_lookup_table(model='tobler', grid=GRADE_LOOKUP_GRID):
+    """
+    Speeds at every grade of the lookup grid, with a trailing NaN slot so
+    index -1 (NaN grade) gathers NaN.
+    """
+    grade_min, grade_max, step = grid
+    n_bins = int(round((grade_max - grade_min) / step)) + 1
+    grades = grade_min + step * np.arange(n_bins)
+    return np.append(model_speed(grades, model), np.nan)
+
+
+def travel_time(grade, distance, model='tobler', lookup=None):
+    """
+    Travel time (mins) over distance (m) at the model speed for the grade.
+
+    Args:
+     grade: array of grades
+     distance: array of distances (m)
+     model: model name, (kernel, params) or params list
+     lookup: optional (grade index, speed table) pair from grade_index and
+             speed_lookup_table. Speeds are then gathered, not evaluated.
+
+    Returns:
+     time_mins: array of times
+    """
+    if lookup is None:
+        speed = model_speed(grade, model)
+    else:
+        idx, table = lookup
+        speed = table[idx]
+    return (np.asarray(distance, dtype=np.float64) / 1000) / speed * 60.0
+
+
+def sweep_travel_times(grade, distance, models, lookup=True, grid=GRADE_LOOKUP_GRID):
+    """
+    Travel times for many speed models over the same edges.
+    With lookup, grades are quantized once and each model is a table
+    gather over the edges.
+
+    Args:
+     grade: array of grades
+     distance: array of distances (m)
+     models: dict of name to model (name, (kernel, params) or params list)
+     lookup: use quantized grade lookup tables
+     grid: lookup grid (min, max, step)
+
+    Returns:
+     times: dataframe with one column of times per model
+    """
+    idx = grade_index(grade, grid) if lookup else None
+    times = {}
+    for name, model in models.items():
+        model_lookup = (idx, speed_lookup_table(model, grid)) if lookup else None
+        times[name] = travel_time(grade, distance, model, lookup=model_lookup)
+    return pd.DataFrame(times)
 
 
 # MOVE TO UTILS
 # Conversion functions
 def hiking_speed(grade, params_list):
-    W = params_list[0]*np.exp(- params_list[1]* np.abs(grade + params_list[2]))
+    W = exponential_speed(grade, params_list)
     return W
 
 def flat_travel_time(distance, speed=5.0):
@@ -16,7 +172,7 @@ def flat_travel_time(distance, speed=5.0):
     return time_mins
 
 def hiking_time(grade, distance, params_list):
-    W = params_list[0]*np.exp(- params_list[1]* np.abs(grade + params_list[2]))
+    W = exponential_speed(grade, params_list)
     time_hr = (distance / 1000) / W
     time_mins = time_hr * 60.0
     return time_mins